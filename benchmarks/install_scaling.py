@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# time install and destroy of synthetic configs through the real main()
+#
+#   python3 benchmarks/install_scaling.py --scale 10,100,1000 --volumes 2 --nics 1 \
+#       --output bench.json
+#
+# every scale runs in its own process against a generated test driver host
+# (test:///<tmp>/host.xml, with directory pools in the same temp dir), so
+# nothing touches the local hypervisor. qemu-img, genisoimage and
+# virt-customize are replaced by stubs on PATH. per scale the report has the
+# wall time, libvirt calls and subprocesses of each phase of main(), the
+# libvirt calls by method and the peak rss of the process. compare two
+# reports with --compare old.json new.json
+#
+# the test driver only knows "test" domains, the domain type is switched for
+# the run. volumes are created through libvirt: the test driver never sees
+# files written behind its back, so --volume-backend qemu-img can't run here
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+LIBVIRT_CLASSES = (
+    "virConnect",
+    "virDomain",
+    "virNetwork",
+    "virStoragePool",
+    "virStorageVol",
+    "virInterface",
+    "virStream",
+)
+STUBS = ("qemu-img", "genisoimage", "virt-customize")
+STUB = """#!{python}
+import sys
+args = sys.argv[1:]
+if "-output" in args:
+    open(args[args.index("-output") + 1], "wb").close()
+elif args[:1] == ["create"]:
+    open(args[-2], "wb").close()
+"""
+BASE_IMAGE = "bench-base.qcow2"
+
+
+def write_stubs(bindir: str):
+    os.makedirs(bindir, exist_ok=True)
+    for name in STUBS:
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(STUB.format(python=sys.executable))
+        os.chmod(path, 0o755)
+
+
+def write_host(path: str, workdir: str, services: int) -> str:
+    # a test driver host big enough for every vm, with a vm pool and an image
+    # pool holding the base image
+    for pool in ("vms", "images"):
+        os.makedirs(os.path.join(workdir, pool), exist_ok=True)
+    open(os.path.join(workdir, "images", BASE_IMAGE), "wb").close()
+    cpus = max(8, services)
+    memory_kib = (services + 8) * 1024 * 1024
+    with open(path, "w") as f:
+        f.write(f"""<node>
+  <cpu>
+    <nodes>1</nodes><sockets>1</sockets><cores>{cpus}</cores><threads>1</threads>
+    <active>{cpus}</active><mhz>2000</mhz><model>x86_64</model>
+  </cpu>
+  <memory>{memory_kib}</memory>
+  <pool type="dir">
+    <name>vms</name>
+    <target><path>{workdir}/vms</path></target>
+  </pool>
+  <pool type="dir">
+    <name>images</name>
+    <target><path>{workdir}/images</path></target>
+    <volume type="file">
+      <name>{BASE_IMAGE}</name>
+      <capacity unit="G">2</capacity>
+      <target><path>{workdir}/images/{BASE_IMAGE}</path><format type="qcow2"/></target>
+    </volume>
+  </pool>
+</node>
+""")
+    return f"test://{path}"
+
+
+def make_config(args, uris: list) -> dict:
+    networks = {}
+    for n in range(args.networks):
+        # /16 each, addresses are left to the ipam
+        networks[f"bench-net{n}"] = {
+            "ipCidr": f"10.{100 + n}.0.1/16",
+            "mode": "nat",
+            "dhcp": {
+                "enabled": True,
+                "start": f"10.{100 + n}.200.1",
+                "end": f"10.{100 + n}.200.254",
+            },
+        }
+    services = {}
+    for i in range(args.services):
+        volumes = [{"type": "root", "size": "4G"}]
+        volumes += [
+            {"type": "additional", "size": "1G"} for _ in range(args.volumes - 1)
+        ]
+        services[f"bench-{i:05d}"] = {
+            "fqdn": f"bench-{i:05d}",
+            "cpu": 1,
+            "ram": {"size": 512, "shared": False},
+            "image": BASE_IMAGE,
+            "profile": "headless",
+            "users": [
+                {
+                    "name": "bench",
+                    "password": "bench",
+                    "ssh_key": ["ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBench bench"],
+                }
+            ],
+            "volumes": volumes,
+            "networks": [
+                {"name": f"bench-net{(i + k) % args.networks}"}
+                for k in range(args.nics)
+            ],
+        }
+    config = {
+        "libvirt": {"vm-pool": "vms", "iso-pool": "images"},
+        "networks": networks,
+        "services": services,
+    }
+    if len(uris) > 1:
+        config["hosts"] = {f"host{h}": {"uri": uri} for h, uri in enumerate(uris)}
+    else:
+        config["libvirt"]["uri"] = uris[0]
+    return config
+
+
+class Probe:
+    # counts libvirt method calls and spawned processes, split by the phase
+    # of main() that is running. phases run one after the other, the calls of
+    # worker threads land in the phase that started them
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phase = "setup"
+        self.phases = {}
+        self.calls = Counter()
+        self.processes = Counter()
+
+    def _current(self) -> dict:
+        return self.phases.setdefault(
+            self.phase, {"seconds": 0.0, "libvirt_calls": 0, "subprocesses": 0}
+        )
+
+    def count_call(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+            self._current()["libvirt_calls"] += 1
+
+    def count_process(self, name: str):
+        with self._lock:
+            self.processes[name] += 1
+            self._current()["subprocesses"] += 1
+
+    def timed(self, phase: str, func):
+        def wrapper(*args, **kwargs):
+            outer = self.phase
+            self.phase = phase
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._current()["seconds"] += time.monotonic() - start
+                self.phase = outer
+
+        return wrapper
+
+    def install(self):
+        import libvirt
+
+        def counted(name, func):
+            def wrapper(*args, **kwargs):
+                self.count_call(name)
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        for cls_name in LIBVIRT_CLASSES:
+            cls = getattr(libvirt, cls_name)
+            for name, func in list(vars(cls).items()):
+                if callable(func) and not name.startswith("_"):
+                    setattr(cls, name, counted(f"{cls_name}.{name}", func))
+        libvirt.open = counted("open", libvirt.open)
+
+        popen_init = subprocess.Popen.__init__
+
+        def init(popen, command, *args, **kwargs):
+            argv0 = command if isinstance(command, str) else command[0]
+            self.count_process(os.path.basename(str(argv0).split(" ")[0]))
+            popen_init(popen, command, *args, **kwargs)
+
+        subprocess.Popen.__init__ = init
+
+
+def run_one(args) -> dict:
+    # child process: environment first, vmcreator reads it at import
+    workdir = tempfile.mkdtemp(prefix="vmcreator-bench-")
+    write_stubs(os.path.join(workdir, "bin"))
+    os.environ["PATH"] = os.path.join(workdir, "bin") + os.pathsep + os.environ["PATH"]
+    os.environ["VMCREATOR_CACHE_DIR"] = os.path.join(workdir, "cache")
+    uris = [
+        write_host(
+            os.path.join(workdir, f"host{h}.xml"),
+            os.path.join(workdir, f"host{h}"),
+            args.services,
+        )
+        for h in range(args.hosts)
+    ]
+    config_path = os.path.join(workdir, "bench.yaml")
+    import yaml
+
+    with open(config_path, "w") as f:
+        yaml.safe_dump(make_config(args, uris), f)
+
+    probe = Probe()
+    probe.install()
+
+    from string import Template
+    import vmcreator.main as cli
+    from vmcreator import templates
+    from vmcreator.plan import Plan
+
+    # the state file is written next to the cwd
+    os.chdir(workdir)
+
+    templates.DOMAIN_HEAD = Template(
+        templates.DOMAIN_HEAD.template.replace('type="kvm"', 'type="test"')
+    )
+    for name, phase in (
+        ("read_config", "read_config"),
+        ("read_state", "read_state"),
+        ("read_reservations", "reservations"),
+        ("resolve_addresses", "addresses"),
+        ("place_services", "placement"),
+        ("plan_from_config", "plan"),
+        ("check_capacity", "capacity"),
+        ("write_state", "write_state"),
+    ):
+        setattr(cli, name, probe.timed(phase, getattr(cli, name)))
+    Plan.apply = probe.timed("apply", Plan.apply)
+    Plan.destroy = probe.timed("destroy", Plan.destroy)
+
+    summaries = []
+    print_summary = cli.print_summary
+
+    def summary(results):
+        summaries.append(
+            {"resources": len(results), "failed": sum(1 for r in results if not r.ok)}
+        )
+        return print_summary(results)
+
+    cli.print_summary = summary
+
+    report = {
+        "services": args.services,
+        "volumes": args.volumes,
+        "nics": args.nics,
+        "networks": args.networks,
+        "hosts": args.hosts,
+        "actions": {},
+    }
+    argvs = [
+        (
+            "install",
+            f"install --force --parallel {args.parallel} --iso-backend {args.iso_backend}",
+        )
+    ]
+    if not args.skip_destroy:
+        argvs.append(
+            (
+                "destroy",
+                f"destroy --delete-storage --delete-network --parallel {args.parallel}",
+            )
+        )
+
+    log = open(os.path.join(workdir, "vmcreator.log"), "w")
+    stdout = sys.stdout
+    for action, argv in argvs:
+        probe.phases = {}
+        probe.phase = "main"
+        del summaries[:]
+        sys.argv = ["vmcreator", "-c", config_path] + argv.split()
+        sys.stdout = log
+        start = time.monotonic()
+        code = 0
+        try:
+            cli.main()
+        except SystemExit as e:
+            code = e.code or 0
+        finally:
+            sys.stdout = stdout
+        report["actions"][action] = {
+            "seconds": round(time.monotonic() - start, 4),
+            "exit_code": code,
+            "results": summaries[0] if summaries else None,
+            "phases": {
+                phase: dict(values, seconds=round(values["seconds"], 4))
+                for phase, values in probe.phases.items()
+            },
+        }
+    log.close()
+
+    import libvirt
+
+    report["libvirt_calls"] = dict(probe.calls.most_common())
+    report["subprocesses"] = dict(probe.processes)
+    report["peak_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["libvirt_version"] = libvirt.getVersion()
+    report["log"] = os.path.join(workdir, "vmcreator.log")
+    return report
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path) as f:
+        old = {r["services"]: r for r in json.load(f)["runs"]}
+    with open(new_path) as f:
+        new = {r["services"]: r for r in json.load(f)["runs"]}
+    for services in sorted(set(old) & set(new)):
+        for action in new[services]["actions"]:
+            a = old[services]["actions"].get(action)
+            b = new[services]["actions"][action]
+            if not a:
+                continue
+            print(
+                f"{services} services {action}: {a['seconds']:.2f}s -> {b['seconds']:.2f}s"
+            )
+            for phase, values in b["phases"].items():
+                before = a["phases"].get(phase, {})
+                print(
+                    f"  {phase:14} {before.get('seconds', 0):8.3f}s -> {values['seconds']:8.3f}s"
+                    f"  calls {before.get('libvirt_calls', 0):6} -> {values['libvirt_calls']:6}"
+                )
+        print(
+            f"  peak rss {old[services]['peak_rss_kib']} -> {new[services]['peak_rss_kib']} KiB"
+        )
+
+
+def main():
+    arg = argparse.ArgumentParser("install_scaling")
+    arg.add_argument(
+        "--scale", default="10,100", help="service counts, comma separated"
+    )
+    arg.add_argument(
+        "--volumes",
+        type=int,
+        default=2,
+        help="volumes per service, the first is the root disk",
+    )
+    arg.add_argument("--nics", type=int, default=1, help="nics per service")
+    arg.add_argument("--networks", type=int, default=2)
+    arg.add_argument(
+        "--hosts",
+        type=int,
+        default=1,
+        help="test driver hosts, more than one adds a hosts: section",
+    )
+    arg.add_argument("--parallel", type=int, default=4)
+    arg.add_argument(
+        "--iso-backend", default="python", choices=("python", "genisoimage")
+    )
+    arg.add_argument("--skip-destroy", action="store_true")
+    arg.add_argument(
+        "--output", "-o", help="write the json report here instead of stdout"
+    )
+    arg.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    arg.add_argument("--services", type=int, help=argparse.SUPPRESS)
+    args = arg.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.services:
+        # one scale, run by the parent below
+        print(json.dumps(run_one(args)))
+        return
+
+    runs = []
+    for services in (int(s) for s in args.scale.split(",")):
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--services",
+            str(services),
+        ]
+        for name in ("volumes", "nics", "networks", "hosts", "parallel", "iso_backend"):
+            command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+        if args.skip_destroy:
+            command.append("--skip-destroy")
+        print(f"{services} services...", file=sys.stderr)
+        out = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+
+    report = json.dumps(
+        {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": runs}, indent=2
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# compare volume creation through storageVolCreateXML against qemu-img
+#
+#   python3 benchmarks/volume_backends.py --uri qemu:///system --pool default \
+#       --count 50 --image-pool isos --image bionic-server-cloudimg-amd64.img
+#
+# the qemu-img backend needs a directory pool on the local host, the libvirt
+# backend also runs against the test driver (test:///default, pool default-pool)
+
+import argparse
+import json
+import time
+import uuid
+from vmcreator.storage import BasicStorage, RootStorage, VOLUME_BACKENDS
+
+
+def bench(args, backend):
+    run_id = uuid.uuid4().hex[:8]
+    volumes = []
+    for i in range(args.count):
+        if args.image:
+            vol = RootStorage(
+                f"bench-{run_id}-{i}",
+                storage_pool_name=args.pool,
+                size=args.size,
+                image=args.image,
+                image_pool=args.image_pool,
+                volume_backend=backend,
+                uri=args.uri,
+            )
+        else:
+            vol = BasicStorage(
+                f"bench-{run_id}-{i}",
+                storage_pool_name=args.pool,
+                size=args.size,
+                volume_backend=backend,
+                uri=args.uri,
+            )
+        volumes.append(vol)
+
+    manager = volumes[0].get_pool_manager()
+    refreshes = manager.get_refresh_count()
+
+    start = time.monotonic()
+    for vol in volumes:
+        vol.create()
+    # resolving the volumes is part of the cost (refresh for qemu-img)
+    for vol in volumes:
+        vol.get_disk()
+    create_time = time.monotonic() - start
+
+    start = time.monotonic()
+    for vol in volumes:
+        vol.delete()
+    delete_time = time.monotonic() - start
+
+    return {
+        "backend": backend,
+        "count": args.count,
+        "create_seconds": round(create_time, 4),
+        "per_volume_ms": round(create_time / args.count * 1000, 3),
+        "delete_seconds": round(delete_time, 4),
+        "pool_refreshes": manager.get_refresh_count() - refreshes,
+    }
+
+
+def main():
+    arg = argparse.ArgumentParser("volume_backends")
+    arg.add_argument("--uri", default="qemu:///system")
+    arg.add_argument("--pool", default="default")
+    arg.add_argument("--count", type=int, default=20)
+    arg.add_argument("--size", default="1G")
+    arg.add_argument("--image", help="base image, benchmarks root disks when set")
+    arg.add_argument("--image-pool", default="default")
+    arg.add_argument(
+        "--backend", action="append", choices=VOLUME_BACKENDS, help="default: all"
+    )
+    args = arg.parse_args()
+
+    results = [bench(args, backend) for backend in args.backend or VOLUME_BACKENDS]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from vmcreator.cache import IsoCache, digest_files
+
+
+def test_digest_covers_names_and_content():
+    seed = {"user-data": b"a", "meta-data": b"b"}
+    assert digest_files(seed) == digest_files(dict(reversed(list(seed.items()))))
+    assert digest_files(seed) != digest_files({"user-data": b"ab", "meta-data": b""})
+    assert digest_files(seed) != digest_files({"user-datab": b"a", "meta-data": b""})
+
+
+def test_put_and_get(tmp_path):
+    cache = IsoCache(str(tmp_path))
+    assert cache.get("k1") is None
+    path = cache.put_data("k1", b"iso")
+    assert cache.get("k1") == path
+    src = tmp_path / "built.iso"
+    src.write_bytes(b"other")
+    with open(cache.put("k2", str(src)), "rb") as f:
+        assert f.read() == b"other"
+    # the index survives a restart
+    assert IsoCache(str(tmp_path)).get("k1") == path
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = IsoCache(str(tmp_path), max_size=10)
+    cache.put_data("old", b"1234")
+    cache.put_data("used", b"1234")
+    cache.get("old")
+    cache.put_data("new", b"1234")
+    assert cache.get("used") is None
+    assert cache.get("old") and cache.get("new")
+
+
+def test_placements(tmp_path):
+    cache = IsoCache(str(tmp_path))
+    cache.record_placement("test:///a#vms/a.iso", "k1", "100")
+    assert cache.placed("test:///a#vms/a.iso", "100") == "k1"
+    # rewritten behind our back
+    assert cache.placed("test:///a#vms/a.iso", "101") is None
+    cache.forget_placement("test:///a#vms/a.iso")
+    assert cache.placed("test:///a#vms/a.iso", "100") is None
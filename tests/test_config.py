@@ -0,0 +1,180 @@
+import datetime
+import os
+
+import pytest
+import yaml
+
+from vmcreator.config import ConfigCache, ConfigError, compile_config, load_config
+
+SERVICE = {
+    "cpu": 1,
+    "ram": {"size": 1024},
+    "image": "base.qcow2",
+    "users": [],
+    "volumes": [{"type": "root", "size": "10G"}],
+    "networks": [{"name": "oam"}],
+}
+
+
+def make_data(services: dict, **extra) -> dict:
+    data = {
+        "libvirt": {"vm-pool": "vms", "iso-pool": "isos"},
+        "networks": {
+            "oam": {
+                "ipCidr": "10.0.0.1/24",
+                "mode": "nat",
+                "dhcp": {"enabled": True, "start": "10.0.0.100", "end": "10.0.0.200"},
+            }
+        },
+        "services": {name: dict(SERVICE, **svc) for name, svc in services.items()},
+    }
+    data.update(extra)
+    return data
+
+
+def test_compile():
+    config = compile_config(
+        make_data(
+            {
+                "web": {"networks": [{"name": "oam"}, {"name": "oam"}]},
+                "db": {"ram": {"size": 2048, "shared": True}},
+            }
+        )
+    )
+    assert list(config.services) == ["web", "db"]
+    assert [n.index for n in config.services["web"].networks] == [0, 1]
+    assert config.services["db"].ram == 2048
+    assert config.services["db"].shared_ram
+    assert config.services["db"].profile == "default"
+    assert config.networks["oam"].dhcp_start == "10.0.0.100"
+
+
+def test_errors_reported_at_once():
+    data = make_data(
+        {"web": {"ram": {}, "networks": [{"name": "oam"}, {"name": "nope"}]}}
+    )
+    del data["networks"]["oam"]["dhcp"]
+    with pytest.raises(ConfigError) as e:
+        compile_config(data)
+    assert e.value.errors == [
+        "networks.oam.dhcp: missing",
+        "services.web.ram.size: missing",
+        "services.web.networks[1].name: unknown network nope",
+    ]
+
+
+def test_bad_values():
+    data = make_data(
+        {
+            "web": {
+                "volumes": [{"type": "data", "size": "lots"}],
+                "networks": [{"name": "oam", "ipAddr": "10.1.0.5"}],
+                "profile": "fancy",
+            }
+        }
+    )
+    with pytest.raises(ConfigError) as e:
+        compile_config(data)
+    assert "services.web.volumes[0].size: not a size: lots" in e.value.errors
+    assert (
+        "services.web.networks[0].ipAddr: 10.1.0.5 is outside 10.0.0.0/24"
+        in e.value.errors
+    )
+    assert any(err.startswith("services.web.profile: one of") for err in e.value.errors)
+
+
+def test_root_volume_needs_size():
+    data = make_data({"web": {"volumes": [{"type": "root"}]}})
+    with pytest.raises(ConfigError) as e:
+        compile_config(data)
+    assert e.value.errors == ["services.web.volumes[0].size: missing"]
+
+
+def test_host_pin_unknown():
+    data = make_data({"build": {"host": "nope"}}, hosts={"hv1": {"uri": "test:///"}})
+    with pytest.raises(ConfigError) as e:
+        compile_config(data)
+    assert "services.build.host: unknown host nope" in e.value.errors
+
+
+def test_replicas():
+    config = compile_config(
+        make_data(
+            {
+                "worker-{i:02d}": {
+                    "replicas": 3,
+                    "fqdn": "worker-{i:02d}.lab",
+                    "networks": [{"name": "oam", "ipAddr": "10.0.0.10"}],
+                },
+                "db": {"replicas": 2, "networks": [{"name": "oam"}]},
+            }
+        )
+    )
+    assert list(config.services) == [
+        "worker-01",
+        "worker-02",
+        "worker-03",
+        "db-1",
+        "db-2",
+    ]
+    assert len(config.services) == 5
+    worker = config.services["worker-03"]
+    assert worker.fqdn == worker.raw["fqdn"] == "worker-03.lab"
+    assert worker.networks[0].ip == "10.0.0.12"
+    assert "replicas" not in worker.raw
+    assert "worker-3" not in config.services
+    assert "worker-04" not in config.services
+    assert list(config.subset(["db-2", "gone"]).services) == ["db-2"]
+
+
+def test_replicas_collide():
+    with pytest.raises(ConfigError) as e:
+        compile_config(make_data({"web": {"replicas": 2}, "web-2": {}}))
+    assert "services: web-2 from web-2 and web-{i}" in e.value.errors
+
+
+def test_replica_addresses_checked():
+    data = make_data(
+        {"web": {"replicas": 10, "networks": [{"name": "oam", "ipAddr": "10.0.0.250"}]}}
+    )
+    with pytest.raises(ConfigError) as e:
+        compile_config(data)
+    assert e.value.errors == [
+        "services.web.networks[0].ipAddr: 10.0.1.3 is outside 10.0.0.0/24"
+    ]
+
+
+def test_cache_keeps_plain_data(tmp_path):
+    filename = tmp_path / "config.yaml"
+    filename.write_text(yaml.safe_dump(make_data({"web": {}})))
+    cache = ConfigCache(str(tmp_path / "cache"))
+
+    config = load_config(str(filename), cache)
+    entries = os.listdir(tmp_path / "cache" / "config")
+    assert len(entries) == 1 and entries[0].endswith(".json")
+    assert load_config(str(filename), cache) == config
+
+
+def test_cache_skips_data_json_can_not_hold(tmp_path):
+    data = make_data({"web": {}})
+    data["built"] = datetime.date(2024, 1, 1)
+    filename = tmp_path / "config.yaml"
+    filename.write_text(yaml.safe_dump(data))
+    cache = ConfigCache(str(tmp_path / "cache"))
+
+    load_config(str(filename), cache)
+    assert not os.path.exists(tmp_path / "cache" / "config")
+
+
+def test_cache_entry_is_checked_again(tmp_path):
+    filename = tmp_path / "config.yaml"
+    content = yaml.safe_dump(make_data({"web": {}}))
+    filename.write_text(content)
+    cache = ConfigCache(str(tmp_path / "cache"))
+    load_config(str(filename), cache)
+
+    # a tampered entry is compiled like any file, it can't skip the checks
+    (path,) = (tmp_path / "cache" / "config").iterdir()
+    path.write_text('{"services": {}}')
+    with pytest.raises(ConfigError):
+        load_config(str(filename), cache)
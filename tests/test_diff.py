@@ -0,0 +1,124 @@
+from vmcreator.config import compile_config
+from vmcreator.diff import diff_configs
+
+SERVICE = {
+    "cpu": 1,
+    "ram": {"size": 1024},
+    "image": "base.qcow2",
+    "users": [],
+    "volumes": [{"type": "root", "size": "10G"}],
+    "networks": [{"name": "oam", "ipAddr": "10.0.0.10"}],
+}
+
+
+def make_config(services: dict, ipcidr: str = "10.0.0.1/24"):
+    return compile_config(
+        {
+            "libvirt": {"vm-pool": "vms", "iso-pool": "isos"},
+            "networks": {
+                "oam": {"ipCidr": ipcidr, "mode": "nat", "dhcp": {"enabled": False}},
+                "storage": {
+                    "ipCidr": "10.1.0.1/24",
+                    "mode": "isolated",
+                    "dhcp": {"enabled": False},
+                },
+            },
+            "services": {
+                name: dict(SERVICE, **extra) for name, extra in services.items()
+            },
+        }
+    )
+
+
+def test_unchanged():
+    diff = diff_configs(make_config({"a": {}}), make_config({"a": {}}))
+    assert diff.is_empty()
+    assert not diff.warnings
+
+
+def test_added_and_removed():
+    diff = diff_configs(
+        make_config({"a": {}, "b": {}}), make_config({"b": {}, "c": {}})
+    )
+    assert diff.added == ["c"]
+    assert diff.removed == ["a"]
+    assert not diff.changed
+
+
+def test_volumes():
+    old = make_config({"a": {}})
+    new = make_config(
+        {
+            "a": {
+                "volumes": [
+                    {"type": "root", "size": "20G"},
+                    {"type": "data", "size": "5G"},
+                ]
+            }
+        }
+    )
+    change = diff_configs(old, new).changed["a"]
+    assert change.grown_volumes == [0]
+    assert change.added_volumes == [1]
+    assert not change.cloudinit
+
+    change = diff_configs(new, old).changed["a"]
+    assert change.removed_volumes == [1]
+    assert change.ignored == ["volume #0 can not shrink, ignored"]
+
+
+def test_nics_by_index():
+    old = make_config({"a": {}})
+    new = make_config(
+        {
+            "a": {
+                "networks": [
+                    {"name": "oam", "ipAddr": "10.0.0.10"},
+                    {"name": "oam", "ipAddr": "10.0.0.11"},
+                    {"name": "storage", "ipAddr": "10.1.0.10"},
+                ]
+            }
+        }
+    )
+    change = diff_configs(old, new).changed["a"]
+    assert [(n.network, n.index) for n in change.added_networks] == [
+        ("oam", 1),
+        ("storage", 0),
+    ]
+    assert not change.removed_networks
+    # the guest's network config changes with its nics
+    assert change.cloudinit
+
+    # the first nic on oam goes away, the second one takes index 0
+    swapped = make_config({"a": {"networks": [{"name": "oam", "ipAddr": "10.0.0.11"}]}})
+    change = diff_configs(new, swapped).changed["a"]
+    assert [(n.network, n.index, n.ip) for n in change.removed_networks] == [
+        ("oam", 0, "10.0.0.10"),
+        ("oam", 1, "10.0.0.11"),
+        ("storage", 0, "10.1.0.10"),
+    ]
+    assert [(n.network, n.index, n.ip) for n in change.added_networks] == [
+        ("oam", 0, "10.0.0.11")
+    ]
+
+
+def test_resources_and_cloudinit():
+    old = make_config({"a": {}})
+    new = make_config(
+        {"a": {"cpu": 2, "ram": {"size": 2048}, "fqdn": "a.lab", "image": "new.img"}}
+    )
+    change = diff_configs(old, new).changed["a"]
+    assert change.vcpu == 2
+    assert change.ram == 2048
+    assert change.cloudinit
+    assert change.ignored == ["image changed, needs destroy+install"]
+
+
+def test_network_change_warns():
+    diff = diff_configs(
+        make_config({"a": {}}), make_config({"a": {}}, ipcidr="10.0.0.1/16")
+    )
+    assert diff.is_empty()
+    assert diff.warnings == [
+        "network oam definition changed, existing network is not modified"
+    ]
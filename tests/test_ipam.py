@@ -0,0 +1,172 @@
+import pytest
+
+from vmcreator.config import compile_config
+from vmcreator.ipam import AddressPool, Ipam, IpamError
+
+SERVICE = {
+    "cpu": 1,
+    "ram": {"size": 1024},
+    "image": "base.qcow2",
+    "users": [],
+    "volumes": [{"type": "root", "size": "10G"}],
+}
+
+
+def make_config(services: dict, ipcidr: str = "10.0.0.1/24"):
+    return compile_config(
+        {
+            "libvirt": {"vm-pool": "vms", "iso-pool": "isos"},
+            "networks": {
+                "oam": {
+                    "ipCidr": ipcidr,
+                    "mode": "nat",
+                    "dhcp": {
+                        "enabled": True,
+                        "start": "10.0.0.2",
+                        "end": "10.0.0.200",
+                    },
+                }
+            },
+            "services": {
+                name: dict(SERVICE, networks=nics) for name, nics in services.items()
+            },
+        }
+    )
+
+
+def addresses(config, vm: str) -> list:
+    return [nic.ip for nic in config.services[vm].networks]
+
+
+def test_pool_skips_reserved_addresses():
+    pool = AddressPool("oam", "10.0.0.1/29")
+    assert [pool.allocate(f"vm{i}") for i in range(6)] == [
+        "10.0.0.2",
+        "10.0.0.3",
+        "10.0.0.4",
+        "10.0.0.5",
+        "10.0.0.6",
+        None,
+    ]
+    assert pool.owner("10.0.0.1") == "gateway"
+    assert pool.owner("10.0.0.7") == "broadcast address"
+
+
+def test_pool_avoids_dhcp_range_first():
+    pool = AddressPool("oam", "10.0.0.1/24", "10.0.0.2", "10.0.0.250")
+    assert [pool.allocate("a"), pool.allocate("b")] == ["10.0.0.251", "10.0.0.252"]
+    assert [pool.allocate("c"), pool.allocate("c")] == ["10.0.0.253", "10.0.0.254"]
+    # outside the range is used up, then the range itself
+    assert pool.allocate("d") == "10.0.0.2"
+
+
+def test_pool_too_large():
+    pool = AddressPool("big", "10.0.0.1/8")
+    assert pool.reserve("10.1.2.3", "vm") is None
+    with pytest.raises(ValueError):
+        pool.allocate("vm")
+
+
+def test_resolve_fills_in_addresses():
+    config = make_config(
+        {
+            "a": [{"name": "oam", "ipAddr": "10.0.0.201"}, {"name": "oam"}],
+            "b": [{"name": "oam"}],
+        }
+    )
+    ipam = Ipam()
+    resolved = ipam.resolve(config)
+    assert addresses(resolved, "a") == ["10.0.0.201", "10.0.0.202"]
+    assert addresses(resolved, "b") == ["10.0.0.203"]
+    assert ipam.get_allocations() == {"a/oam/1": "10.0.0.202", "b/oam/0": "10.0.0.203"}
+    # the config itself is left alone
+    assert addresses(config, "b") == [None]
+
+
+def test_resolve_keeps_earlier_addresses():
+    config = make_config({"a": [{"name": "oam"}], "b": [{"name": "oam"}]})
+    ipam = Ipam({"b/oam/0": "10.0.0.250"})
+    resolved = ipam.resolve(config)
+    assert addresses(resolved, "a") == ["10.0.0.201"]
+    assert addresses(resolved, "b") == ["10.0.0.250"]
+
+
+def test_resolve_moves_taken_address():
+    config = make_config(
+        {"a": [{"name": "oam", "ipAddr": "10.0.0.250"}], "b": [{"name": "oam"}]}
+    )
+    ipam = Ipam({"b/oam/0": "10.0.0.250"})
+    resolved = ipam.resolve(config)
+    assert addresses(resolved, "b") == ["10.0.0.201"]
+
+
+def test_conflicts_reported_at_once():
+    config = make_config(
+        {
+            "a": [{"name": "oam", "ipAddr": "10.0.0.210"}],
+            "b": [{"name": "oam", "ipAddr": "10.0.0.210"}],
+            "c": [{"name": "oam", "ipAddr": "10.0.0.1"}],
+            "d": [{"name": "oam", "ipAddr": "10.0.0.220"}],
+        }
+    )
+    reservations = {
+        "oam": [
+            {"name": "other", "mac": "52:54:00:00:00:01", "ip": "10.0.0.220"},
+            {"name": "a", "mac": "52:54:00:00:00:02", "ip": "10.0.0.210"},
+        ]
+    }
+    ipam = Ipam()
+    with pytest.raises(IpamError) as e:
+        ipam.resolve(config, reservations, managed={"a", "b", "c", "d"})
+    assert e.value.errors == [
+        "b: ipAddr on oam: 10.0.0.210 is already used by a",
+        "c: ipAddr on oam: 10.0.0.1 is already used by gateway",
+        "d: ipAddr on oam: 10.0.0.220 is already used by reservation other (52:54:00:00:00:01)",
+    ]
+    # nothing is recorded when anything failed
+    assert ipam.get_allocations() == {}
+
+
+def test_reservations_of_others_are_skipped():
+    config = make_config({"a": [{"name": "oam"}]})
+    reservations = {
+        "oam": [{"name": "other", "mac": "52:54:00:00:00:01", "ip": "10.0.0.201"}]
+    }
+    resolved = Ipam().resolve(config, reservations, managed={"a"})
+    assert addresses(resolved, "a") == ["10.0.0.202"]
+
+
+def test_release():
+    config = make_config({"a": [{"name": "oam"}], "b": [{"name": "oam"}]})
+    ipam = Ipam()
+    ipam.resolve(config)
+    ipam.release("a")
+    assert list(ipam.get_allocations()) == ["b/oam/0"]
+
+
+def test_network_too_large_for_auto_addresses():
+    config = make_config({"a": [{"name": "oam"}]}, ipcidr="10.0.0.1/8")
+    with pytest.raises(IpamError) as e:
+        Ipam().resolve(config)
+    assert e.value.errors == [
+        "a: no ipAddr on oam: 10.0.0.0/8 is too large to assign addresses from, set ipAddr"
+    ]
+
+
+def test_recall_allocates_nothing():
+    config = make_config(
+        {
+            "a": [{"name": "oam", "ipAddr": "10.0.0.210"}, {"name": "oam"}],
+            "b": [{"name": "oam"}],
+        }
+    )
+    ipam = Ipam({"a/oam/1": "10.0.0.201", "gone/oam/0": "10.0.0.202"})
+    recalled = ipam.recall(config)
+    assert addresses(recalled, "a") == ["10.0.0.210", "10.0.0.201"]
+    # no state for b: it stays without an address instead of getting one
+    # that may be reserved by someone else
+    assert addresses(recalled, "b") == [None]
+    assert ipam.get_allocations() == {
+        "a/oam/1": "10.0.0.201",
+        "gone/oam/0": "10.0.0.202",
+    }
@@ -0,0 +1,65 @@
+import struct
+
+from vmcreator.iso9660 import SECTOR, build_iso
+
+SEED = {
+    "user-data": b"#cloud-config\nhostname: web\n",
+    "meta-data": b"instance-id: web\n",
+    "network-config": b"version: 2\n" * 300,
+}
+
+
+def read_dir(iso: bytes, descriptor: int, encoding: str) -> dict:
+    # {name: content} of the root directory the volume descriptor points at
+    vd = iso[descriptor * SECTOR : (descriptor + 1) * SECTOR]
+    (extent,) = struct.unpack_from("<I", vd, 158)
+    (size,) = struct.unpack_from("<I", vd, 166)
+    directory = iso[extent * SECTOR : extent * SECTOR + size]
+    files = {}
+    offset = 0
+    while offset < len(directory):
+        length = directory[offset]
+        if length == 0:
+            # records don't span sectors, the rest of this one is padding
+            offset = (offset // SECTOR + 1) * SECTOR
+            continue
+        record = directory[offset : offset + length]
+        if not record[25] & 2:
+            start = struct.unpack_from("<I", record, 2)[0] * SECTOR
+            data_size = struct.unpack_from("<I", record, 10)[0]
+            name = record[33 : 33 + record[32]].decode(encoding)
+            files[name] = iso[start : start + data_size]
+        offset += length
+    return files
+
+
+def test_layout():
+    iso = build_iso(SEED, timestamp=0)
+    assert len(iso) % SECTOR == 0
+    assert iso[16 * SECTOR : 16 * SECTOR + 6] == b"\x01CD001"
+    assert iso[17 * SECTOR : 17 * SECTOR + 6] == b"\x02CD001"
+    assert iso[18 * SECTOR : 18 * SECTOR + 6] == b"\xffCD001"
+    # cloud-init finds the seed by its volume label
+    assert iso[16 * SECTOR + 40 : 16 * SECTOR + 72].rstrip() == b"cidata"
+    total = struct.unpack_from("<I", iso, 16 * SECTOR + 80)[0]
+    assert total * SECTOR == len(iso)
+
+
+def test_files():
+    iso = build_iso(SEED, timestamp=0)
+    assert read_dir(iso, 17, "utf-16-be") == {f"{n};1": c for n, c in SEED.items()}
+    assert read_dir(iso, 16, "ascii") == {
+        "META_DAT.;1": SEED["meta-data"],
+        "NETWORK_.;1": SEED["network-config"],
+        "USER_DAT.;1": SEED["user-data"],
+    }
+
+
+def test_short_names_stay_unique():
+    iso = build_iso({"user-data-1": b"a", "user-data-2": b"b"}, timestamp=0)
+    assert read_dir(iso, 16, "ascii") == {"USER_DAT.;1": b"a", "USER_DA1.;1": b"b"}
+
+
+def test_reproducible():
+    assert build_iso(SEED, timestamp=0) == build_iso(SEED, timestamp=0)
+    assert build_iso(SEED, timestamp=0) != build_iso(SEED, timestamp=86400)
@@ -0,0 +1,56 @@
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from vmcreator.connection import pool
+from vmcreator.mac import MacAllocator
+
+HOST = """<node>
+  <cpu>
+    <nodes>1</nodes><sockets>1</sockets><cores>2</cores><threads>1</threads>
+    <active>2</active><mhz>2000</mhz><model>x86_64</model>
+  </cpu>
+  <memory>4194304</memory>
+  <domain type="test">
+    <name>other</name>
+    <memory>1048576</memory>
+    <os><type>hvm</type></os>
+    <devices>
+      <interface type="user"><mac address="{mac}"/></interface>
+    </devices>
+  </domain>
+</node>
+"""
+
+
+@pytest.fixture
+def uri(tmp_path):
+    xml = tmp_path / "host.xml"
+    xml.write_text(HOST.format(mac=MacAllocator.derive("web/oam/0")))
+    yield f"test://{xml}"
+    pool.close_all()
+
+
+def test_derive_is_stable():
+    mac = MacAllocator.derive("web/oam/0")
+    assert mac.startswith("52:54:00:") and len(mac) == 17
+    assert MacAllocator.derive("web/oam/0") == mac
+    assert MacAllocator.derive("web/oam/1") != mac
+    assert MacAllocator.derive("web/oam/0", 1) != mac
+
+
+def test_allocate_avoids_used_macs(uri):
+    macs = MacAllocator(uri=uri)
+    # web/oam/0 derives the mac "other" already has
+    assert macs.allocate("web", "oam", 0) == MacAllocator.derive("web/oam/0", 1)
+    assert macs.allocate("web", "oam", 1) == MacAllocator.derive("web/oam/1")
+    assert macs.lookup("web", "oam", 1) == MacAllocator.derive("web/oam/1")
+    assert macs.lookup("db", "oam", 0) is None
+
+
+def test_allocations_are_kept(uri):
+    macs = MacAllocator({"web/oam/0": "52:54:00:aa:bb:cc"}, uri=uri)
+    assert macs.allocate("web", "oam", 0) == "52:54:00:aa:bb:cc"
+    macs.claim("db", "oam", 0, "52:54:00:AA:BB:DD")
+    macs.release("web")
+    assert macs.get_allocations() == {"db/oam/0": "52:54:00:aa:bb:dd"}
@@ -0,0 +1,59 @@
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from vmcreator.connection import pool
+from vmcreator.network import VirtNetwork
+
+HOST = """<node>
+  <cpu>
+    <nodes>1</nodes><sockets>1</sockets><cores>2</cores><threads>1</threads>
+    <active>2</active><mhz>2000</mhz><model>x86_64</model>
+  </cpu>
+  <memory>4194304</memory>
+  <network>
+    <name>oam</name>
+    <bridge name="virbr9"/>
+    <forward mode="nat"/>
+    <ip address="10.0.0.1" netmask="255.255.255.0">
+      <dhcp>
+        <range start="10.0.0.100" end="10.0.0.200"/>
+        <host mac="52:54:00:00:00:01" name="a" ip="10.0.0.10"/>
+        <host mac="52:54:00:00:00:02" name="other" ip="10.0.0.11"/>
+        <host mac="52:54:00:00:00:03" name="b-old" ip="10.0.0.12"/>
+      </dhcp>
+    </ip>
+  </network>
+</node>
+"""
+
+
+@pytest.fixture
+def uri(tmp_path):
+    xml = tmp_path / "host.xml"
+    xml.write_text(HOST)
+    yield f"test://{xml}"
+    pool.close_all()
+
+
+def names(uri: str) -> list:
+    # read again from libvirt, not from the cached reservation table
+    return sorted(h["name"] for h in VirtNetwork.from_name("oam", uri).get_leases())
+
+
+def test_delete_leases_of_the_vm(uri):
+    VirtNetwork.from_name("oam", uri).delete_leases([{"name": "a", "ip": "10.0.0.10"}])
+    assert names(uri) == ["b-old", "other"]
+
+
+def test_delete_leases_keeps_foreign_reservation(uri):
+    # a stale or made up address of "a" is held by another vm
+    VirtNetwork.from_name("oam", uri).delete_leases([{"name": "a", "ip": "10.0.0.11"}])
+    assert names(uri) == ["a", "b-old", "other"]
+
+
+def test_delete_leases_by_allocated_mac(uri):
+    # renamed in the reservation, still the mac allocated to the vm
+    ports = [{"name": "b", "ip": "10.0.0.12", "mac": "52:54:00:00:00:03"}]
+    VirtNetwork.from_name("oam", uri).delete_leases(ports)
+    assert names(uri) == ["a", "other"]
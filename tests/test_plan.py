@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from vmcreator.plan import Plan
+
+
+def recorder(log: list, name: str, fail: bool = False, delay: float = 0):
+    def step():
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError(f"{name} broke")
+        log.append(name)
+
+    return step
+
+
+def make_plan(log: list, fail=()) -> Plan:
+    # network <- volume <- domain, per vm, the network is shared
+    plan = Plan()
+    for vm in ("a", "b"):
+        net = plan.add(
+            "network",
+            "oam",
+            create=recorder(log, "oam"),
+            destroy=recorder(log, "-oam"),
+        )
+        vol = plan.add(
+            "volume",
+            f"{vm}-root",
+            create=recorder(log, f"{vm}-root", fail=f"{vm}-root" in fail),
+            destroy=recorder(log, f"-{vm}-root"),
+            vm=vm,
+        )
+        plan.add(
+            "domain",
+            vm,
+            create=recorder(log, vm),
+            destroy=recorder(log, f"-{vm}"),
+            deps=[net, vol],
+            vm=vm,
+        )
+    return plan
+
+
+def test_resources_are_shared():
+    plan = make_plan([])
+    assert len(plan) == 5
+    assert plan.get("domain", "a").deps == {("network", "oam"), ("volume", "a-root")}
+
+
+def test_topological_order():
+    order = [r.label() for r in make_plan([]).topological_order()]
+    for dep, resource in (
+        ("network:oam", "domain:a"),
+        ("volume:a-root", "domain:a"),
+        ("network:oam", "domain:b"),
+        ("volume:b-root", "domain:b"),
+    ):
+        assert order.index(dep) < order.index(resource)
+
+
+def test_cycle():
+    plan = Plan()
+    a = plan.add("x", "a")
+    b = plan.add("x", "b", deps=[a])
+    plan.add("x", "a", deps=[b])
+    with pytest.raises(ValueError) as e:
+        plan.apply()
+    assert "dependency cycle" in str(e.value)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_apply_and_destroy_order(workers):
+    log = []
+    plan = make_plan(log)
+    results = plan.apply(workers=workers)
+    assert all(r.ok for r in results)
+    assert sorted(log) == ["a", "a-root", "b", "b-root", "oam"]
+    for dep, resource in (("oam", "a"), ("a-root", "a"), ("b-root", "b")):
+        assert log.index(dep) < log.index(resource)
+
+    log.clear()
+    plan.destroy(workers=workers)
+    assert log.index("-a") < log.index("-a-root")
+    assert log.index("-a") < log.index("-oam")
+    assert log.index("-b") < log.index("-oam")
+
+
+def test_failure_skips_dependents_only():
+    log = []
+    plan = make_plan(log, fail={"a-root"})
+    results = {r.name: r for r in plan.apply(workers=2)}
+    assert not results["volume:a-root"].ok
+    assert results["volume:a-root"].error == "a-root broke"
+    assert not results["domain:a"].ok
+    assert results["domain:a"].error == "volume:a-root failed"
+    assert "a" not in log
+    assert results["domain:b"].ok
+
+    by_vm = {r.name: r for r in plan.summarize_by_vm(list(results.values()))}
+    assert not by_vm["a"].ok
+    assert by_vm["b"].ok and by_vm["shared"].ok
+
+
+def test_workers_per_host():
+    running = {"hv1": 0, "hv2": 0}
+    peak = {"hv1": 0, "hv2": 0}
+    lock = threading.Lock()
+
+    def step(host):
+        def run():
+            with lock:
+                running[host] += 1
+                peak[host] = max(peak[host], running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+
+        return run
+
+    plan = Plan()
+    for i in range(6):
+        for host in ("hv1", "hv2"):
+            plan.add("volume", f"{host}-{i}", create=step(host), host=host)
+    plan.apply(workers=2)
+    assert all(1 <= n <= 2 for n in peak.values())
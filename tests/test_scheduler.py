@@ -0,0 +1,205 @@
+import pytest
+
+from vmcreator.config import compile_config
+
+# the rest talks to libvirt test driver hosts
+libvirt = pytest.importorskip("libvirt")
+
+from vmcreator.connection import pool
+from vmcreator.planner import plan_from_config
+from vmcreator.scheduler import (
+    HostState,
+    SchedulingError,
+    get_hosts,
+    locate,
+    schedule,
+)
+
+GiB = 1024**3
+
+# a test driver host: every test:///path/to/host.xml uri is its own
+# in-memory libvirt host
+HOST = """<node>
+  <cpu>
+    <nodes>1</nodes><sockets>1</sockets><cores>8</cores><threads>1</threads>
+    <active>8</active><mhz>2000</mhz><model>x86_64</model>
+  </cpu>
+  <memory>{memory}</memory>
+  <pool type="dir">
+    <name>vms</name>
+    <target><path>{path}</path></target>
+  </pool>
+</node>
+"""
+
+DOMAIN = """<domain type="test">
+  <name>{name}</name>
+  <memory>1048576</memory>
+  <vcpu>1</vcpu>
+  <os><type>hvm</type></os>
+</domain>
+"""
+
+SERVICE = {
+    "cpu": 1,
+    "ram": {"size": 1024},
+    "image": "base.qcow2",
+    "users": [],
+    "volumes": [{"type": "root", "size": "10G"}],
+    "networks": [{"name": "oam"}],
+}
+
+
+@pytest.fixture
+def uris(tmp_path):
+    hosts = {}
+    for name in ("hv1", "hv2", "hv3"):
+        (tmp_path / name).mkdir()
+        xml = tmp_path / f"{name}.xml"
+        xml.write_text(HOST.format(memory=16 * 1024 * 1024, path=tmp_path / name))
+        hosts[name] = f"test://{xml}"
+    yield hosts
+    pool.close_all()
+
+
+def make_config(uris: dict, services: dict):
+    return compile_config(
+        {
+            "libvirt": {"vm-pool": "vms", "iso-pool": "vms"},
+            "hosts": {name: {"uri": uri} for name, uri in uris.items()},
+            "networks": {
+                "oam": {
+                    "ipCidr": "10.0.0.1/24",
+                    "mode": "nat",
+                    "dhcp": {"enabled": False},
+                }
+            },
+            "services": {
+                name: dict(SERVICE, **extra) for name, extra in services.items()
+            },
+        }
+    )
+
+
+def host_states(uris: dict, ram: dict = None) -> dict:
+    # the free memory the test driver reports differs between libvirt
+    # versions, the capacity is set by hand
+    states = {}
+    for name, uri in uris.items():
+        host = HostState(name, uri, vm_pool="vms")
+        host.ram = (ram or {}).get(name, 8 * GiB)
+        host.vcpu = 8
+        host.disk = None
+        states[name] = host
+    return states
+
+
+def define(uri: str, name: str):
+    pool.acquire(uri).defineXML(DOMAIN.format(name=name))
+
+
+def test_get_hosts(uris):
+    assert get_hosts(make_config(uris, {"a": {}})) == uris
+
+
+def test_best_fit_decreasing(uris):
+    config = make_config(
+        uris,
+        {
+            "small": {"ram": {"size": 1024}},
+            "big": {"ram": {"size": 6 * 1024}},
+            "mid": {"ram": {"size": 3 * 1024}},
+        },
+    )
+    ram = {"hv1": 4 * GiB, "hv2": 8 * GiB, "hv3": int(2.5 * GiB)}
+    placement = schedule(config, host_states(uris, ram))
+    # big only fits hv2, mid leaves least on hv1, small then fills hv1
+    assert placement == {"big": "hv2", "mid": "hv1", "small": "hv1"}
+
+
+def test_affinity_keeps_group_together(uris):
+    config = make_config(
+        uris,
+        {
+            "web": {"affinity": "front"},
+            "proxy": {"affinity": "front"},
+            "cache": {"affinity": "front"},
+        },
+    )
+    placement = schedule(config, host_states(uris))
+    assert len(set(placement.values())) == 1
+
+
+def test_anti_affinity_spreads_group(uris):
+    config = make_config(uris, {f"db-{i}": {"anti_affinity": "db"} for i in range(3)})
+    placement = schedule(config, host_states(uris))
+    assert sorted(placement.values()) == ["hv1", "hv2", "hv3"]
+
+
+def test_anti_affinity_without_host_left(uris):
+    config = make_config(uris, {f"db-{i}": {"anti_affinity": "db"} for i in range(4)})
+    with pytest.raises(SchedulingError) as e:
+        schedule(config, host_states(uris))
+    assert "leaves no host" in str(e.value)
+
+
+def test_anti_affinity_inside_affinity_group(uris):
+    config = make_config(
+        uris,
+        {
+            "a": {"affinity": "pair", "anti_affinity": "db"},
+            "b": {"affinity": "pair", "anti_affinity": "db"},
+        },
+    )
+    with pytest.raises(SchedulingError):
+        schedule(config, host_states(uris))
+
+
+def test_host_pin(uris):
+    config = make_config(uris, {"build": {"host": "hv3"}, "other": {}})
+    ram = {"hv1": 8 * GiB, "hv2": 8 * GiB, "hv3": 2 * GiB}
+    assert schedule(config, host_states(uris, ram))["build"] == "hv3"
+
+
+def test_pin_without_room(uris):
+    config = make_config(uris, {"build": {"host": "hv3", "ram": {"size": 4096}}})
+    with pytest.raises(SchedulingError) as e:
+        schedule(config, host_states(uris, {"hv3": 2 * GiB}))
+    assert "hv3:" in str(e.value)
+
+
+def test_existing_domain_stays(uris):
+    define(uris["hv2"], "web")
+    config = make_config(uris, {"web": {"ram": {"size": 4096}}})
+    states = host_states(uris, {"hv1": 8 * GiB, "hv2": 1 * GiB, "hv3": 8 * GiB})
+    assert "web" in states["hv2"].domains
+    # it already runs there, so it takes nothing from hv2
+    assert schedule(config, states) == {"web": "hv2"}
+
+
+def test_sticky_placement_wins(uris):
+    config = make_config(uris, {"web": {}, "new": {"anti_affinity": "x"}})
+    placement = schedule(config, host_states(uris), sticky={"web": "hv3"})
+    assert placement["web"] == "hv3"
+
+
+def test_locate(uris):
+    define(uris["hv3"], "found")
+    config = make_config(uris, {"found": {}, "stated": {}, "nowhere": {}})
+    placement = locate(config, uris, sticky={"stated": "hv1", "gone": "hv2"})
+    assert placement == {"found": "hv3", "stated": "hv1"}
+
+
+def test_plan_per_host(uris):
+    config = make_config(uris, {"a": {}, "b": {}, "c": {}})
+    placement = {"a": "hv1", "b": "hv2", "c": "hv2"}
+    plan = plan_from_config(config, placement=placement)
+    domains = {r.name: r for r in plan.resources() if r.kind == "domain"}
+    assert {vm: r.host for vm, r in domains.items()} == placement
+    assert domains["a"].obj.get_uri() == uris["hv1"]
+    # shared resources are planned once per host they are needed on
+    networks = sorted(r.name for r in plan.resources() if r.kind == "network")
+    assert networks == ["hv1:oam", "hv2:oam"]
+    for resource in plan.resources():
+        if resource.kind == "volume":
+            assert resource.obj.get_uri() == uris[placement[resource.vm]]
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import subprocess
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from vmcreator.tracing import tracer
+
+
+class AsyncRunner:
+    # libvirt calls are blocking, they run in a bounded thread pool. the
+    # semaphores bound what is in flight per event loop, so a caller can
+    # gather hundreds of operations and they simply queue (back-pressure)
+    # instead of piling up threads or child processes
+    def __init__(self, max_workers: int = 8, max_processes: int = 4):
+        self._max_workers = max_workers
+        self._max_processes = max_processes
+        self._executor = None
+        self._limits = weakref.WeakKeyDictionary()
+
+    def configure(self, max_workers: int = None, max_processes: int = None):
+        if max_workers:
+            self._max_workers = max_workers
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        if max_processes:
+            self._max_processes = max_processes
+        self._limits = weakref.WeakKeyDictionary()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self._max_workers, thread_name_prefix="vmcreator-aio"
+            )
+        return self._executor
+
+    def _get_limits(self):
+        # asyncio primitives belong to one loop
+        loop = asyncio.get_running_loop()
+        if loop not in self._limits:
+            self._limits[loop] = (
+                asyncio.Semaphore(self._max_workers),
+                asyncio.Semaphore(self._max_processes),
+            )
+        return self._limits[loop]
+
+    async def call(self, func, *args, **kwargs):
+        calls, _ = self._get_limits()
+        async with calls:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), lambda: func(*args, **kwargs)
+            )
+
+    async def run_process(self, command: list) -> bytes:
+        _, processes = self._get_limits()
+        async with processes:
+            start = tracer.now()
+            proc = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            out, err = await proc.communicate()
+            tracer.record(
+                f"exec {os.path.basename(command[0])}",
+                "subprocess",
+                start,
+                argv=" ".join(command),
+                returncode=proc.returncode,
+            )
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, command, out, err)
+        return out
+
+
+runner = AsyncRunner()
+
+
+class AsyncMixin:
+    # await resource.acreate() etc, the blocking method runs on the runner
+    async def acreate(self):
+        return await runner.call(self.create)
+
+    async def adelete(self, *args, **kwargs):
+        return await runner.call(self.delete, *args, **kwargs)
+
+    async def aexists(self) -> bool:
+        return await runner.call(self.exists)
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+from shutil import which
+from vmcreator.cache import DEFAULT_CACHE_DIR
+from vmcreator.config import LayerConfig
+from vmcreator.connection import DEFAULT_URI, host_key
+from vmcreator.storage import Storage, StorageNotFoundException, FILE_POOL_TYPES
+from vmcreator.tracing import check_call
+
+
+class BackingChainRegistry:
+    # which overlays sit on top of which golden layer, so a layer is only
+    # removed once nothing depends on it anymore
+    def __init__(self, path: str = None):
+        self._path = path or os.path.join(DEFAULT_CACHE_DIR, "layers.json")
+        self._lock = threading.Lock()
+        self._layers = None
+
+    def _load(self) -> dict:
+        if self._layers is None:
+            try:
+                with open(self._path) as f:
+                    self._layers = json.load(f)
+            except (OSError, ValueError):
+                self._layers = {}
+        return self._layers
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp = f"{self._path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as f:
+            json.dump(self._layers, f, indent=2, sort_keys=True)
+        os.replace(tmp, self._path)
+
+    def acquire(self, layer: str, overlay: str):
+        with self._lock:
+            overlays = self._load().setdefault(layer, [])
+            if overlay not in overlays:
+                overlays.append(overlay)
+                self._save()
+
+    def release(self, overlay: str):
+        with self._lock:
+            changed = False
+            for overlays in self._load().values():
+                if overlay in overlays:
+                    overlays.remove(overlay)
+                    changed = True
+            if changed:
+                self._save()
+
+    def dependents(self, layer: str) -> list:
+        with self._lock:
+            return list(self._load().get(layer, []))
+
+    def refcount(self, layer: str) -> int:
+        return len(self.dependents(layer))
+
+    def forget(self, layer: str):
+        with self._lock:
+            if self._load().pop(layer, None) is not None:
+                self._save()
+
+
+backing_registry = BackingChainRegistry()
+
+
+class GoldenLayer(Storage):
+    # a versioned qcow2 overlay on a base image with packages/commands baked
+    # in (virt-customize), stored next to the base image and shared by the
+    # root disks of every service that uses it
+    def __init__(
+        self,
+        name: str,
+        image: str,
+        image_pool: str = "default",
+        version=1,
+        packages: list = None,
+        commands: list = None,
+        volume_backend: str = "libvirt",
+        debug: bool = False,
+        uri: str = DEFAULT_URI,
+    ):
+        super(GoldenLayer, self).__init__(name, image_pool, debug=debug, uri=uri)
+        self._name = name
+        self._image = image
+        self._version = version
+        self._packages = packages or []
+        self._commands = commands or []
+        self._volume_backend = volume_backend
+        self._size = None
+
+    @classmethod
+    def from_config(cls, config: LayerConfig, image_pool: str, **kwargs):
+        return cls(
+            config.name,
+            config.image,
+            image_pool=image_pool,
+            version=config.version,
+            packages=config.packages,
+            commands=config.commands,
+            **kwargs,
+        )
+
+    def get_digest(self) -> str:
+        recipe = json.dumps(
+            [self._image, self._version, self._packages, self._commands]
+        )
+        return hashlib.sha256(recipe.encode()).hexdigest()[:8]
+
+    def get_volume_name(self) -> str:
+        return f"{self._name}-v{self._version}-{self.get_digest()}.qcow2"
+
+    def get_registry_key(self) -> str:
+        return host_key(self.get_uri(), self.get_volume_name())
+
+    def get_base_volume(self):
+        vol = self.get_pool_manager().lookup(self._image)
+        if vol is None:
+            raise StorageNotFoundException(
+                f"base image {self._image} not found in {self._storage_pool_name}"
+            )
+        return vol
+
+    def create(self):
+        if self.exists():
+            print(f"golden layer {self.get_volume_name()} already built.")
+            return
+        if self.get_pool_type() not in FILE_POOL_TYPES:
+            raise RuntimeError(
+                f"golden layers need a file based pool, {self._storage_pool_name} is {self.get_pool_type()}"
+            )
+
+        print(f"building golden layer {self.get_volume_name()} on {self._image}...")
+        base = self.get_base_volume()
+        self._size = base.info()[1]
+        self.create_qcow2(base.path())
+        try:
+            self.__bake()
+        except BaseException:
+            # never leave a half baked layer behind, it would be reused
+            self.delete()
+            raise
+        print(f"golden layer {self.get_volume_name()} successfully built.")
+
+    def __bake(self):
+        if not self._packages and not self._commands:
+            return
+        if not which("virt-customize"):
+            raise RuntimeError("virt-customize (libguestfs) is needed to bake layers")
+        command = ["virt-customize", "-a", self.get_disk().path()]
+        if self._packages:
+            command += ["--install", ",".join(self._packages)]
+        for cmd in self._commands:
+            command += ["--run-command", cmd]
+        # let cloud-init run again on the overlays
+        command += ["--run-command", "cloud-init clean || true"]
+        check_call(command)
+
+    def delete(self):
+        super(GoldenLayer, self).delete()
+        backing_registry.forget(self.get_registry_key())
+
+    def refcount(self) -> int:
+        return backing_registry.refcount(self.get_registry_key())
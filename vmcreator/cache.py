@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from shutil import copyfile
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "VMCREATOR_CACHE_DIR",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "vmcreator"
+    ),
+)
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+def digest_files(files: dict) -> str:
+    # files: {name: bytes}, the digest covers names and content
+    h = hashlib.sha256()
+    for name in sorted(files):
+        h.update(name.encode())
+        h.update(b"\0")
+        h.update(len(files[name]).to_bytes(8, "big"))
+        h.update(files[name])
+    return h.hexdigest()
+
+
+class IsoCache:
+    def __init__(
+        self,
+        cache_dir: str = None,
+        max_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self._dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, "cloudinit")
+        self._max_size = max_size
+        self._index_path = os.path.join(self._dir, "index.json")
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _load(self) -> dict:
+        if self._index is None:
+            try:
+                with open(self._index_path) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+            self._index.setdefault("entries", {})
+            self._index.setdefault("placements", {})
+        return self._index
+
+    def _save(self):
+        os.makedirs(self._dir, exist_ok=True)
+        tmp = f"{self._index_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp, self._index_path)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self._dir, f"{key}.iso")
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            entry = self._load()["entries"].get(key)
+            if entry is None or not os.path.exists(self.path(key)):
+                return None
+            entry["last_used"] = time.time()
+            self._save()
+            return self.path(key)
+
+    def put(self, key: str, src: str) -> str:
+        return self._store(key, lambda tmp: copyfile(src, tmp))
+
+    def put_data(self, key: str, data: bytes) -> str:
+        # an iso built in memory
+        def write(tmp):
+            with open(tmp, "wb") as f:
+                f.write(data)
+
+        return self._store(key, write)
+
+    def _store(self, key: str, write) -> str:
+        with self._lock:
+            os.makedirs(self._dir, exist_ok=True)
+            tmp = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}"
+            write(tmp)
+            os.replace(tmp, self.path(key))
+            self._load()["entries"][key] = {
+                "size": os.path.getsize(self.path(key)),
+                "last_used": time.time(),
+            }
+            self._evict()
+            self._save()
+            return self.path(key)
+
+    def _evict(self):
+        entries = self._index["entries"]
+        total = sum(e["size"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self._max_size:
+                break
+            total -= entries.pop(key)["size"]
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def placed(self, dest: str, stamp: str = None) -> str:
+        # key of the iso last uploaded to dest, if dest was not touched since.
+        # stamp: the volume's mtime as libvirt reports it
+        with self._lock:
+            placement = self._load()["placements"].get(dest)
+        if not placement or placement.get("stamp") != stamp:
+            return None
+        return placement["key"]
+
+    def record_placement(self, dest: str, key: str, stamp: str = None):
+        with self._lock:
+            self._load()["placements"][dest] = {"key": key, "stamp": stamp}
+            self._save()
+
+    def forget_placement(self, dest: str):
+        with self._lock:
+            if self._load()["placements"].pop(dest, None):
+                self._save()
+
+
+iso_cache = IsoCache()
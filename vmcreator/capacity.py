@@ -0,0 +1,188 @@
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect
+from vmcreator.plan import Plan
+from vmcreator.scheduler import available_memory
+from vmcreator.storage import (
+    Storage,
+    Cloudinit,
+    StorageNotFoundException,
+)
+from vmcreator.backing import GoldenLayer
+from vmcreator.topology import get_topology
+from vmcreator.units import parse_size
+from libvirt import VIR_CONNECT_LIST_DOMAINS_ACTIVE
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+# what a fresh thin qcow2 / cloud-init iso takes in the pool right away
+QCOW2_INITIAL = MiB
+ISO_INITIAL = MiB
+
+
+def _gib(size: int) -> str:
+    return f"{size / GiB:.1f}G"
+
+
+class CapacityReport:
+    def __init__(self, host: str = None):
+        self.host = host
+        self.lines = []
+        self.errors = []
+
+    def ok(self) -> bool:
+        return not self.errors
+
+    def show(self):
+        print(f"capacity ({self.host}):" if self.host else "capacity:")
+        for line in self.lines:
+            print(f"  {line}")
+        for error in self.errors:
+            print(f"  !! {error}")
+
+
+class CapacityPlanner(LibvirtConnect):
+    # admission check for a plan: what the vms/volumes it would create need
+    # against what the host has left. ram is never overcommitted, vcpus up
+    # to cpu_overcommit x host cpus, and qcow2 volumes are thin: they only
+    # need a little space now but may grow to their virtual size, which may
+    # not exceed disk_overcommit x free space. volumes already in the pool
+    # are not counted, their growth is what the overcommit is about
+    def __init__(
+        self,
+        cpu_overcommit: float = 4.0,
+        disk_overcommit: float = 1.0,
+        uri: str = DEFAULT_URI,
+    ):
+        super(CapacityPlanner, self).__init__(uri)
+        self._cpu_overcommit = cpu_overcommit
+        self._disk_overcommit = disk_overcommit
+
+    def check(self, plan: Plan, host: str = None) -> CapacityReport:
+        # only what the plan puts on this planner's host
+        report = CapacityReport(host)
+        resources = [
+            r
+            for r in plan.resources()
+            if r.kind in ("domain", "volume", "cloudinit", "layer")
+            and r.obj.get_uri() == self.get_uri()
+        ]
+        instances = [
+            r.obj for r in resources if r.kind == "domain" and not r.obj.exists()
+        ]
+        storages = [
+            r.obj
+            for r in resources
+            if r.kind in ("volume", "cloudinit", "layer") and not r.obj.exists()
+        ]
+        self.__check_cpu(instances, report)
+        self.__check_memory(instances, report)
+        self.__check_numa(instances, report)
+        self.__check_pools(storages, report)
+        return report
+
+    def __check_cpu(self, instances: list, report: CapacityReport):
+        conn = self.get_connection()
+        host_cpus = conn.getInfo()[2]
+        running = sum(
+            dom.info()[3] for dom in conn.listAllDomains(VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        )
+        wanted = sum(i.get_vcpu() for i in instances)
+        limit = host_cpus * self._cpu_overcommit
+        report.lines.append(
+            f"vcpu: {wanted} new + {running} running of {host_cpus} host cpus"
+            f" ({(wanted + running) / host_cpus:.2f}x, limit {self._cpu_overcommit}x)"
+        )
+        if wanted + running > limit:
+            report.errors.append(
+                f"vcpu overcommit {(wanted + running) / host_cpus:.2f}x exceeds {self._cpu_overcommit}x"
+            )
+        for i in instances:
+            if i.get_vcpu() > host_cpus:
+                report.errors.append(
+                    f"{i.get_name()}: {i.get_vcpu()} vcpus, host only has {host_cpus}"
+                )
+
+    def __check_memory(self, instances: list, report: CapacityReport):
+        free = available_memory(self.get_connection())
+        wanted = sum(i.get_ram() for i in instances) * MiB
+        report.lines.append(f"ram: {_gib(wanted)} needed of {_gib(free)} available")
+        if wanted > free:
+            report.errors.append(
+                f"ram: needs {_gib(wanted)}, only {_gib(free)} available"
+            )
+
+    def __check_numa(self, instances: list, report: CapacityReport):
+        bound = [i for i in instances if i.get_tuning().numa is not None]
+        if not bound:
+            return
+        topology = get_topology(self.get_uri())
+        cells = topology.get_cells()
+        if not cells:
+            report.errors.append("numa placement requested, host reports no numa cells")
+            return
+        ids = sorted(cells)
+        free = dict(
+            zip(ids, self.get_connection().getCellsFreeMemory(ids[0], len(ids)))
+        )
+        left = dict(free)
+        placement = {cell: [] for cell in ids}
+        # pinned vms first, auto placement fills around them the same way
+        # HostTopology.place() will
+        for i in sorted(bound, key=lambda i: i.get_tuning().numa == "auto"):
+            cell = i.get_tuning().numa
+            if cell == "auto":
+                cell = max(left, key=lambda c: left[c])
+            if cell not in left:
+                report.errors.append(f"{i.get_name()}: host has no numa node {cell}")
+                continue
+            left[cell] -= i.get_ram() * MiB
+            placement[cell].append(i.get_name())
+        for cell in ids:
+            report.lines.append(
+                f"numa node {cell}: {_gib(free[cell] - left[cell])} needed of {_gib(free[cell])} free"
+                f" <- {', '.join(placement[cell]) or '-'}"
+            )
+            if left[cell] < 0:
+                report.errors.append(
+                    f"numa node {cell}: {', '.join(placement[cell])} need {_gib(free[cell] - left[cell])}, only {_gib(free[cell])} free"
+                )
+
+    @staticmethod
+    def _virtual_size(storage: Storage) -> int:
+        if isinstance(storage, Cloudinit):
+            return ISO_INITIAL
+        if isinstance(storage, GoldenLayer):
+            return storage.get_base_volume().info()[1]
+        return parse_size(storage.get_size())
+
+    def __check_pools(self, storages: list, report: CapacityReport):
+        by_pool = {}
+        for storage in storages:
+            by_pool.setdefault(storage.get_pool_manager(), []).append(storage)
+
+        for manager, pool_storages in by_pool.items():
+            pool = manager.get_pool()
+            _, capacity, allocation, available = pool.info()
+            initial = sum(
+                ISO_INITIAL if isinstance(s, Cloudinit) else QCOW2_INITIAL
+                for s in pool_storages
+            )
+            virtual = 0
+            for s in pool_storages:
+                try:
+                    virtual += self._virtual_size(s)
+                except StorageNotFoundException as e:
+                    report.errors.append(f"{s.get_volume_name()}: {e}")
+            ratio = virtual / available if available else float("inf")
+            report.lines.append(
+                f"pool {pool.name()}: {len(pool_storages)} volumes, {_gib(virtual)} virtual"
+                f" on {_gib(available)} free of {_gib(capacity)}"
+                f" ({ratio:.2f}x, limit {self._disk_overcommit}x)"
+            )
+            if initial > available:
+                report.errors.append(
+                    f"pool {pool.name()}: not even room for the new volumes ({_gib(available)} free)"
+                )
+            elif ratio > self._disk_overcommit:
+                report.errors.append(
+                    f"pool {pool.name()}: thin overcommit {ratio:.2f}x exceeds {self._disk_overcommit}x"
+                )
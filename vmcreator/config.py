@@ -0,0 +1,624 @@
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import threading
+from collections.abc import Mapping
+from functools import lru_cache
+import yaml
+from vmcreator.cache import DEFAULT_CACHE_DIR
+from vmcreator.templates import PROFILES
+from vmcreator.tuning import Tuning
+from vmcreator.units import parse_size
+
+# libyaml when pyyaml was built with it, several times faster on big configs
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+NETWORK_MODES = ("route", "nat", "isolated")
+CACHE_ENTRIES = 32
+# {i} or {i:02d} in the name, fqdn and ipAddr of a replica set
+REPLICA_INDEX = re.compile(r"\{i(?::([^}]*))?\}")
+
+
+class ConfigError(Exception):
+    def __init__(self, errors: list):
+        super(ConfigError, self).__init__("; ".join(errors))
+        self.errors = errors
+
+
+class Model:
+    # plain records compiled from the yaml, compared and copied by slots
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return type(self)(**values)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"{type(self).__name__}({getattr(self, self.__slots__[0])!r})"
+
+
+class LibvirtConfig(Model):
+    __slots__ = ("vm_pool", "iso_pool", "uri")
+
+
+class HostConfig(Model):
+    __slots__ = ("name", "uri")
+
+
+class NetworkConfig(Model):
+    __slots__ = (
+        "name",
+        "external",
+        "ipcidr",
+        "mode",
+        "dhcp",
+        "dhcp_start",
+        "dhcp_end",
+        "domain",
+    )
+
+
+class LayerConfig(Model):
+    __slots__ = ("name", "image", "version", "packages", "commands")
+
+
+class VolumeConfig(Model):
+    __slots__ = ("type", "size")
+
+
+def nic_key(vm: str, network: str, index: int = 0) -> str:
+    return f"{vm}/{network}/{index}"
+
+
+class NicConfig(Model):
+    # index: nth nic of the vm on that network, keys its mac and ip
+    __slots__ = ("network", "ip", "index")
+
+
+class ServiceConfig(Model):
+    # raw: the service mapping as written, what the cloud-init iso is built from
+    __slots__ = (
+        "name",
+        "fqdn",
+        "cpu",
+        "ram",
+        "shared_ram",
+        "image",
+        "layer",
+        "profile",
+        "tuning",
+        "volumes",
+        "networks",
+        "host",
+        "affinity",
+        "anti_affinity",
+        "raw",
+    )
+
+
+def render(template: str, i: int) -> str:
+    return REPLICA_INDEX.sub(lambda m: format(i, m.group(1) or ""), template)
+
+
+def replica_address(ip: str, i: int) -> str:
+    # 10.0.0.{i} is rendered, a plain address is the first of a block
+    if ip is None:
+        return None
+    if REPLICA_INDEX.search(ip):
+        return render(ip, i)
+    return str(ipaddress.ip_address(ip) + i - 1)
+
+
+@lru_cache(maxsize=None)
+def _name_pattern(template: str) -> re.Pattern:
+    parts = REPLICA_INDEX.split(template)
+    # split() also returns the format specs, every other part
+    return re.compile(r"(\d+)".join(re.escape(text) for text in parts[::2]))
+
+
+class ReplicaSet(Model):
+    # replicas: N of a service, worker-{i} is worker-1 .. worker-N. name is
+    # the template, template the service as written. replicas are built one
+    # at a time when asked for, never all of them up front
+    __slots__ = ("name", "count", "template")
+
+    def names(self):
+        for i in range(1, self.count + 1):
+            yield render(self.name, i)
+
+    def index_of(self, vm: str) -> int:
+        match = _name_pattern(self.name).fullmatch(vm)
+        if match is None:
+            return None
+        i = int(match.group(1))
+        if 1 <= i <= self.count and render(self.name, i) == vm:
+            return i
+        return None
+
+    def expand(self, i: int) -> ServiceConfig:
+        template = self.template
+        raw = dict(template.raw)
+        raw.pop("replicas", None)
+        fqdn = template.fqdn
+        if fqdn is not None:
+            fqdn = raw["fqdn"] = render(str(fqdn), i)
+        return template.replace(
+            name=render(self.name, i),
+            fqdn=fqdn,
+            networks=[
+                nic.replace(ip=replica_address(nic.ip, i)) for nic in template.networks
+            ],
+            raw=raw,
+        )
+
+
+class Services(Mapping):
+    # {vm: ServiceConfig} in file order, replica sets are expanded vm by vm
+    # as they are iterated or looked up. addresses filled in by ipam and
+    # subsets are kept as overlays, so neither copies the services
+    def __init__(self, entries: list, addresses: dict = None, only: list = None):
+        self._entries = entries
+        self._singles = {e.name: e for e in entries if isinstance(e, ServiceConfig)}
+        self._sets = [e for e in entries if isinstance(e, ReplicaSet)]
+        self._addresses = addresses or {}
+        self._only = only
+
+    def _find(self, vm: str):
+        if self._only is not None and vm not in self._only:
+            return None
+        service = self._singles.get(vm)
+        if service is not None:
+            return service
+        for replicas in self._sets:
+            i = replicas.index_of(vm)
+            if i is not None:
+                return replicas, i
+        return None
+
+    def __getitem__(self, vm: str) -> ServiceConfig:
+        found = self._find(vm)
+        if found is None:
+            raise KeyError(vm)
+        service = found[0].expand(found[1]) if isinstance(found, tuple) else found
+        addresses = self._addresses.get(vm)
+        if addresses:
+            nics = list(service.networks)
+            for position, ip in addresses.items():
+                nics[position] = nics[position].replace(ip=ip)
+            service = service.replace(networks=nics)
+        return service
+
+    def __contains__(self, vm) -> bool:
+        return isinstance(vm, str) and self._find(vm) is not None
+
+    def __iter__(self):
+        if self._only is not None:
+            yield from (vm for vm in self._only if vm in self)
+            return
+        for entry in self._entries:
+            if isinstance(entry, ReplicaSet):
+                yield from entry.names()
+            else:
+                yield entry.name
+
+    def __len__(self) -> int:
+        if self._only is not None:
+            return sum(1 for _ in self)
+        return sum(e.count if isinstance(e, ReplicaSet) else 1 for e in self._entries)
+
+    def subset(self, vms: list) -> "Services":
+        return Services(self._entries, self._addresses, list(vms))
+
+    def with_addresses(self, addresses: dict) -> "Services":
+        merged = {vm: dict(ips) for vm, ips in self._addresses.items()}
+        for (vm, position), ip in addresses.items():
+            merged.setdefault(vm, {})[position] = ip
+        return Services(self._entries, merged, self._only)
+
+
+class Config(Model):
+    # data: the whole file as loaded, written to the state file
+    __slots__ = ("libvirt", "hosts", "networks", "layers", "services", "data")
+
+    def subset(self, services: list) -> "Config":
+        return self.replace(services=self.services.subset(services))
+
+    def with_addresses(self, addresses: dict) -> "Config":
+        # addresses: {(vm, nic position): ip}
+        return self.replace(services=self.services.with_addresses(addresses))
+
+
+class _Compiler:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, path: str, message: str):
+        self.errors.append(f"{path}: {message}")
+
+    def mapping(self, value, path: str, required: bool = True) -> dict:
+        if value is None and not required:
+            return {}
+        if not isinstance(value, dict):
+            self.error(path, "missing" if value is None else "must be a mapping")
+            return {}
+        return value
+
+    def sequence(self, value, path: str, required: bool = True) -> list:
+        if value is None and not required:
+            return []
+        if not isinstance(value, list):
+            self.error(path, "missing" if value is None else "must be a list")
+            return []
+        return value
+
+    def string(self, value, path: str, required: bool = True):
+        if value is None:
+            if required:
+                self.error(path, "missing")
+            return None
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            self.error(path, "must be a string")
+            return None
+        return str(value)
+
+    def number(self, value, path: str, required: bool = True):
+        if value is None and not required:
+            return None
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            self.error(
+                path, "missing" if value is None else "must be a positive number"
+            )
+            return None
+        return value
+
+    def flag(self, value, path: str, default: bool = False) -> bool:
+        if value is None:
+            return default
+        if not isinstance(value, bool):
+            self.error(path, "must be true or false")
+            return default
+        return value
+
+    def size(self, value, path: str, required: bool = True):
+        if value is None:
+            if required:
+                self.error(path, "missing")
+            return None
+        try:
+            parse_size(value)
+        except (ValueError, KeyError, IndexError):
+            self.error(path, f"not a size: {value}")
+            return None
+        return value
+
+    def address(self, value, path: str, network=None):
+        value = self.string(value, path, required=False)
+        if value is None:
+            return None
+        try:
+            ip = ipaddress.ip_address(value)
+        except ValueError:
+            self.error(path, f"not an ip address: {value}")
+            return None
+        if network is not None and ip not in network:
+            self.error(path, f"{value} is outside {network}")
+        return value
+
+    def compile(self, data) -> Config:
+        data = self.mapping(data, "config")
+        libvirt = self.mapping(data.get("libvirt"), "libvirt")
+        config = Config(
+            libvirt=LibvirtConfig(
+                vm_pool=self.string(libvirt.get("vm-pool"), "libvirt.vm-pool"),
+                iso_pool=self.string(libvirt.get("iso-pool"), "libvirt.iso-pool"),
+                uri=self.string(libvirt.get("uri"), "libvirt.uri", required=False),
+            ),
+            hosts={},
+            networks={},
+            layers={},
+            services=None,
+            data=data,
+        )
+        for name, host in self.mapping(data.get("hosts"), "hosts", False).items():
+            host = self.mapping(host, f"hosts.{name}")
+            config.hosts[name] = HostConfig(
+                name=name, uri=self.string(host.get("uri"), f"hosts.{name}.uri")
+            )
+        networks = self.mapping(data.get("networks"), "networks", False)
+        for name, network in networks.items():
+            config.networks[name] = self.network(name, network)
+        for name, layer in self.mapping(data.get("layers"), "layers", False).items():
+            layer = self.mapping(layer, f"layers.{name}")
+            config.layers[name] = LayerConfig(
+                name=name,
+                image=self.string(layer.get("image"), f"layers.{name}.image", False),
+                version=layer.get("version", 1),
+                packages=self.sequence(
+                    layer.get("packages"), f"layers.{name}.packages", False
+                ),
+                commands=self.sequence(
+                    layer.get("commands"), f"layers.{name}.commands", False
+                ),
+            )
+        services = self.mapping(data.get("services"), "services")
+        if not services and isinstance(data.get("services"), dict):
+            self.error("services", "no services defined")
+        entries = []
+        for name, service in services.items():
+            if isinstance(service, dict) and "replicas" in service:
+                entries.append(self.replica_set(name, service, config))
+            else:
+                entries.append(self.service(name, service, config))
+        config.services = Services(entries)
+        self.unique_names(entries)
+        return config
+
+    def replica_set(self, name: str, service: dict, config: Config) -> ReplicaSet:
+        path = f"services.{name}"
+        count = service.get("replicas")
+        # replicas: 0 scales a set down to nothing but keeps it in the file
+        if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+            self.error(f"{path}.replicas", "must be a number")
+            count = 0
+        template = name if REPLICA_INDEX.search(name) else f"{name}-{{i}}"
+        return ReplicaSet(
+            name=template,
+            count=count,
+            template=self.service(name, service, config, replicas=max(count, 1)),
+        )
+
+    def unique_names(self, entries: list):
+        # a replica set must not expand onto another service
+        seen = {}
+        for entry in entries:
+            names = entry.names() if isinstance(entry, ReplicaSet) else [entry.name]
+            for vm in names:
+                if vm in seen:
+                    self.error("services", f"{vm} from {entry.name} and {seen[vm]}")
+                    break
+                seen[vm] = entry.name
+
+    def network(self, name: str, network) -> NetworkConfig:
+        path = f"networks.{name}"
+        network = self.mapping(network, path)
+        external = self.flag(network.get("external"), f"{path}.external")
+        if external:
+            return NetworkConfig(name=name, external=True, dhcp=False)
+
+        ipcidr = self.string(network.get("ipCidr"), f"{path}.ipCidr")
+        subnet = None
+        if ipcidr is not None:
+            try:
+                subnet = ipaddress.ip_interface(ipcidr).network
+            except ValueError:
+                self.error(f"{path}.ipCidr", f"not an address/prefix: {ipcidr}")
+        mode = self.string(network.get("mode"), f"{path}.mode")
+        if mode is not None and mode.lower() not in NETWORK_MODES:
+            self.error(f"{path}.mode", f"one of {', '.join(NETWORK_MODES)}")
+        dhcp = self.mapping(network.get("dhcp"), f"{path}.dhcp")
+        enabled = self.flag(dhcp.get("enabled"), f"{path}.dhcp.enabled")
+        start = self.address(dhcp.get("start"), f"{path}.dhcp.start", subnet)
+        end = self.address(dhcp.get("end"), f"{path}.dhcp.end", subnet)
+        if enabled and (start is None or end is None):
+            self.error(f"{path}.dhcp", "enabled needs start and end")
+        return NetworkConfig(
+            name=name,
+            external=False,
+            ipcidr=ipcidr,
+            mode=mode.lower() if mode else None,
+            dhcp=enabled,
+            dhcp_start=start,
+            dhcp_end=end,
+            domain=self.string(network.get("domain"), f"{path}.domain", False) or name,
+        )
+
+    def replica_address(self, value, path: str, count: int, network=None):
+        # the first and the last replica's address have to be valid
+        value = self.string(value, path, required=False)
+        if value is None:
+            return None
+        try:
+            ends = [replica_address(value, 1), replica_address(value, count)]
+        except ValueError:
+            self.error(path, f"not an ip address: {value}")
+            return None
+        for ip in ends:
+            if self.address(ip, path, network) is None:
+                return None
+        return value
+
+    def service(
+        self, name: str, service, config: Config, replicas: int = None
+    ) -> ServiceConfig:
+        path = f"services.{name}"
+        service = self.mapping(service, path)
+        cpu = self.number(service.get("cpu"), f"{path}.cpu")
+        ram = self.mapping(service.get("ram"), f"{path}.ram")
+        ram_size = self.number(ram.get("size"), f"{path}.ram.size")
+
+        layer = self.string(service.get("layer"), f"{path}.layer", False)
+        if layer is not None and layer not in config.layers:
+            self.error(f"{path}.layer", f"unknown layer {layer}")
+        image = self.string(service.get("image"), f"{path}.image", False)
+        if image is None and not (
+            layer in config.layers and config.layers[layer].image
+        ):
+            self.error(f"{path}.image", "missing")
+
+        profile = self.string(service.get("profile"), f"{path}.profile", False)
+        if profile is not None and profile not in PROFILES:
+            self.error(f"{path}.profile", f"one of {', '.join(PROFILES)}")
+
+        tuning = self.mapping(service.get("tuning"), f"{path}.tuning", False)
+        try:
+            Tuning(tuning, cpu or 1)
+        except ValueError as e:
+            self.error(f"{path}.tuning", str(e))
+
+        volumes = []
+        raw_volumes = self.sequence(service.get("volumes"), f"{path}.volumes")
+        for i, volume in enumerate(raw_volumes):
+            volume = self.mapping(volume, f"{path}.volumes[{i}]")
+            kind = self.string(volume.get("type"), f"{path}.volumes[{i}].type")
+            volumes.append(
+                VolumeConfig(
+                    type=kind,
+                    size=self.size(volume.get("size"), f"{path}.volumes[{i}].size"),
+                )
+            )
+        if sum(1 for v in volumes if v.type == "root") > 1:
+            self.error(f"{path}.volumes", "only one root volume")
+
+        nics = []
+        index = {}
+        raw_nics = self.sequence(service.get("networks"), f"{path}.networks")
+        for i, nic in enumerate(raw_nics):
+            nic = self.mapping(nic, f"{path}.networks[{i}]")
+            network = self.string(nic.get("name"), f"{path}.networks[{i}].name")
+            if network is not None and network not in config.networks:
+                self.error(f"{path}.networks[{i}].name", f"unknown network {network}")
+            index[network] = index.get(network, -1) + 1
+            subnet = None
+            if network in config.networks and config.networks[network].ipcidr:
+                try:
+                    subnet = ipaddress.ip_interface(
+                        config.networks[network].ipcidr
+                    ).network
+                except ValueError:
+                    pass
+            ip_path = f"{path}.networks[{i}].ipAddr"
+            nics.append(
+                NicConfig(
+                    network=network,
+                    ip=(
+                        self.replica_address(
+                            nic.get("ipAddr"), ip_path, replicas, subnet
+                        )
+                        if replicas
+                        else self.address(nic.get("ipAddr"), ip_path, subnet)
+                    ),
+                    index=index[network],
+                )
+            )
+
+        for i, user in enumerate(self.sequence(service.get("users"), f"{path}.users")):
+            user = self.mapping(user, f"{path}.users[{i}]")
+            self.string(user.get("name"), f"{path}.users[{i}].name")
+            self.sequence(user.get("ssh_key"), f"{path}.users[{i}].ssh_key")
+
+        host = self.string(service.get("host"), f"{path}.host", False)
+        if host is not None and host not in config.hosts:
+            self.error(f"{path}.host", f"unknown host {host}")
+        anti_affinity = service.get("anti_affinity") or []
+        if isinstance(anti_affinity, str):
+            anti_affinity = [anti_affinity]
+
+        return ServiceConfig(
+            name=name,
+            fqdn=service.get("fqdn"),
+            cpu=cpu,
+            ram=ram_size,
+            shared_ram=self.flag(ram.get("shared"), f"{path}.ram.shared"),
+            image=image,
+            layer=layer,
+            profile=profile or "default",
+            tuning=tuning or None,
+            volumes=volumes,
+            networks=nics,
+            host=host,
+            affinity=self.string(service.get("affinity"), f"{path}.affinity", False),
+            anti_affinity=frozenset(str(g) for g in anti_affinity),
+            raw=service,
+        )
+
+
+def compile_config(data) -> Config:
+    # every problem of the file at once, or the model
+    compiler = _Compiler()
+    config = compiler.compile(data)
+    if compiler.errors:
+        raise ConfigError(compiler.errors)
+    return config
+
+
+class ConfigCache:
+    # the parsed yaml of a file as json by its sha256, a repeat run skips the
+    # yaml parser and only compiles. plain data, nothing in the cache directory
+    # can run code. only valid configs are cached
+    def __init__(self, cache_dir: str = None, max_entries: int = CACHE_ENTRIES):
+        self._dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, "config")
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self._dir, f"{digest}.json")
+
+    def get(self, digest: str):
+        try:
+            with open(self._path(digest)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, digest: str, data):
+        try:
+            dump = json.dumps(data)
+        except (TypeError, ValueError):
+            return
+        # dates, int keys... would not load back the same, those stay uncached
+        if json.loads(dump) != data:
+            return
+        with self._lock:
+            try:
+                os.makedirs(self._dir, exist_ok=True)
+                tmp = f"{self._path(digest)}.{os.getpid()}"
+                with open(tmp, "w") as f:
+                    f.write(dump)
+                os.replace(tmp, self._path(digest))
+                self.__prune()
+            except OSError:
+                pass
+
+    def __prune(self):
+        entries = sorted(
+            (os.path.join(self._dir, name) for name in os.listdir(self._dir)),
+            key=os.path.getmtime,
+        )
+        for path in entries[: -self._max_entries]:
+            os.remove(path)
+
+
+config_cache = ConfigCache()
+
+
+def load_config(filename: str, cache: ConfigCache = config_cache) -> Config:
+    try:
+        with open(filename, "rb") as f:
+            content = f.read()
+    except OSError as e:
+        raise ConfigError([str(e)])
+    digest = hashlib.sha256(content).hexdigest()
+    data = cache.get(digest) if cache else None
+    if data is not None:
+        return compile_config(data)
+    try:
+        data = yaml.load(content, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        raise ConfigError([str(e)])
+    config = compile_config(data)
+    if cache:
+        cache.put(digest, data)
+    return config
@@ -1,12 +1,119 @@
+import atexit
+import sys
+import threading
 import libvirt
+from vmcreator.tracing import tracer
 
+DEFAULT_URI = "qemu:///system"
 
-class LibvirtConnect:
-    def __init__(self, uri="qemu:///system"):
-        self._conn = libvirt.open(uri)
-        if self._conn == None:
+
+def host_key(uri: str, key: str) -> str:
+    # registry/cache keys of things living on a libvirt host, unchanged for
+    # the default host so existing registries stay valid
+    return key if uri == DEFAULT_URI else f"{uri}#{key}"
+
+
+class ConnectionPool:
+    def __init__(self, max_size: int = 4):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._conns = {}
+        self._cursor = {}
+
+    def set_max_size(self, max_size: int):
+        with self._lock:
+            self._max_size = max(1, max_size)
+
+    def _open(self, uri):
+        try:
+            conn = libvirt.open(uri)
+        except libvirt.libvirtError as e:
+            print(e, file=sys.stderr)
+            conn = None
+        if conn == None:
             print(f"Failed open connection to {uri}", file=sys.stderr)
             exit(1)
+        return tracer.wrap(conn)
+
+    def _limit(self, uri) -> int:
+        # every open of a test driver file (test:///path/to/host.xml) starts
+        # its own private in-memory host, one connection keeps it one host
+        if uri.startswith("test:///") and uri != "test:///default":
+            return 1
+        return self._max_size
+
+    def acquire(self, uri) -> libvirt.virConnect:
+        # libvirt connections are thread-safe, so the pool only grows up to
+        # max_size per uri and after that hands out the existing ones round-robin
+        with self._lock:
+            conns = self._conns.setdefault(uri, [])
+            if len(conns) < self._limit(uri):
+                conns.append(self._open(uri))
+                return conns[-1]
+
+            idx = self._cursor.get(uri, 0) % len(conns)
+            self._cursor[uri] = idx + 1
+            conn = conns[idx]
+            if not self._is_alive(conn):
+                conn = self._open(uri)
+                conns[idx] = conn
+            return conn
+
+    def reconnect(self, uri, conn) -> libvirt.virConnect:
+        with self._lock:
+            conns = self._conns.setdefault(uri, [])
+            if conn in conns:
+                idx = conns.index(conn)
+                if self._is_alive(conn):
+                    return conn
+                self._close(conn)
+                conns[idx] = self._open(uri)
+                return conns[idx]
+            new_conn = self._open(uri)
+            if len(conns) < self._limit(uri):
+                conns.append(new_conn)
+            return new_conn
+
+    def close_all(self):
+        with self._lock:
+            for conns in self._conns.values():
+                for conn in conns:
+                    self._close(conn)
+            self._conns = {}
+            self._cursor = {}
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {uri: len(conns) for uri, conns in self._conns.items()}
+
+
+pool = ConnectionPool()
+atexit.register(pool.close_all)
+
+
+class LibvirtConnect:
+    def __init__(self, uri=DEFAULT_URI):
+        self._uri = uri
+        self._conn = pool.acquire(uri)
 
     def get_connection(self):
+        if not ConnectionPool._is_alive(self._conn):
+            self._conn = pool.reconnect(self._uri, self._conn)
         return self._conn
+
+    def get_uri(self):
+        return self._uri
@@ -0,0 +1,163 @@
+from typing import Dict, List
+from vmcreator.config import Config, NicConfig, ServiceConfig
+from vmcreator.units import parse_size
+
+# service keys that end up in the cloud-init iso
+CLOUDINIT_KEYS = ("fqdn", "timezone", "users", "network-init")
+
+
+class ServiceChange:
+    def __init__(self, name: str):
+        self.name = name
+        self.grown_volumes: List[int] = []
+        self.added_volumes: List[int] = []
+        self.removed_volumes: List[int] = []
+        self.added_networks: List[NicConfig] = []
+        self.removed_networks: List[NicConfig] = []
+        self.vcpu = None
+        self.ram = None
+        self.cloudinit = False
+        self.ignored: List[str] = []
+
+    def is_empty(self) -> bool:
+        return not (
+            self.grown_volumes
+            or self.added_volumes
+            or self.removed_volumes
+            or self.added_networks
+            or self.removed_networks
+            or self.vcpu
+            or self.ram
+            or self.cloudinit
+            or self.ignored
+        )
+
+    def describe(self) -> List[str]:
+        lines = []
+        for idx in self.grown_volumes:
+            lines.append(f"grow volume #{idx}")
+        for idx in self.added_volumes:
+            lines.append(f"add volume #{idx}")
+        for idx in self.removed_volumes:
+            lines.append(f"volume #{idx} removed from config (not deleted)")
+        for nic in self.added_networks:
+            lines.append(f"add nic on {nic.network} ({nic.ip})")
+        for nic in self.removed_networks:
+            lines.append(f"remove nic on {nic.network} ({nic.ip})")
+        if self.vcpu:
+            lines.append(f"set vcpu to {self.vcpu}")
+        if self.ram:
+            lines.append(f"set ram to {self.ram} MiB")
+        if self.cloudinit:
+            lines.append("regenerate cloud-init iso")
+        lines.extend(self.ignored)
+        return lines
+
+
+class ConfigDiff:
+    def __init__(self):
+        self.added: List[str] = []
+        self.removed: List[str] = []
+        self.changed: Dict[str, ServiceChange] = {}
+        self.warnings: List[str] = []
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+    def show(self):
+        if self.is_empty():
+            print("no changes.")
+        for vm in self.added:
+            print(f"+ {vm}")
+        for vm in self.removed:
+            print(f"- {vm}")
+        for vm, change in self.changed.items():
+            print(f"~ {vm}")
+            for line in change.describe():
+                print(f"    {line}")
+        for warning in self.warnings:
+            print(f"warning: {warning}")
+
+
+def _diff_service(name: str, old: ServiceConfig, new: ServiceConfig) -> ServiceChange:
+    change = ServiceChange(name)
+
+    old_vols = old.volumes
+    new_vols = new.volumes
+    for idx, vol in enumerate(new_vols):
+        if idx >= len(old_vols):
+            change.added_volumes.append(idx)
+            continue
+        old_vol = old_vols[idx]
+        if vol.type != old_vol.type:
+            change.ignored.append(f"volume #{idx} changed type, ignored")
+            continue
+        old_size = parse_size(old_vol.size)
+        new_size = parse_size(vol.size)
+        if new_size > old_size:
+            change.grown_volumes.append(idx)
+        elif new_size < old_size:
+            change.ignored.append(f"volume #{idx} can not shrink, ignored")
+    change.removed_volumes = list(range(len(new_vols), len(old_vols)))
+
+    # the nth nic on a network keys its mac and lease, so a nic that moves
+    # to another index is removed and added again
+    old_nics = {(n.network, n.index, n.ip): n for n in old.networks}
+    new_nics = {(n.network, n.index, n.ip): n for n in new.networks}
+    change.added_networks = [n for k, n in new_nics.items() if k not in old_nics]
+    change.removed_networks = [n for k, n in old_nics.items() if k not in new_nics]
+
+    if new.cpu != old.cpu:
+        change.vcpu = new.cpu
+    if new.ram != old.ram:
+        change.ram = new.ram
+    if new.shared_ram != old.shared_ram:
+        change.ignored.append("ram.shared changed, needs destroy+install")
+    if new.image != old.image:
+        change.ignored.append("image changed, needs destroy+install")
+    if new.layer != old.layer:
+        change.ignored.append("layer changed, needs destroy+install")
+    if new.profile != old.profile:
+        change.ignored.append("profile changed, needs destroy+install")
+    if new.tuning != old.tuning:
+        change.ignored.append("tuning changed, needs destroy+install")
+    if any(
+        getattr(new, k) != getattr(old, k)
+        for k in ("host", "affinity", "anti_affinity")
+    ):
+        change.ignored.append(
+            "placement changed, vm stays where it is until destroy+install"
+        )
+
+    change.cloudinit = any(
+        new.raw.get(k) != old.raw.get(k) for k in CLOUDINIT_KEYS
+    ) or len(new_nics) != len(old_nics)
+    return change
+
+
+def diff_configs(old: Config, new: Config) -> ConfigDiff:
+    diff = ConfigDiff()
+    old_services = old.services
+    new_services = new.services
+
+    diff.added = [vm for vm in new_services if vm not in old_services]
+    diff.removed = [vm for vm in old_services if vm not in new_services]
+    for vm in new_services:
+        if vm not in old_services or new_services[vm] == old_services[vm]:
+            continue
+        change = _diff_service(vm, old_services[vm], new_services[vm])
+        if not change.is_empty():
+            diff.changed[vm] = change
+
+    for name, netconfig in new.networks.items():
+        old_netconfig = old.networks.get(name)
+        if old_netconfig is not None and old_netconfig != netconfig:
+            diff.warnings.append(
+                f"network {name} definition changed, existing network is not modified"
+            )
+    if new.libvirt != old.libvirt:
+        diff.warnings.append("libvirt pools changed, existing volumes are not moved")
+    for name in old.hosts:
+        if name not in new.hosts:
+            diff.warnings.append(f"host {name} removed, vms placed on it are not moved")
+    return diff
@@ -1,13 +1,33 @@
 from typing import List
-from vmcreator.connection import LibvirtConnect
+from vmcreator.aio import AsyncMixin
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect
 from vmcreator.network import Network
 from vmcreator.storage import Storage, Cloudinit
-from libvirt import virDomain
+from vmcreator.topology import get_topology
+from vmcreator.tuning import Tuning
+from vmcreator.units import parse_size
+from vmcreator.templates import (
+    get_profile,
+    render_cdrom,
+    render_disk,
+    render_domain,
+    render_interface,
+)
+from libvirt import (
+    virDomain,
+    libvirtError,
+    VIR_DOMAIN_AFFECT_CONFIG,
+    VIR_DOMAIN_AFFECT_LIVE,
+    VIR_DOMAIN_BLOCK_RESIZE_BYTES,
+    VIR_DOMAIN_XML_INACTIVE,
+)
 import string
+import time
 import xml.etree.ElementTree as ET
+from vmcreator.tracing import parse_xml
 
 
-class Instance(LibvirtConnect):
+class Instance(LibvirtConnect, AsyncMixin):
     def __init__(
         self,
         name: str,
@@ -16,15 +36,20 @@ class Instance(LibvirtConnect):
         shared_ram: bool = True,
         networks: List[Network] = None,
         storages: List[Storage] = None,
+        profile: str = "default",
+        tuning: dict = None,
         debug: bool = False,
-        uri: str = "qemu:///system",
+        uri: str = DEFAULT_URI,
     ):
         super(Instance, self).__init__(uri)
+        get_profile(profile)
 
         self._name = name
         self._vcpu = vcpu
         self._ram = ram
         self._shared_ram = shared_ram
+        self._profile = profile
+        self._tuning = Tuning(tuning, vcpu)
 
         self._storages = storages
         if storages is None:
@@ -37,16 +62,42 @@ class Instance(LibvirtConnect):
         self._debug = debug
         self._instance = None
         self._xml = None
+        self._started_at = None
 
     def get_instance(self) -> virDomain:
         if not self._instance:
             self.create()
-        self._xml = ET.fromstring(self._instance.XMLDesc())
+        self._xml = parse_xml(self._instance.XMLDesc())
         return self._instance
 
+    def get_name(self):
+        return self._name
+
+    def exists(self) -> bool:
+        if self._instance:
+            return True
+        try:
+            self._instance = self.get_connection().lookupByName(self._name)
+        except libvirtError:
+            return False
+        return True
+
     def get_networks(self):
         return self._networks
 
+    def get_vcpu(self) -> int:
+        return self._vcpu
+
+    def get_ram(self) -> int:
+        return self._ram
+
+    def get_tuning(self) -> Tuning:
+        return self._tuning
+
+    def get_started_at(self) -> float:
+        # monotonic time this run started the domain, None if it already ran
+        return self._started_at
+
     def create(self) -> virDomain:
         try:
             instance = self.get_connection().lookupByName(self._name)
@@ -58,129 +109,45 @@ class Instance(LibvirtConnect):
                 import traceback
                 print(traceback.format_exc())
 
-        dev_counter = 1
-
-        ram_size = f'<memory unit="MiB">{self._ram}</memory>'
-
-        ram_config = ""
-        if self._shared_ram:
-            ram_config = f"""
-            <memoryBacking>
-              <source type="memfd"/>
-              <access mode="shared"/>
-            </memoryBacking>
-            <memballoon model="virtio">
-            <address type="pci" domain="0x0000" bus="0x0{dev_counter}" slot="0x00" function="0x0"/>
-            </memballoon>
-            """
-
-        # cpu configs
-        cpu = f'<cpu mode="host-passthrough"></cpu><vcpu placement="static">{self._vcpu}</vcpu>'
-
         # storage config
-        disk_opt = ""
-        disk_counter = 0
+        disks = []
         alphabet_letter = string.ascii_lowercase
-        for disk in self._storages:
+        for disk_counter, disk in enumerate(self._storages):
             if type(disk) == Cloudinit:
                 # attaching cloudinit disk
-                disk_opt += f"""
-                <disk type="file" device="cdrom">
-                <driver name="qemu" type="raw"/>
-                <source file="{disk.get_disk().path()}"/>
-                <target dev="sda" bus="sata"/>
-                <readonly/>
-                <address type="drive" controller="0" bus="0" target="0" unit="0"/>
-                </disk>
-                """
+                disks.append(render_cdrom(disk.get_disk().path(), "sda"))
             else:
-                disk_opt += f"""
-                <disk type="file" device="disk">
-                    <driver name="qemu" type="qcow2"/>
-                    <source file="{disk.get_disk().path()}"/>
-                    <target dev="vd{alphabet_letter[disk_counter]}" bus="virtio"/>
-                </disk>
-                """
-            disk_counter += 1
+                disks.append(
+                    render_disk(
+                        disk.get_disk().path(),
+                        f"vd{alphabet_letter[disk_counter]}",
+                        **self._tuning.disk_driver(disk_counter),
+                    )
+                )
 
         # network config
-        net_opt = ""
-        for net in self._networks:
-            this_mac = net.get_mac()
-
-            net_opt += f"""
-            <interface type="network">
-                <mac address="{net.get_mac()}"/>
-                <source network="{net.get_name()}"/>
-                <model type="virtio"/>
-                <address type="pci" domain="0x0000" bus="0x0{dev_counter}" slot="0x00" function="0x0"/>
-            </interface>
-            """
-            dev_counter += 1
+        interfaces = [
+            render_interface(net.get_mac(), net.get_name(), self._tuning.net_queues)
+            for net in self._networks
+        ]
 
         # instance define
-        instanceXML = f"""
-        <domain type="kvm">
-            <name>{self._name}</name>
-            <features>
-              <acpi/>
-              <apic/>
-              <vmport state="off"/>
-            </features>
-            {ram_size}
-            {ram_config}
-            <on_poweroff>destroy</on_poweroff>
-            <on_reboot>restart</on_reboot>
-            <on_crash>destroy</on_crash>
-            {cpu}
-            <os>
-                <type arch="x86_64" machine="q35">hvm</type>
-                <boot dev="hd"/>
-            </os>
-            <devices>
-                {disk_opt}
-                {net_opt}
-                <serial type="pty">
-                <target type="isa-serial" port="0">
-                    <model name="isa-serial"/>
-                </target>
-                </serial>
-                <console type="pty">
-                <target type="serial" port="0"/>
-                </console>
-                <channel type="spicevmc">
-                <target type="virtio" name="com.redhat.spice.0"/>
-                <address type="virtio-serial" controller="0" bus="0" port="1"/>
-                </channel>
-                <input type="tablet" bus="usb">
-                <address type="usb" bus="0" port="1"/>
-                </input>
-                <input type="mouse" bus="ps2"/>
-                <input type="keyboard" bus="ps2"/>
-                <graphics type="spice" autoport="yes">
-                <listen type="address"/>
-                <image compression="off"/>
-                </graphics>
-                <sound model="ich6">
-                <address type="pci" domain="0x0000" bus="0x00" slot="0x04" function="0x0"/>
-                </sound>
-                <audio id="1" type="spice"/>
-                <video>
-                <model type="qxl" ram="65536" vram="65536" vgamem="16384" heads="1" primary="yes"/>
-                <address type="pci" domain="0x0000" bus="0x00" slot="0x02" function="0x0"/>
-                </video>
-                <redirdev bus="usb" type="spicevmc">
-                <address type="usb" bus="0" port="2"/>
-                </redirdev>
-                <redirdev bus="usb" type="spicevmc">
-                <address type="usb" bus="0" port="3"/>
-                </redirdev>
-            </devices>
-        </domain>
-        """
+        instanceXML = render_domain(
+            self._profile,
+            self._name,
+            self._vcpu,
+            self._ram,
+            self._shared_ram,
+            disks,
+            interfaces,
+            tuning=self._tuning.render_head(
+                self._ram, self._shared_ram, get_topology(self.get_uri())
+            ),
+        )
 
         instance = self.get_connection().defineXML(instanceXML)
         instance.create()
+        self._started_at = time.monotonic()
 
         self._instance = self.get_connection().lookupByName(self._name)
         print(f"Instance {self._name} successfully created.")
@@ -190,7 +157,7 @@ class Instance(LibvirtConnect):
     def get_associated_storages(self):
         instance = self.get_instance()
 
-        root = ET.fromstring(instance.XMLDesc())
+        root = parse_xml(instance.XMLDesc())
         disks = root.findall(".//disk/source")
 
         for disk in disks:
@@ -202,14 +169,17 @@ class Instance(LibvirtConnect):
 
         return self._storages
 
-    def delete(self, with_storage: bool = False):
+    def destroy_domain(self):
         instance = self.get_instance()
-
-        disks = self.get_associated_storages()
-
         if instance.isActive():
             instance.destroy()
         instance.undefine()
+        self._instance = None
+
+    def delete(self, with_storage: bool = False):
+        disks = self.get_associated_storages()
+
+        self.destroy_domain()
 
         # delete if we have storage
         if with_storage:
@@ -220,3 +190,98 @@ class Instance(LibvirtConnect):
         # delete dhcp lease in network
         for network in self.get_networks():
             network.delete()
+
+    def _live_flags(self) -> int:
+        flags = VIR_DOMAIN_AFFECT_CONFIG
+        if self.get_instance().isActive():
+            flags |= VIR_DOMAIN_AFFECT_LIVE
+        return flags
+
+    def _free_disk_target(self) -> str:
+        root = parse_xml(self.get_instance().XMLDesc())
+        used = {t.get("dev") for t in root.findall(".//disk/target")}
+        for letter in string.ascii_lowercase:
+            if f"vd{letter}" not in used:
+                return f"vd{letter}"
+        raise RuntimeError(f"no free disk target left on {self._name}")
+
+    def _disk_target(self, storage: Storage) -> str:
+        path = storage.get_disk().path()
+        root = parse_xml(self.get_instance().XMLDesc())
+        for disk in root.findall(".//disk"):
+            source = disk.find("source")
+            if source is not None and source.get("file") == path:
+                return disk.find("target").get("dev")
+        return None
+
+    def attach_disk(self, storage: Storage):
+        disk_xml = render_disk(
+            storage.get_disk().path(),
+            self._free_disk_target(),
+            **self._tuning.disk_driver(len(self._storages)),
+        )
+        self.get_instance().attachDeviceFlags(disk_xml, self._live_flags())
+        self._storages.append(storage)
+        print(f"attached {storage.get_volume_name()} to {self._name}")
+
+    def grow_disk(self, storage: Storage, size: str):
+        capacity = parse_size(size)
+        if capacity <= storage.get_disk().info()[1]:
+            print(f"{storage.get_volume_name()} is already >= {size}, skipping")
+            return
+        target = self._disk_target(storage)
+        if target and self.get_instance().isActive():
+            self.get_instance().blockResize(
+                target, capacity, VIR_DOMAIN_BLOCK_RESIZE_BYTES
+            )
+        else:
+            storage.get_disk().resize(capacity)
+        print(f"resized {storage.get_volume_name()} to {size}")
+
+    def attach_interface(self, network: Network):
+        net_xml = render_interface(
+            network.get_mac(), network.get_name(), self._tuning.net_queues
+        )
+        self.get_instance().attachDeviceFlags(net_xml, self._live_flags())
+        self._networks.append(network)
+        print(f"attached {network.get_name()} ({network.get_mac()}) to {self._name}")
+
+    def detach_interface(self, network: Network):
+        root = parse_xml(self.get_instance().XMLDesc())
+        candidates = [
+            iface
+            for iface in root.findall(".//devices/interface")
+            if iface.find("source").get("network") == network.get_name()
+        ]
+        if len(candidates) > 1:
+            # several nics on the same network, pick the reserved one
+            mac = network.get_mac()
+            candidates = [c for c in candidates if c.find("mac").get("address") == mac]
+        if not candidates:
+            print(f"no interface on {network.get_name()} in {self._name}, skipping")
+            return
+        self.get_instance().detachDeviceFlags(
+            ET.tostring(candidates[0], encoding="unicode"), self._live_flags()
+        )
+        print(f"detached {network.get_name()} from {self._name}")
+
+    def redefine(self, vcpu: int = None, ram: int = None):
+        # changes the persistent definition only, running domains pick it up
+        # on the next cold boot
+        root = parse_xml(
+            self.get_instance().XMLDesc(VIR_DOMAIN_XML_INACTIVE)
+        )
+        if vcpu:
+            root.find("vcpu").text = str(vcpu)
+            self._vcpu = vcpu
+        if ram:
+            for tag in ("memory", "currentMemory"):
+                elem = root.find(tag)
+                if elem is not None:
+                    elem.set("unit", "MiB")
+                    elem.text = str(ram)
+            self._ram = ram
+        self._instance = self.get_connection().defineXML(
+            ET.tostring(root, encoding="unicode")
+        )
+        print(f"redefined {self._name} (vcpu={vcpu}, ram={ram}), applies on next boot")
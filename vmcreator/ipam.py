@@ -0,0 +1,226 @@
+import ipaddress
+import socket
+from vmcreator.config import Config, nic_key
+
+# one byte per address, keeps a /12 under 1 MiB. bigger networks still take
+# explicit addresses, they just can't hand any out
+MAX_POOL_SIZE = 1 << 20
+
+
+class IpamError(Exception):
+    def __init__(self, errors: list):
+        super(IpamError, self).__init__("\n".join(errors))
+        self.errors = errors
+
+
+class AddressPool:
+    # owners of the used addresses of one network, plus a free/used bitmap
+    # built on the first allocation. network, gateway and broadcast are
+    # never handed out; auto-assigned addresses are taken outside the dhcp
+    # range first so they don't race dnsmasq's dynamic leases
+    def __init__(
+        self, name: str, ipcidr: str, dhcp_start: str = None, dhcp_end: str = None
+    ):
+        iface = ipaddress.ip_interface(ipcidr)
+        self.name = name
+        self.network = iface.network
+        size = self.network.num_addresses
+        self._size = size
+        self._base = int(self.network.network_address)
+        self._v4 = self.network.version == 4
+        self._used = None
+        self._owners = {}
+
+        self._mark(0, "network address")
+        if size > 2:
+            self._mark(size - 1, "broadcast address")
+        self._mark(self.offset(str(iface.ip)), "gateway")
+
+        first, last = 1, max(1, size - 2)
+        ranges = []
+        if dhcp_start and dhcp_end:
+            lo, hi = self.offset(dhcp_start), self.offset(dhcp_end)
+            ranges = [(first, lo - 1), (hi + 1, last), (lo, hi)]
+        else:
+            ranges = [(first, last)]
+        # [lo, hi, next offset to look at]
+        self._ranges = [[lo, hi, lo] for lo, hi in ranges if lo <= hi]
+
+    def _mark(self, offset: int, owner: str):
+        if self._used is not None:
+            self._used[offset] = 1
+        self._owners[offset] = owner
+
+    def _bitmap(self) -> bytearray:
+        if self._used is None:
+            if self._size > MAX_POOL_SIZE:
+                raise ValueError(
+                    f"{self.network} is too large to assign addresses from, set ipAddr"
+                )
+            self._used = bytearray(self._size)
+            for offset in self._owners:
+                self._used[offset] = 1
+        return self._used
+
+    def offset(self, ip: str) -> int:
+        addr = ipaddress.ip_address(ip)
+        if addr not in self.network:
+            raise ValueError(f"{ip} is outside {self.network}")
+        return int(addr) - self._base
+
+    def owner(self, ip: str) -> str:
+        return self._owners.get(self.offset(ip))
+
+    def reserve(self, ip: str, owner: str) -> str:
+        # returns the current owner when the address is taken by someone else
+        offset = self.offset(ip)
+        current = self._owners.get(offset)
+        if current is not None and current != owner:
+            return current
+        self._mark(offset, owner)
+        return None
+
+    def allocate(self, owner: str) -> str:
+        used = self._bitmap()
+        for r in self._ranges:
+            lo, hi, hint = r
+            offset = used.find(0, hint, hi + 1)
+            if offset < 0:
+                offset = used.find(0, lo, hint)
+            if offset >= 0:
+                r[2] = offset + 1
+                self._mark(offset, owner)
+                return self.address(offset)
+        return None
+
+    def address(self, offset: int) -> str:
+        # inet_ntoa is several times cheaper than an ip_address object
+        if self._v4:
+            return socket.inet_ntoa((self._base + offset).to_bytes(4, "big"))
+        return str(ipaddress.ip_address(self._base + offset))
+
+    def release(self, ip: str):
+        offset = self.offset(ip)
+        if self._used is not None:
+            self._used[offset] = 0
+        self._owners.pop(offset, None)
+
+
+class Ipam:
+    # fills in ipAddr for nics that omit it and checks every address of a
+    # config at once, before anything is created. auto-assigned addresses
+    # are kept (per vm/network/nic index) in the state file
+    def __init__(self, allocations: dict = None):
+        self._allocations = dict(allocations or {})
+
+    def get_allocations(self) -> dict:
+        return dict(self._allocations)
+
+    def release(self, vm: str):
+        for key in [k for k in self._allocations if k.split("/")[0] == vm]:
+            del self._allocations[key]
+
+    def recall(self, config: Config) -> Config:
+        # the addresses earlier runs handed out, nothing is allocated or
+        # checked. for teardown: a nic without a recorded address stays
+        # without one rather than getting an address some other vm holds
+        addresses = {}
+        for vm, service in config.services.items():
+            for position, nic in enumerate(service.networks):
+                ip = self._allocations.get(nic_key(vm, nic.network, nic.index))
+                if not nic.ip and ip:
+                    addresses[(vm, position)] = ip
+        return config.with_addresses(addresses)
+
+    @staticmethod
+    def _pools(config: Config, errors: list) -> dict:
+        pools = {}
+        for name, network in config.networks.items():
+            if network.external or not network.ipcidr:
+                continue
+            try:
+                pools[name] = AddressPool(
+                    name, network.ipcidr, network.dhcp_start, network.dhcp_end
+                )
+            except ValueError as e:
+                errors.append(f"network {name}: {e}")
+        return pools
+
+    def resolve(self, config: Config, reservations: dict = None, managed=()) -> Config:
+        # returns a copy of config where every nic on a managed network has
+        # an ip. reservations: {network: [host]} already on the networks,
+        # hosts named after a vm in managed are ours and don't conflict
+        errors = []
+        pools = self._pools(config, errors)
+
+        nics = []
+        for vm, service in config.services.items():
+            for position, nic in enumerate(service.networks):
+                nics.append((vm, position, nic, nic_key(vm, nic.network, nic.index)))
+
+        def take(vm, netname, ip) -> str:
+            # None when ip is now held by vm, the reason otherwise
+            pool = pools.get(netname)
+            try:
+                if pool is None:
+                    owner = taken.setdefault((netname, ip), vm)
+                    owner = None if owner == vm else owner
+                else:
+                    owner = pool.reserve(ip, vm)
+            except ValueError as e:
+                return str(e)
+            if owner is not None:
+                return f"{ip} is already used by {owner}"
+            return None
+
+        taken = {}
+        for netname, hosts in (reservations or {}).items():
+            pool = pools.get(netname)
+            for host in hosts:
+                if not host.get("ip") or host.get("name") in managed:
+                    continue
+                owner = f"reservation {host.get('name')} ({host.get('mac')})"
+                if pool is None:
+                    taken[(netname, host.get("ip"))] = owner
+                else:
+                    try:
+                        pool.reserve(host.get("ip"), owner)
+                    except ValueError:
+                        pass
+
+        # explicit addresses first, then the ones handed out by earlier
+        # runs, then new ones. nothing is recorded unless all of them fit
+        allocations = dict(self._allocations)
+        for vm, position, nic, key in nics:
+            if nic.ip:
+                error = take(vm, nic.network, nic.ip)
+                if error:
+                    errors.append(f"{vm}: ipAddr on {nic.network}: {error}")
+                allocations.pop(key, None)
+        addresses = {}
+        pending = []
+        for vm, position, nic, key in nics:
+            if nic.ip or nic.network not in pools:
+                continue
+            ip = allocations.get(key)
+            if ip and not take(vm, nic.network, ip):
+                addresses[(vm, position)] = ip
+            else:
+                # taken meanwhile or outside a changed ipCidr, pick another
+                pending.append((vm, position, nic, key))
+        for vm, position, nic, key in pending:
+            try:
+                ip = pools[nic.network].allocate(vm)
+            except ValueError as e:
+                errors.append(f"{vm}: no ipAddr on {nic.network}: {e}")
+                continue
+            if ip is None:
+                errors.append(f"{vm}: no free address left on {nic.network}")
+                continue
+            addresses[(vm, position)] = ip
+            allocations[key] = ip
+
+        if errors:
+            raise IpamError(errors)
+        self._allocations = allocations
+        return config.with_addresses(addresses)
@@ -0,0 +1,239 @@
+import os
+import re
+import struct
+import time
+
+# minimal ISO9660 + Joliet writer, enough for a flat cloud-init seed
+# (a handful of small files in the root directory)
+
+SECTOR = 2048
+
+
+def _both16(value: int) -> bytes:
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+
+def _both32(value: int) -> bytes:
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+
+def _pad(data: bytes, length: int, fill: bytes = b" ") -> bytes:
+    if len(data) > length:
+        return data[:length]
+    return data + fill * ((length - len(data)) // len(fill))
+
+
+def _ucs2(text: str, length: int) -> bytes:
+    data = _pad(text.encode("utf-16-be"), length - length % 2, b"\x00 ")
+    return data + b"\x00" * (length - len(data))
+
+
+def _sectors(size: int) -> int:
+    return max(1, (size + SECTOR - 1) // SECTOR)
+
+
+def _volume_date(ts: float) -> bytes:
+    t = time.gmtime(ts)
+    return time.strftime("%Y%m%d%H%M%S", t).encode() + b"00\x00"
+
+
+def _record_date(ts: float) -> bytes:
+    t = time.gmtime(ts)
+    return bytes(
+        [t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0]
+    )
+
+
+def _dir_record(ident: bytes, extent: int, size: int, ts: float, is_dir=False) -> bytes:
+    length = 33 + len(ident) + (1 - len(ident) % 2)
+    record = (
+        bytes([length, 0])
+        + _both32(extent)
+        + _both32(size)
+        + _record_date(ts)
+        + bytes([2 if is_dir else 0, 0, 0])
+        + _both16(1)
+        + bytes([len(ident)])
+        + ident
+    )
+    return _pad(record, length, b"\x00")
+
+
+def _iso_names(names) -> dict:
+    # 8.3 d-character names for the primary volume descriptor
+    result = {}
+    used = set()
+    for name in names:
+        base, ext = name.upper(), ""
+        if "." in name:
+            base, _, ext = base.rpartition(".")
+        base = re.sub(r"[^A-Z0-9_]", "_", base)[:8] or "_"
+        ext = re.sub(r"[^A-Z0-9_]", "_", ext)[:3]
+        candidate = f"{base}.{ext}"
+        counter = 0
+        while candidate in used:
+            counter += 1
+            suffix = str(counter)
+            candidate = f"{base[: 8 - len(suffix)]}{suffix}.{ext}"
+        used.add(candidate)
+        result[name] = f"{candidate};1".encode("ascii")
+    return result
+
+
+def _directory(entries, self_extent: int, ts: float) -> bytes:
+    # entries: [(identifier, extent, size)], records may not span sectors
+    records = [
+        _dir_record(b"\x00", self_extent, 0, ts, is_dir=True),
+        _dir_record(b"\x01", self_extent, 0, ts, is_dir=True),
+    ]
+    for ident, extent, size in sorted(entries):
+        records.append(_dir_record(ident, extent, size, ts))
+
+    data = b""
+    for record in records:
+        used = len(data) % SECTOR
+        if used + len(record) > SECTOR:
+            data += b"\x00" * (SECTOR - used)
+        data += record
+    return _pad(data, _sectors(len(data)) * SECTOR, b"\x00")
+
+
+def _fix_dir_size(directory: bytes, extent: int) -> bytes:
+    # "." and ".." carry the size of the directory itself
+    size = _both32(len(directory))
+    out = bytearray(directory)
+    for offset in (0, out[0]):
+        out[offset + 2 : offset + 10] = _both32(extent)
+        out[offset + 10 : offset + 18] = size
+    return bytes(out)
+
+
+def _path_table(extent: int, big_endian: bool) -> bytes:
+    fmt = ">IH" if big_endian else "<IH"
+    return bytes([1, 0]) + struct.pack(fmt, extent, 1) + b"\x00\x00"
+
+
+def _volume_descriptor(
+    joliet: bool,
+    volume_id: str,
+    total_sectors: int,
+    path_table_l: int,
+    path_table_m: int,
+    root_record: bytes,
+    ts: float,
+) -> bytes:
+    text = (lambda s, n: _ucs2(s, n)) if joliet else (lambda s, n: _pad(s.encode(), n))
+    date = _volume_date(ts)
+    vd = (
+        bytes([2 if joliet else 1])
+        + b"CD001"
+        + bytes([1, 0])
+        + text("LINUX", 32)
+        + text(volume_id, 32)
+        + b"\x00" * 8
+        + _both32(total_sectors)
+        + (_pad(b"%/E", 32, b"\x00") if joliet else b"\x00" * 32)
+        + _both16(1)
+        + _both16(1)
+        + _both16(SECTOR)
+        + _both32(10)
+        + struct.pack("<I", path_table_l)
+        + b"\x00" * 4
+        + struct.pack(">I", path_table_m)
+        + b"\x00" * 4
+        + root_record
+        + text("", 128)
+        + text("", 128)
+        + text("", 128)
+        + text("VMCREATOR", 128)
+        + text("", 37)
+        + text("", 37)
+        + text("", 37)
+        + date
+        + date
+        + b"0" * 16
+        + b"\x00"
+        + date
+        + bytes([1, 0])
+    )
+    return _pad(vd, SECTOR, b"\x00")
+
+
+def build_iso(files: dict, volume_id: str = "cidata", timestamp: float = None) -> bytes:
+    # files: {name: bytes}, all placed in the root directory
+    ts = timestamp
+    if ts is None:
+        ts = float(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+    names = sorted(files)
+    iso_names = _iso_names(names)
+    joliet_names = {n: f"{n};1".encode("utf-16-be") for n in names}
+
+    # layout: 16 system sectors, pvd, svd, terminator, 4 path tables,
+    # primary root, joliet root, file data
+    path_tables = 19
+    primary_root = path_tables + 4
+
+    # directory size only depends on the identifiers, compute it first
+    primary_dir = _directory([(iso_names[n], 0, 0) for n in names], 0, ts)
+    joliet_root = primary_root + len(primary_dir) // SECTOR
+    joliet_dir = _directory([(joliet_names[n], 0, 0) for n in names], 0, ts)
+
+    extent = joliet_root + len(joliet_dir) // SECTOR
+    extents = {}
+    for name in names:
+        extents[name] = extent
+        extent += _sectors(len(files[name]))
+    total_sectors = extent
+
+    primary_dir = _fix_dir_size(
+        _directory(
+            [(iso_names[n], extents[n], len(files[n])) for n in names],
+            primary_root,
+            ts,
+        ),
+        primary_root,
+    )
+    joliet_dir = _fix_dir_size(
+        _directory(
+            [(joliet_names[n], extents[n], len(files[n])) for n in names],
+            joliet_root,
+            ts,
+        ),
+        joliet_root,
+    )
+
+    pvd = _volume_descriptor(
+        False,
+        volume_id,
+        total_sectors,
+        path_tables,
+        path_tables + 1,
+        primary_dir[:34],
+        ts,
+    )
+    svd = _volume_descriptor(
+        True,
+        volume_id,
+        total_sectors,
+        path_tables + 2,
+        path_tables + 3,
+        joliet_dir[:34],
+        ts,
+    )
+    terminator = _pad(b"\xffCD001\x01", SECTOR, b"\x00")
+
+    chunks = [
+        b"\x00" * (16 * SECTOR),
+        pvd,
+        svd,
+        terminator,
+        _pad(_path_table(primary_root, False), SECTOR, b"\x00"),
+        _pad(_path_table(primary_root, True), SECTOR, b"\x00"),
+        _pad(_path_table(joliet_root, False), SECTOR, b"\x00"),
+        _pad(_path_table(joliet_root, True), SECTOR, b"\x00"),
+        primary_dir,
+        joliet_dir,
+    ]
+    for name in names:
+        chunks.append(_pad(files[name], _sectors(len(files[name])) * SECTOR, b"\x00"))
+    return b"".join(chunks)
@@ -0,0 +1,103 @@
+import hashlib
+import threading
+from vmcreator.config import nic_key
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect, pool
+from vmcreator.tracing import parse_xml
+
+QEMU_OUI = "52:54:00"
+
+
+class MacAllocator(LibvirtConnect):
+    # stable mac addresses: derived from (vm, network, nic index) instead of
+    # drawn at random, checked against every mac already in use on the host
+    # (domains, dhcp reservations, host interfaces) and remembered in the
+    # state file so a redeploy hands out the same ones again. with several
+    # hosts every one of them is checked, vms may move or share a bridge
+    def __init__(self, allocations: dict = None, uri: str = DEFAULT_URI):
+        super(MacAllocator, self).__init__(uri)
+        self._allocations = dict(allocations or {})
+        self._taken = set(self._allocations.values())
+        self._lock = threading.Lock()
+        self._used = None
+        self._uris = [uri]
+
+    def add_uri(self, uri: str):
+        with self._lock:
+            if uri not in self._uris:
+                self._uris.append(uri)
+                self._used = None
+
+    def _load_used(self) -> set:
+        used = set()
+        for uri in self._uris:
+            conn = self.get_connection() if uri == self.get_uri() else pool.acquire(uri)
+            used |= self._load_host(conn)
+        return used
+
+    @staticmethod
+    def _load_host(conn) -> set:
+        used = set()
+        for dom in conn.listAllDomains(0):
+            for mac in parse_xml(dom.XMLDesc(0)).findall(".//interface/mac"):
+                used.add(mac.get("address").lower())
+        for net in conn.listAllNetworks(0):
+            root = parse_xml(net.XMLDesc(0))
+            for elem in root.findall("mac") + root.findall(".//dhcp/host"):
+                if elem.get("address") or elem.get("mac"):
+                    used.add((elem.get("address") or elem.get("mac")).lower())
+        for iface in conn.listAllInterfaces(0):
+            used.add(iface.MACString().lower())
+        return used
+
+    def get_used(self) -> set:
+        if self._used is None:
+            self._used = self._load_used()
+        return self._used
+
+    @staticmethod
+    def derive(key: str, attempt: int = 0) -> str:
+        seed = key if attempt == 0 else f"{key}#{attempt}"
+        digest = hashlib.sha256(seed.encode()).digest()
+        return QEMU_OUI + "".join(f":{b:02x}" for b in digest[:3])
+
+    def allocate(self, vm: str, network: str, index: int = 0) -> str:
+        key = nic_key(vm, network, index)
+        with self._lock:
+            mac = self._allocations.get(key)
+            if mac:
+                # ours from a previous run, whether or not it is still in use
+                return mac
+            used = self.get_used()
+            attempt = 0
+            mac = self.derive(key)
+            while mac in used or mac in self._taken:
+                attempt += 1
+                if attempt > 0xFFFFFF:
+                    raise RuntimeError(f"no free mac address left for {key}")
+                mac = self.derive(key, attempt)
+            used.add(mac)
+            self._taken.add(mac)
+            self._allocations[key] = mac
+            return mac
+
+    def lookup(self, vm: str, network: str, index: int = 0) -> str:
+        # the mac handed out earlier, None instead of allocating one
+        with self._lock:
+            return self._allocations.get(nic_key(vm, network, index))
+
+    def claim(self, vm: str, network: str, index: int, mac: str):
+        # mac found on an existing reservation, keep it for next time
+        with self._lock:
+            self._allocations[nic_key(vm, network, index)] = mac.lower()
+            self._taken.add(mac.lower())
+            if self._used is not None:
+                self._used.add(mac.lower())
+
+    def release(self, vm: str):
+        with self._lock:
+            for key in [k for k in self._allocations if k.split("/")[0] == vm]:
+                self._taken.discard(self._allocations.pop(key))
+
+    def get_allocations(self) -> dict:
+        with self._lock:
+            return dict(self._allocations)
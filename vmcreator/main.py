@@ -1,37 +1,107 @@
 #!/usr/bin/env python3
 
-import os
-import yaml
 import argparse
-import string
-from vmcreator.connection import LibvirtConnect
-from vmcreator.instance import Instance
-from vmcreator.network import InstanceNetwork, VirtNetwork, VirtNetworkMode
-from vmcreator.storage import RootStorage, BasicStorage, Cloudinit
-from typing import List
+from vmcreator.config import ConfigError, compile_config, load_config
+from vmcreator.planner import plan_from_config, dry_run
+from vmcreator.provision import print_summary
+from vmcreator.diff import diff_configs
+from vmcreator.update import plan_update
+from vmcreator.storage import ISO_BACKENDS, VOLUME_BACKENDS
+from vmcreator.state import state_filename, read_state, write_state
+from vmcreator.mac import MacAllocator
+from vmcreator.ipam import Ipam, IpamError
+from vmcreator.network import read_reservations
+from vmcreator.capacity import CapacityPlanner
+from vmcreator.readiness import wait_ready, start_event_loop
+from vmcreator.tracing import TRACE_FORMATS, start_tracing, traced
+from vmcreator.scheduler import (
+    HostState,
+    SchedulingError,
+    get_hosts,
+    is_multi_host,
+    locate,
+    schedule,
+)
 
 
-def read_config(config_file="config.yaml"):
-    filepath = os.path.abspath(config_file)
-    config = None
+def read_config(config_file="config.yaml", data=None):
+    # the compiled config, every error of the file is printed at once.
+    # data: an already loaded config (the one frozen in the state)
     try:
-        with open(filepath, "r") as f:
-            config = yaml.safe_load(f)
-    except OSError as e:
-        print(e)
-    except yaml.YAMLError as y:
-        print(y)
-    return config
-
-def freeze_config(config, config_filename):
+        if data is not None:
+            return compile_config(data)
+        return load_config(config_file)
+    except ConfigError as e:
+        print(f"invalid config {config_file}:")
+        for error in e.errors:
+            print(f"  {error}")
+    return None
+
+
+@traced("addresses")
+def resolve_addresses(ipam: Ipam, config, reservations=None, managed=()):
+    # every address problem of the config at once, before touching libvirt
     try:
-        cfg_basename = os.path.basename(
-                        os.path.splitext(config_filename)[0]
-                    ).replace(" ","_")
-        with open(f"{cfg_basename}_output.state", "w") as f:
-            yaml.safe_dump(config, f)
-    except Exception as e:
-        print(e)
+        return ipam.resolve(config, reservations, managed)
+    except IpamError as e:
+        print("address conflicts:")
+        for error in e.errors:
+            print(f"  {error}")
+        exit(-10)
+
+
+@traced("placement")
+def place_services(config, hosts, sticky, args) -> dict:
+    # {vm: host}, only with a hosts: section, a single host needs no choice
+    if not is_multi_host(config):
+        return {}
+    states = {
+        name: HostState(
+            name,
+            uri,
+            vm_pool=config.libvirt.vm_pool,
+            cpu_overcommit=args.cpu_overcommit,
+            disk_overcommit=args.disk_overcommit,
+        )
+        for name, uri in hosts.items()
+    }
+    try:
+        placement = schedule(config, states, sticky)
+    except SchedulingError as e:
+        print("placement failed:")
+        for error in e.errors:
+            print(f"  {error}")
+        exit(-10)
+    print("placement:")
+    for host in states.values():
+        print(f"  {host.name}: {', '.join(host.vms) or '-'} ({host.describe()})")
+    return placement
+
+
+@traced("capacity")
+def check_capacity(plan, args, hosts) -> bool:
+    used = {r.obj.get_uri() for r in plan.resources() if r.kind == "domain"}
+    multi = len(hosts) > 1
+    ok = True
+    for name, uri in hosts.items():
+        if uri not in used:
+            continue
+        report = CapacityPlanner(
+            cpu_overcommit=args.cpu_overcommit,
+            disk_overcommit=args.disk_overcommit,
+            uri=uri,
+        ).check(plan, host=name if multi else None)
+        report.show()
+        ok = ok and report.ok()
+    if ok:
+        return True
+    if args.force:
+        print("capacity check failed, continuing anyway (--force)")
+        return True
+    if not args.dry_run:
+        print("capacity check failed, nothing was created (use --force to override)")
+    return False
+
 
 def main():
     arg = argparse.ArgumentParser("vmcreator")
@@ -45,7 +115,7 @@ def main():
     )
     arg.add_argument(
         "--delete-storage",
-        help="also delete storages defined in config.yaml (section services inside volumes) when action=destroy",
+        help="also delete storages defined in config.yaml (section services inside volumes) when action=destroy, or of removed services when action=update",
         action="store_true",
     )
     arg.add_argument(
@@ -53,6 +123,69 @@ def main():
         help="also delete network defined in config.yaml (section networks outside services) when action=destroy",
         action="store_true",
     )
+    arg.add_argument(
+        "--parallel",
+        "-p",
+        help="max number of resources created/deleted concurrently per host (default: 4)",
+        type=int,
+        default=4,
+    )
+    arg.add_argument(
+        "--iso-backend",
+        help="how cloud-init isos are built: python (in-process, default) or genisoimage",
+        choices=ISO_BACKENDS,
+        default="python",
+    )
+    arg.add_argument(
+        "--volume-backend",
+        help="how volumes are created: libvirt (storageVolCreateXML, default) or qemu-img",
+        choices=VOLUME_BACKENDS,
+        default="libvirt",
+    )
+    arg.add_argument(
+        "--force",
+        help="install/update even when the host capacity check fails",
+        action="store_true",
+    )
+    arg.add_argument(
+        "--cpu-overcommit",
+        help="max ratio of vcpus to host cpus accepted by the capacity check (default: 4)",
+        type=float,
+        default=4.0,
+    )
+    arg.add_argument(
+        "--disk-overcommit",
+        help="max ratio of virtual (thin) volume size to free pool space accepted by the capacity check (default: 1)",
+        type=float,
+        default=1.0,
+    )
+    arg.add_argument(
+        "--wait",
+        help="after install, block until every vm runs and holds its reserved ip",
+        action="store_true",
+    )
+    arg.add_argument(
+        "--wait-timeout",
+        help="seconds to wait per vm with --wait (default: 300)",
+        type=float,
+        default=300,
+    )
+    arg.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record every libvirt call, process and xml parse and write them to FILE, with a table of the slowest resources",
+    )
+    arg.add_argument(
+        "--trace-format",
+        help="chrome (chrome://tracing, perfetto, default) or otlp (OpenTelemetry json)",
+        choices=TRACE_FORMATS,
+        default="chrome",
+    )
+    arg.add_argument(
+        "--dry-run",
+        help="only print the plan and the number of dnsmasq reloads it causes when action=install",
+        action="store_true",
+    )
     arg.add_argument(
         "--debug",
         help="enable debugging",
@@ -60,157 +193,156 @@ def main():
     )
     args = arg.parse_args()
 
+    if args.wait:
+        # before the first connection is opened
+        start_event_loop()
+    if args.trace:
+        start_tracing(args.trace, args.trace_format)
+
     config = read_config(args.config)
 
     if not config:
         exit(-10)
 
-    vm_storagepool = config.get("libvirt").get("vm-pool")
-    iso_storagepool = config.get("libvirt").get("iso-pool")
+    state = read_state(args.config)
+    hosts = get_hosts(config)
+    macs = MacAllocator(state.get("macs"), uri=next(iter(hosts.values())))
+    for uri in hosts.values():
+        macs.add_uri(uri)
+    ipam = Ipam(state.get("ips"))
 
     # install
     if args.action == "install":
+        resolved = resolve_addresses(
+            ipam,
+            config,
+            read_reservations(config, list(hosts.values())),
+            managed=set(config.services),
+        )
+        placement = place_services(resolved, hosts, state.get("hosts"), args)
+        plan = plan_from_config(
+            resolved,
+            debug=args.debug,
+            iso_backend=args.iso_backend,
+            volume_backend=args.volume_backend,
+            macs=macs,
+            placement=placement,
+        )
+        admitted = check_capacity(plan, args, hosts)
+        if args.dry_run:
+            dry_run(plan)
+            exit(0)
+        if not admitted:
+            exit(-10)
+        results = plan.apply(workers=args.parallel, debug=args.debug)
+        ok = print_summary(plan.summarize_by_vm(results))
 
-        for vm in config.get("services"):
-            storages = []
-            networks = []
-            # generate cloudinit
-            cloudinit = Cloudinit(
-                vm_name=vm,
-                storage_pool_name=vm_storagepool,
-                config=config.get("services").get(vm),
-                debug=args.debug,
-            )
-            storages.append(cloudinit)
-
-            # generate vm disks
-            disk_counter = 0
-            alphabet_letter = string.ascii_lowercase
-            for vol in config.get("services").get(vm).get("volumes"):
-                if vol.get("type") == "root":
-                    new_vol = RootStorage(
-                        vm,
-                        storage_pool_name=vm_storagepool,
-                        disk_mount=f"vd{alphabet_letter[disk_counter]}",
-                        size=vol.get("size"),
-                        image=config.get("services").get(vm).get("image"),
-                        image_pool=iso_storagepool,
-                        debug=args.debug,
-                    )
-                else:
-                    new_vol = BasicStorage(
-                        vm,
-                        storage_pool_name=vm_storagepool,
-                        disk_mount=f"vd{alphabet_letter[disk_counter]}",
-                        size=vol.get("size"),
-                        debug=args.debug,
-                    )
-                new_vol.create()
-                storages.append(new_vol)
-                disk_counter += 1
-
-            # generate networks
-            for net in config.get("services").get(vm).get("networks"):
-                netconfig = config.get("networks").get(net.get("name"))
-                # check if it has external: true
-                if netconfig.get("external", False) :
-                    # dont instantiate the net
-                    # just query the existing net
-                    this_net = VirtNetwork.from_name(net.get("name"))
-                else:
-                    this_net = VirtNetwork(
-                        net.get("name"),
-                        ipcidr=netconfig.get("ipCidr"),
-                        dhcp=netconfig.get("dhcp").get("enabled", False),
-                        dhcp_start=netconfig.get("dhcp").get("start"),
-                        dhcp_end=netconfig.get("dhcp").get("end"),
-                        mode=VirtNetworkMode[netconfig.get("mode").upper()],
-                        domain=netconfig.get("domain", net.get("name")),
-                        debug=args.debug,
-                    )
-
-                this_instancenet = InstanceNetwork(vm, net.get("ipAddr", None), this_net)
-                this_instancenet.create()
-
-                networks.append(this_instancenet)
-
-            # create vms
-            instance = Instance(
-                vm,
-                vcpu=config.get("services").get(vm).get("cpu"),
-                ram=config.get("services").get(vm).get("ram").get("size"),
-                shared_ram=config.get("services").get(vm).get("ram").get("shared"),
-                networks=networks,
-                storages=storages,
-                debug=args.debug,
-            )
-            instance.create()
-            print("==============")
-    
         # store current data
-        freeze_config(config, args.config)
+        write_state(
+            args.config,
+            config.data,
+            macs.get_allocations(),
+            ipam.get_allocations(),
+            placement,
+        )
+
+        if args.wait:
+            print("waiting for vms to boot and get their leases...")
+            instances = [
+                r.obj
+                for r in plan.resources()
+                if r.kind == "domain" and r.obj.exists()
+            ]
+            ready = wait_ready(instances, timeout=args.wait_timeout)
+            ok = print_summary(ready) and ok
+        if not ok:
+            exit(1)
     # end install
 
     # destroy
     elif args.action == "destroy":
-        for vm in config.get("services"):
-            networks: List[VirtNetwork] = []
-            instance_networks: List[InstanceNetwork] = []
-
-            # populate networks
-            for net in config.get("services").get(vm).get("networks"):
-                netconfig = config.get("networks").get(net.get("name"))
-
-                # check if it has external: true
-                if netconfig.get("external", False) :
-                    # dont instantiate the net
-                    this_net = VirtNetwork.from_name(net.get("name"))
-                else:
-                    this_net = VirtNetwork(
-                        net.get("name"),
-                        ipcidr=netconfig.get("ipCidr"),
-                        dhcp=netconfig.get("dhcp").get("enabled", False),
-                        dhcp_start=netconfig.get("dhcp").get("start"),
-                        dhcp_end=netconfig.get("dhcp").get("end"),
-                        mode=VirtNetworkMode[netconfig.get("mode").upper()],
-                        debug=args.debug,
-                        domain=netconfig.get("domain", net.get("name")),
-                    )
-                networks.append(this_net)
-
-                this_instancenet = InstanceNetwork(
-                    vm, net.get("ipAddr"), this_net, debug=args.debug
-                )
-                instance_networks.append(this_instancenet)
-
-            instance = Instance(vm, networks=instance_networks, debug=args.debug)
-            try:
-                print(
-                    f"deleting instance {vm} with delete_storage: {args.delete_storage}"
-                )
-                instance.delete(args.delete_storage)
-            except:
-                print("unable to delete instance and storages, skipping...")
-                if args.debug:
-                    import traceback
-
-                    print(traceback.format_exc())
-
-            print(f"processed {vm}")
-            print("================")
-
         if args.delete_network:
             print("--delete-network flag is supplied, deleting defined networks...")
-            for net in networks:
-                netname = net.get_name()
-                net.delete()
-                print(f">> {netname} successfully deleted.")
-            print("all process done.")
+        # only the addresses this config was given, handing out new ones
+        # here would release reservations of vms that are not ours
+        plan = plan_from_config(
+            ipam.recall(config),
+            debug=args.debug,
+            delete_storage=args.delete_storage,
+            delete_network=args.delete_network,
+            macs=macs,
+            placement=(
+                locate(config, hosts, state.get("hosts"))
+                if is_multi_host(config)
+                else None
+            ),
+        )
+        results = plan.destroy(workers=args.parallel, debug=args.debug)
+        ok = print_summary(plan.summarize_by_vm(results))
+        print("all process done.")
+        if not ok:
+            exit(1)
     # end destroy
 
     # update
     elif args.action == "update":
-        raise NotImplementedError
+        if not state.get("config"):
+            print(f"no state found ({state_filename(args.config)}), run install first")
+            exit(-10)
+        frozen = read_config(state_filename(args.config), data=state.get("config"))
+        if not frozen:
+            exit(-10)
+
+        # diffed with addresses filled in, auto-assigned ones come back
+        # the same from the state
+        managed = set(frozen.services) | set(config.services)
+        reservations = read_reservations(config, list(hosts.values()))
+        frozen = resolve_addresses(ipam, frozen, reservations, managed)
+        resolved = resolve_addresses(ipam, config, reservations, managed)
+        diff = diff_configs(frozen, resolved)
+        diff.show()
+        if diff.is_empty():
+            exit(0)
+
+        # removed vms are torn down where they are, the others keep their
+        # host and new ones are scheduled around them
+        placement = {}
+        if is_multi_host(config):
+            placement = locate(frozen, hosts, state.get("hosts"))
+        placement.update(place_services(resolved, hosts, placement, args))
+
+        teardown, apply = plan_update(
+            frozen,
+            resolved,
+            diff,
+            debug=args.debug,
+            delete_storage=args.delete_storage,
+            iso_backend=args.iso_backend,
+            volume_backend=args.volume_backend,
+            macs=macs,
+            placement=placement,
+        )
+        if not check_capacity(apply, args, hosts):
+            exit(-10)
+        removed = teardown.destroy(workers=args.parallel, debug=args.debug)
+        for vm in diff.removed:
+            macs.release(vm)
+            ipam.release(vm)
+            placement.pop(vm, None)
+        applied = apply.apply(workers=args.parallel, debug=args.debug)
+        ok = print_summary(
+            teardown.summarize_by_vm(removed) + apply.summarize_by_vm(applied)
+        )
+
+        write_state(
+            args.config,
+            config.data,
+            macs.get_allocations(),
+            ipam.get_allocations(),
+            placement,
+        )
+        if not ok:
+            exit(1)
     # end update
 
     else:
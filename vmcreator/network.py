@@ -1,7 +1,11 @@
-from vmcreator.connection import LibvirtConnect
+from vmcreator.config import Config
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect
+from vmcreator.provision import named_lock
+from vmcreator.aio import AsyncMixin
 from abc import abstractmethod, ABC
 from enum import Enum
 import xml.etree.ElementTree as ET
+from vmcreator.tracing import parse_xml, traced
 import ipaddress
 from libvirt import (
     VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
@@ -9,13 +13,15 @@ from libvirt import (
     VIR_NETWORK_UPDATE_COMMAND_DELETE,
     VIR_NETWORK_UPDATE_AFFECT_LIVE,
     VIR_NETWORK_UPDATE_AFFECT_CONFIG,
+    VIR_NETWORK_EVENT_ID_LIFECYCLE,
+    VIR_NETWORK_XML_INACTIVE,
     virNetwork,
+    libvirtError,
 )
 import random
-from pprint import pprint
 
 
-class Network(ABC):
+class Network(AsyncMixin, ABC):
     @abstractmethod
     def create(self):
         pass
@@ -28,6 +34,10 @@ class Network(ABC):
     def get_name(self):
         pass
 
+    @abstractmethod
+    def exists(self) -> bool:
+        pass
+
     @abstractmethod
     def get_network(self) -> object:
         pass
@@ -37,6 +47,63 @@ class Network(ABC):
         pass
 
 
+class ReservationTable:
+    # dhcp host reservations of one network indexed by mac, ip and name
+    def __init__(self, hosts: list = None):
+        self._by_mac = {}
+        self._by_ip = {}
+        self._by_name = {}
+        for host in hosts or []:
+            self.add(host)
+
+    @classmethod
+    def from_xml(cls, xml: str):
+        hosts = []
+        dhcp = parse_xml(xml).find(".//dhcp")
+        if dhcp is not None:
+            for host_elem in dhcp.findall(".//host"):
+                hosts.append(
+                    {
+                        "mac": host_elem.get("mac"),
+                        "name": host_elem.get("name"),
+                        "ip": host_elem.get("ip"),
+                    }
+                )
+        return cls(hosts)
+
+    def add(self, host: dict):
+        host = {"mac": host.get("mac"), "name": host.get("name"), "ip": host.get("ip")}
+        self._by_mac[host["mac"]] = host
+        if host["ip"]:
+            self._by_ip[host["ip"]] = host
+        if host["name"]:
+            self._by_name[host["name"]] = host
+
+    def remove(self, host: dict):
+        host = self._by_mac.pop(host.get("mac"), None)
+        if not host:
+            return
+        if self._by_ip.get(host["ip"]) is host:
+            del self._by_ip[host["ip"]]
+        if self._by_name.get(host["name"]) is host:
+            del self._by_name[host["name"]]
+
+    def by_mac(self, mac: str) -> dict:
+        return self._by_mac.get(mac)
+
+    def by_ip(self, ip: str) -> dict:
+        return self._by_ip.get(ip)
+
+    def by_name(self, name: str) -> dict:
+        return self._by_name.get(name)
+
+    def __iter__(self):
+        return iter(list(self._by_mac.values()))
+
+    def __len__(self):
+        return len(self._by_mac)
+
+
 class VirtNetworkMode(Enum):
     ROUTE = 1
     NAT = 2
@@ -57,7 +124,7 @@ class VirtNetwork(LibvirtConnect, Network):
         netmask: int = None,
         flag=None,
         debug=False,
-        uri: str = "qemu:///system",
+        uri: str = DEFAULT_URI,
     ):
         super(VirtNetwork, self).__init__(uri)
         self._name = name
@@ -81,13 +148,25 @@ class VirtNetwork(LibvirtConnect, Network):
                 VIR_NETWORK_UPDATE_AFFECT_LIVE | VIR_NETWORK_UPDATE_AFFECT_CONFIG
             )
         self._network: virNetwork = None
+        self._reservations: ReservationTable = None
+        self._event_id = None
+        self._pending = []
 
     def get_name(self):
         return self._name
 
+    def exists(self) -> bool:
+        if self._network:
+            return True
+        try:
+            self._network = self.get_connection().networkLookupByName(self._name)
+        except libvirtError:
+            return False
+        return True
+
     @classmethod
-    def from_name(cls, net_name: str):
-        return cls(net_name)
+    def from_name(cls, net_name: str, uri: str = DEFAULT_URI):
+        return cls(net_name, uri=uri)
 
     def _convert_ipcidr(self):
         ip_interface = ipaddress.ip_interface(self._ipcidr)
@@ -103,21 +182,27 @@ class VirtNetwork(LibvirtConnect, Network):
         return self._interfaces
 
     def generate_mac_address(self) -> str:
+        # random fallback when no MacAllocator is given
         initmac_qemu = [0x52, 0x54, 0x00]
-
-        mac = initmac_qemu + [
-            random.randint(0x00, 0xFF),
-            random.randint(0x00, 0xFF),
-            random.randint(0x00, 0xFF),
-        ]
-
-        mac_joined = ":".join(["%02x" % x for x in mac])
-
-        if mac_joined in self.get_all_interfaces():
-            return self.generate_mac_address()
-        return mac_joined
+        used = set(self.get_all_interfaces())
+        if self.exists():
+            used.update(host.get("mac") for host in self.get_leases())
+
+        while True:
+            mac = initmac_qemu + [
+                random.randint(0x00, 0xFF),
+                random.randint(0x00, 0xFF),
+                random.randint(0x00, 0xFF),
+            ]
+            mac_joined = ":".join(["%02x" % x for x in mac])
+            if mac_joined not in used:
+                return mac_joined
 
     def create(self) -> virNetwork:
+        with named_lock("network", self.get_uri(), self._name):
+            return self.__do_create()
+
+    def __do_create(self) -> virNetwork:
         try:
             net = self.get_connection().networkLookupByName(self._name)
             self._network = net
@@ -142,9 +227,19 @@ class VirtNetwork(LibvirtConnect, Network):
 
         netaddr = ""
 
+        # reservations queued before the network exists are defined up
+        # front, dnsmasq starts with them instead of being reloaded per host
+        nethosts = "".join(
+            f"<host mac='{p.get('mac')}' name='{p.get('name')}' ip='{p.get('ip')}'/>"
+            for p in self._pending
+        )
+        self._pending = []
+
         netdhcp = ""
         if self._dhcp:
-            netdhcp = f'<dhcp><range start="{self._dhcp_start}" end="{self._dhcp_end}"/></dhcp>'
+            netdhcp = f'<dhcp><range start="{self._dhcp_start}" end="{self._dhcp_end}"/>{nethosts}</dhcp>'
+        elif nethosts:
+            netdhcp = f"<dhcp>{nethosts}</dhcp>"
 
         netip, netnetmask = self._convert_ipcidr()
         netaddr = f'<ip address="{netip}" netmask="{netnetmask}">{netdhcp}</ip>'
@@ -165,13 +260,11 @@ class VirtNetwork(LibvirtConnect, Network):
         return self._network
 
     def create_lease(self, port):
-        found = False
-        for host in self.get_leases():
-            if port.get("mac") == host.get("mac"):
-                found = True
-                break
+        with named_lock("network", self.get_uri(), self._name):
+            self.__do_create_lease(port)
 
-        if found:
+    def __do_create_lease(self, port):
+        if self.get_reservations().by_mac(port.get("mac")):
             print("lease already exist, skip create new lease")
             return
 
@@ -184,36 +277,161 @@ class VirtNetwork(LibvirtConnect, Network):
             dhcp_entry,
             self._flag,
         )
+        self.get_reservations().add(port)
+
+    def queue_lease(self, port):
+        with named_lock("network", self.get_uri(), self._name):
+            if not any(p.get("mac") == port.get("mac") for p in self._pending):
+                self._pending.append(port)
+
+    def apply_leases(self, dry_run: bool = False) -> int:
+        # applies every queued reservation at once and returns how many
+        # times dnsmasq gets reloaded/restarted for it:
+        # - network not defined yet: defined with the full host list, 0
+        # - inactive, or active without guests attached: redefined once
+        #   (and restarted once when active), 0 or 1
+        # - active with guests attached: one live update per host, N
+        with named_lock("network", self.get_uri(), self._name):
+            exists = self.exists()
+            pending = [
+                p
+                for p in self._pending
+                if not (exists and self.get_reservations().by_mac(p.get("mac")))
+            ]
+            if not pending:
+                self._pending = []
+                return 0
+
+            if not exists:
+                reloads = 0
+                if not dry_run:
+                    self._pending = pending
+                    self.__do_create()
+            elif self.__can_redefine():
+                reloads = 1 if self.get_network().isActive() else 0
+                if not dry_run:
+                    self.__redefine_with(pending)
+            else:
+                reloads = len(pending)
+                if not dry_run:
+                    for port in pending:
+                        self.__do_create_lease(port)
+
+            if not dry_run:
+                self._pending = []
+            print(
+                f"network {self._name}: {len(pending)} reservations, {reloads} dnsmasq reload(s)"
+            )
+            return reloads
+
+    def __can_redefine(self) -> bool:
+        net = self.get_network()
+        if not net.isActive():
+            return True
+        connections = parse_xml(net.XMLDesc(0)).get("connections")
+        return not connections or int(connections) == 0
+
+    def __redefine_with(self, ports: list):
+        root = parse_xml(self.get_network().XMLDesc(VIR_NETWORK_XML_INACTIVE))
+        ip = root.find("ip")
+        if ip is None:
+            raise RuntimeError(f"network {self._name} has no ip to reserve on")
+        dhcp = ip.find("dhcp")
+        if dhcp is None:
+            dhcp = ET.SubElement(ip, "dhcp")
+        for port in ports:
+            ET.SubElement(
+                dhcp,
+                "host",
+                mac=port.get("mac"),
+                name=port.get("name"),
+                ip=port.get("ip"),
+            )
+        self._network = self.get_connection().networkDefineXML(
+            ET.tostring(root, encoding="unicode")
+        )
+        if self._network.isActive():
+            self._network.destroy()
+            self._network.create()
+        for port in ports:
+            self.get_reservations().add(port)
 
     def delete_lease(self, port):
-        for host in self.get_leases():
-            if port.get("mac") != host.get("mac"):
-                continue
-
-            dhcp_entry = f"<host mac='{port.get('mac')}' name='{port.get('name')}' ip='{port.get('ip')}'/>"
-            self.get_network().update(
-                VIR_NETWORK_UPDATE_COMMAND_DELETE,
-                VIR_NETWORK_SECTION_IP_DHCP_HOST,
-                0,
-                dhcp_entry,
-                self._flag,
+        with named_lock("network", self.get_uri(), self._name):
+            self.__do_delete_lease(self.get_reservations().by_mac(port.get("mac")))
+
+    def __do_delete_lease(self, host):
+        if not host:
+            return
+        dhcp_entry = f"<host mac='{host.get('mac')}' name='{host.get('name')}' ip='{host.get('ip')}'/>"
+        self.get_network().update(
+            VIR_NETWORK_UPDATE_COMMAND_DELETE,
+            VIR_NETWORK_SECTION_IP_DHCP_HOST,
+            0,
+            dhcp_entry,
+            self._flag,
+        )
+        self.get_reservations().remove(host)
+
+    def delete_leases(self, ports: list):
+        # a whole batch of ports against one reservation table, ports are
+        # matched on ip, or on name when they have no ip. a host is only
+        # deleted when it carries the port's name or mac, a stale address
+        # must not take another vm's reservation with it
+        with named_lock("network", self.get_uri(), self._name):
+            table = self.get_reservations()
+            for port in ports:
+                if port.get("ip"):
+                    host = table.by_ip(port.get("ip"))
+                else:
+                    host = table.by_name(port.get("name"))
+                if not host:
+                    continue
+                if not self.__is_port_of(host, port):
+                    print(f"warning: lease {host} is not {port.get('name')}'s, kept")
+                    continue
+                self.__do_delete_lease(host)
+                print(f"deleted lease: {host}")
+
+    @staticmethod
+    def __is_port_of(host: dict, port: dict) -> bool:
+        if host.get("name") == port.get("name"):
+            return True
+        mac = port.get("mac")
+        return bool(mac) and (host.get("mac") or "").lower() == mac.lower()
+
+    def get_reservations(self) -> "ReservationTable":
+        # parsed once from the network xml, then kept in sync with every
+        # update() issued here. network lifecycle events (redefine, restart
+        # from outside) drop it so the next access reloads
+        with named_lock("network", self.get_uri(), self._name):
+            if self._reservations is None:
+                self._reservations = ReservationTable.from_xml(
+                    self.get_network().XMLDesc(0)
+                )
+                self.__watch_lifecycle()
+            return self._reservations
+
+    def invalidate_reservations(self):
+        self._reservations = None
+
+    def __watch_lifecycle(self):
+        if self._event_id is not None:
+            return
+        try:
+            self._event_id = self.get_connection().networkEventRegisterAny(
+                self.get_network(),
+                VIR_NETWORK_EVENT_ID_LIFECYCLE,
+                lambda conn, net, event, detail, opaque: self.invalidate_reservations(),
+                None,
             )
+        except libvirtError:
+            # no event loop registered, nothing will invalidate the table
+            # behind our back within this run anyway
+            self._event_id = -1
 
     def get_leases(self) -> list:
-        hosts = []
-        # cek = self.get_network().XMLDesc()
-        # pprint(cek)
-        root = ET.fromstring(self.get_network().XMLDesc(0))
-        dhcp = root.find(".//dhcp")
-        if dhcp is not None:
-            for host_elem in dhcp.findall(".//host"):
-                host = {
-                    "mac": host_elem.get("mac"),
-                    "name": host_elem.get("name"),
-                    "ip": host_elem.get("ip"),
-                }
-                hosts.append(host)
-        return hosts
+        return list(self.get_reservations())
 
     def get_network(self) -> virNetwork:
         if self._network:
@@ -229,29 +447,43 @@ class VirtNetwork(LibvirtConnect, Network):
         return mac
 
     def get_host_lease(self, hostname=None, ip=None):
-        if hostname:
-            for host in self.get_leases():
-                if host.get("hostname") != hostname:
-                    continue
-                return host
+        if not self.exists():
+            return None
         if ip:
-            for host in self.get_leases():
-                if host.get("ip") != ip:
-                    continue
-                return host
+            return self.get_reservations().by_ip(ip)
+        if hostname:
+            return self.get_reservations().by_name(hostname)
         return None
 
     def delete(self):
+        if self._event_id is not None and self._event_id >= 0:
+            try:
+                self.get_connection().networkEventDeregisterAny(self._event_id)
+            except libvirtError:
+                pass
+        self._event_id = None
         self.get_network().destroy()
         self.get_network().undefine()
+        self._network = None
+        self._reservations = None
 
 
 class InstanceNetwork(Network):
-    def __init__(self, vm_name: str, ipaddress: str, network: VirtNetwork, debug=False):
+    def __init__(
+        self,
+        vm_name: str,
+        ipaddress: str,
+        network: VirtNetwork,
+        index: int = 0,
+        macs=None,
+        debug=False,
+    ):
         super()
         self._network = network
         self._vm_name = vm_name
         self._ipaddress = ipaddress
+        self._index = index
+        self._macs = macs
         self._mac = None
         self._debug = debug
 
@@ -262,6 +494,13 @@ class InstanceNetwork(Network):
         self._network.create_lease(port)
         print(port)
 
+    def queue(self):
+        # bulk variant of create(), applied by VirtNetwork.apply_leases()
+        if not self._ipaddress:
+            return
+        port = {"name": self._vm_name, "ip": self._ipaddress, "mac": self.get_mac()}
+        self._network.queue_lease(port)
+
     def get_name(self):
         return self._network.get_name()
 
@@ -275,18 +514,52 @@ class InstanceNetwork(Network):
         )
         if host_lease:
             self._mac = host_lease.get("mac")
+            if self._macs:
+                self._macs.claim(
+                    self._vm_name, self.get_name(), self._index, self._mac
+                )
             return self._mac
 
         # create mac
-        self._mac = self._network.generate_mac_address()
+        if self._macs:
+            self._mac = self._macs.allocate(
+                self._vm_name, self.get_name(), self._index
+            )
+        else:
+            self._mac = self._network.generate_mac_address()
         return self._mac
 
     def get_network(self) -> VirtNetwork:
         return self._network
 
+    def get_ip(self) -> str:
+        return self._ipaddress
+
+    def exists(self) -> bool:
+        # the dhcp reservation is on the network, a nic without an address
+        # has nothing to reserve
+        if not self._ipaddress:
+            return True
+        lease = self._network.get_host_lease(ip=self._ipaddress)
+        return lease is not None and lease.get("name") == self._vm_name
+
     def delete(self):
-        if self._ipaddress:
-            port = {"name": self._vm_name, "ip": self._ipaddress, "mac": self.get_mac()}
-            self._network.delete_lease(port)
+        if not self._ipaddress:
+            return
+        port = {"name": self._vm_name, "ip": self._ipaddress, "mac": self.get_mac()}
+        self._network.delete_lease(port)
         self._mac = None
         print(f"deleted port: {port}")
+
+
+@traced("reservations")
+def read_reservations(config: Config, uris: list = None) -> dict:
+    # dhcp hosts already defined on the networks of config, read only. a
+    # network name spans all hosts, so do its addresses
+    reservations = {}
+    for name in config.networks:
+        for uri in uris or [DEFAULT_URI]:
+            net = VirtNetwork.from_name(name, uri=uri)
+            if net.exists():
+                reservations.setdefault(name, []).extend(net.get_leases())
+    return reservations
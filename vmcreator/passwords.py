@@ -0,0 +1,86 @@
+import crypt
+import hashlib
+import hmac
+import json
+import os
+import threading
+from vmcreator.cache import DEFAULT_CACHE_DIR
+
+SALT_ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+DEFAULT_SECRET_FILE = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")),
+    "vmcreator",
+    "secret",
+)
+
+
+def _write_private(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class PasswordHasher:
+    # sha512-crypt is slow on purpose. every distinct (user, password) is
+    # hashed once per run, with a salt derived from a local secret so the
+    # hash (and the cloud-init iso built from it) is stable between runs
+    def __init__(self, secret: str = None, store_path: str = None):
+        self._secret = secret
+        self._store_path = store_path or os.path.join(
+            DEFAULT_CACHE_DIR, "passwords.json"
+        )
+        self._lock = threading.Lock()
+        self._memo = None
+
+    def _get_secret(self) -> bytes:
+        if self._secret is None:
+            self._secret = os.environ.get("VMCREATOR_SECRET")
+        if self._secret is None:
+            try:
+                with open(DEFAULT_SECRET_FILE) as f:
+                    self._secret = f.read().strip()
+            except OSError:
+                self._secret = os.urandom(32).hex()
+                _write_private(DEFAULT_SECRET_FILE, self._secret)
+        return self._secret.encode()
+
+    def _load(self) -> dict:
+        if self._memo is None:
+            try:
+                with open(self._store_path) as f:
+                    self._memo = json.load(f)
+            except (OSError, ValueError):
+                self._memo = {}
+        return self._memo
+
+    def _key(self, user: str, password: str) -> bytes:
+        return hmac.new(
+            self._get_secret(),
+            f"{user}\0{password}".encode(),
+            hashlib.sha256,
+        ).digest()
+
+    def salt(self, user: str, password: str) -> str:
+        key = self._key(user, password)
+        return "".join(SALT_ALPHABET[b % len(SALT_ALPHABET)] for b in key[:16])
+
+    def hash(self, user: str, password: str) -> str:
+        with self._lock:
+            memo_key = self._key(user, password).hex()
+            hashed = self._load().get(memo_key)
+            if hashed is None:
+                hashed = crypt.crypt(
+                    password, f"$6${self.salt(user, password)}"
+                )
+                self._memo[memo_key] = hashed
+                try:
+                    _write_private(self._store_path, json.dumps(self._memo))
+                except OSError as e:
+                    print(f"unable to persist password hashes: {e}")
+            return hashed
+
+
+password_hasher = PasswordHasher()
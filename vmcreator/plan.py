@@ -0,0 +1,204 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List
+from vmcreator.provision import ProvisionResult, PrefixedOutput, run_one
+from vmcreator.tracing import tracer, traced
+
+
+class Resource:
+    def __init__(
+        self,
+        kind: str,
+        name: str,
+        create: Callable = None,
+        destroy: Callable = None,
+        vm: str = None,
+        obj=None,
+        host: str = None,
+    ):
+        self.kind = kind
+        self.name = name
+        self.create = create
+        self.destroy = destroy
+        self.vm = vm
+        self.obj = obj
+        self.host = host
+        self.deps = set()
+
+    @property
+    def key(self):
+        return (self.kind, self.name)
+
+    def label(self):
+        return f"{self.kind}:{self.name}"
+
+
+class Plan:
+    def __init__(self):
+        self._resources: Dict[tuple, Resource] = {}
+
+    def add(
+        self,
+        kind: str,
+        name: str,
+        create: Callable = None,
+        destroy: Callable = None,
+        deps: List[Resource] = None,
+        vm: str = None,
+        obj=None,
+        host: str = None,
+    ) -> Resource:
+        # resources are deduplicated by (kind, name), the first definition wins
+        resource = self._resources.get((kind, name))
+        if resource is None:
+            resource = Resource(
+                kind, name, create=create, destroy=destroy, vm=vm, obj=obj, host=host
+            )
+            self._resources[resource.key] = resource
+        for dep in deps or []:
+            resource.deps.add(dep.key)
+        return resource
+
+    def get(self, kind: str, name: str) -> Resource:
+        return self._resources.get((kind, name))
+
+    def resources(self) -> List[Resource]:
+        return list(self._resources.values())
+
+    def __len__(self):
+        return len(self._resources)
+
+    def topological_order(self) -> List[Resource]:
+        order = []
+        state = {}
+
+        def visit(key, path):
+            if state.get(key) == "done":
+                return
+            if state.get(key) == "visiting":
+                cycle = " -> ".join(f"{k[0]}:{k[1]}" for k in path + [key])
+                raise ValueError(f"dependency cycle: {cycle}")
+            state[key] = "visiting"
+            for dep in sorted(self._resources[key].deps):
+                visit(dep, path + [key])
+            state[key] = "done"
+            order.append(self._resources[key])
+
+        for key in self._resources:
+            visit(key, [])
+        return order
+
+    def _graph(self, reverse: bool):
+        # edges point from a resource to the ones waiting for it
+        waiting = {key: set() for key in self._resources}
+        blockers = {key: set() for key in self._resources}
+        for resource in self._resources.values():
+            for dep in resource.deps:
+                if dep not in self._resources:
+                    raise KeyError(f"{resource.label()} depends on unknown {dep}")
+                if reverse:
+                    waiting[resource.key].add(dep)
+                    blockers[dep].add(resource.key)
+                else:
+                    waiting[dep].add(resource.key)
+                    blockers[resource.key].add(dep)
+        return waiting, blockers
+
+    def _execute(self, action: str, workers: int, debug: bool) -> List[ProvisionResult]:
+        # workers is per host, hosts are provisioned side by side
+        self.topological_order()  # fail early on cycles
+        waiting, blockers = self._graph(reverse=action == "destroy")
+        remaining = {key: len(deps) for key, deps in blockers.items()}
+        ready = [key for key, count in remaining.items() if count == 0]
+        results: Dict[tuple, ProvisionResult] = {}
+        workers = max(1, workers)
+        hosts = {r.host for r in self._resources.values()}
+        busy = {host: 0 for host in hosts}
+
+        def skip(key, reason):
+            # a failed resource blocks everything that depends on it
+            if key in results:
+                return
+            results[key] = ProvisionResult(
+                self._resources[key].label(), False, 0.0, reason
+            )
+            for nxt in waiting[key]:
+                skip(nxt, reason)
+
+        def task(resource):
+            func = getattr(resource, action)
+            if func is None:
+                return ProvisionResult(resource.label(), True, 0.0)
+            with tracer.span(
+                resource.label(),
+                "resource",
+                resource=resource.label(),
+                vm=resource.vm,
+                host=resource.host,
+                action=action,
+            ):
+                result = run_one(resource.label(), func, output, debug)
+                tracer.annotate(ok=result.ok)
+            return result
+
+        output = None
+        if workers * len(hosts) > 1:
+            output = PrefixedOutput(sys.stdout)
+            sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=workers * len(hosts)) as executor:
+                running = {}
+                while ready or running:
+                    deferred = []
+                    for key in ready:
+                        if key in results:
+                            continue
+                        host = self._resources[key].host
+                        if busy[host] >= workers:
+                            deferred.append(key)
+                            continue
+                        busy[host] += 1
+                        future = executor.submit(task, self._resources[key])
+                        running[future] = key
+                    ready = deferred
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key = running.pop(future)
+                        busy[self._resources[key].host] -= 1
+                        result = future.result()
+                        results[key] = result
+                        if not result.ok:
+                            for nxt in waiting[key]:
+                                skip(nxt, f"{result.name} failed")
+                            continue
+                        for nxt in waiting[key]:
+                            remaining[nxt] -= 1
+                            if remaining[nxt] == 0 and nxt not in results:
+                                ready.append(nxt)
+        finally:
+            if output:
+                sys.stdout = output._stream
+
+        return [results[key] for key in self._resources if key in results]
+
+    @traced("apply")
+    def apply(self, workers: int = 1, debug: bool = False) -> List[ProvisionResult]:
+        return self._execute("create", workers, debug)
+
+    @traced("destroy")
+    def destroy(self, workers: int = 1, debug: bool = False) -> List[ProvisionResult]:
+        return self._execute("destroy", workers, debug)
+
+    def summarize_by_vm(self, results: List[ProvisionResult]) -> List[ProvisionResult]:
+        by_label = {r.label(): r for r in self._resources.values()}
+        grouped: Dict[str, ProvisionResult] = {}
+        for result in results:
+            vm = by_label[result.name].vm or "shared"
+            summary = grouped.setdefault(vm, ProvisionResult(vm, True, 0.0))
+            summary.elapsed += result.elapsed
+            if not result.ok and summary.ok:
+                summary.ok = False
+                summary.error = f"{result.name}: {result.error}"
+        return list(grouped.values())
@@ -0,0 +1,359 @@
+import string
+from typing import Callable, Dict
+from vmcreator.instance import Instance
+from vmcreator.network import InstanceNetwork, VirtNetwork, VirtNetworkMode
+from vmcreator.mac import MacAllocator
+from vmcreator.storage import RootStorage, BasicStorage, Cloudinit
+from vmcreator.backing import GoldenLayer
+from vmcreator.config import Config, ServiceConfig, nic_key
+from vmcreator.scheduler import get_hosts, is_multi_host
+from vmcreator.plan import Plan
+from vmcreator.tracing import traced
+
+
+def dry_run(plan: Plan) -> int:
+    # prints what would be done and the resulting dnsmasq reloads, the only
+    # thing run is the (read only) lease queueing
+    print("plan:")
+    for resource in plan.topological_order():
+        print(f"  {resource.label()}")
+    for resource in plan.resources():
+        if resource.kind == "lease":
+            resource.create()
+    reloads = 0
+    for resource in plan.resources():
+        if resource.kind == "network":
+            reloads += resource.obj.apply_leases(dry_run=True)
+    print(f"{len(plan)} resources, {reloads} dnsmasq reload(s)")
+    return reloads
+
+
+def _build_network(name, config: Config, debug=False, uri=None) -> VirtNetwork:
+    netconfig = config.networks[name]
+    uri = uri or next(iter(get_hosts(config).values()))
+    # check if it has external: true
+    if netconfig.external:
+        # dont instantiate the net
+        # just query the existing net
+        return VirtNetwork.from_name(name, uri=uri)
+    return VirtNetwork(
+        name,
+        ipcidr=netconfig.ipcidr,
+        dhcp=netconfig.dhcp,
+        dhcp_start=netconfig.dhcp_start,
+        dhcp_end=netconfig.dhcp_end,
+        mode=VirtNetworkMode[netconfig.mode.upper()],
+        domain=netconfig.domain,
+        debug=debug,
+        uri=uri,
+    )
+
+
+def _destroy_if_exists(resource):
+    def destroy():
+        if not resource.exists():
+            print(f"{resource.get_volume_name()} not found, skipping")
+            return
+        print(f"deleting storage: {resource.get_volume_name()}")
+        resource.delete()
+
+    return destroy
+
+
+def _destroy_network(net: VirtNetwork):
+    def destroy():
+        if not net.exists():
+            print(f"network {net.get_name()} not found, skipping")
+            return
+        net.delete()
+        print(f">> {net.get_name()} successfully deleted.")
+
+    return destroy
+
+
+def _destroy_leases(net: VirtNetwork, ports: list):
+    def destroy():
+        if not ports or not net.exists():
+            return
+        net.delete_leases(ports)
+
+    return destroy
+
+
+def _destroy_instance(instance: Instance):
+    def destroy():
+        if not instance.exists():
+            print(f"instance {instance.get_name()} not found, skipping")
+            return
+        instance.destroy_domain()
+        print(f"instance {instance.get_name()} deleted")
+
+    return destroy
+
+
+def _check_backing(lookup: Callable, image: str):
+    def create():
+        lookup()
+        print(f"base image {image} found")
+
+    return create
+
+
+def _destroy_layer(layer: GoldenLayer):
+    def destroy():
+        if not layer.exists():
+            return
+        if layer.refcount():
+            print(
+                f"golden layer {layer.get_volume_name()} still used by {layer.refcount()} overlays, keeping it"
+            )
+            return
+        print(f"deleting unused golden layer {layer.get_volume_name()}")
+        layer.delete()
+
+    return destroy
+
+
+def layer_config_image(config: Config, service: ServiceConfig) -> str:
+    return config.layers[service.layer].image or service.image
+
+
+@traced("plan")
+def plan_from_config(
+    config: Config,
+    debug: bool = False,
+    delete_storage: bool = False,
+    delete_network: bool = False,
+    iso_backend: str = "python",
+    volume_backend: str = "libvirt",
+    macs: MacAllocator = None,
+    placement: Dict[str, str] = None,
+) -> Plan:
+    # placement: {vm: host name} from the scheduler, networks, layers and
+    # base images are then planned once per host they are needed on
+    plan = Plan()
+    vm_storagepool = config.libvirt.vm_pool
+    iso_storagepool = config.libvirt.iso_pool
+    hosts = get_hosts(config)
+    multi = is_multi_host(config)
+
+    networks: Dict[tuple, VirtNetwork] = {}
+    layers: Dict[tuple, GoldenLayer] = {}
+    released_ports: Dict[str, list] = {}
+
+    for vm, service in config.services.items():
+        domain_deps = []
+        host = (placement or {}).get(vm) or next(iter(hosts))
+        uri = hosts[host]
+
+        def at(name):
+            # shared resources exist once per host
+            return f"{host}:{name}" if multi else name
+
+        # cloudinit
+        cloudinit = Cloudinit(
+            vm_name=vm,
+            storage_pool_name=vm_storagepool,
+            config=service.raw,
+            iso_backend=iso_backend,
+            debug=debug,
+            uri=uri,
+        )
+        storages = [cloudinit]
+        domain_deps.append(
+            plan.add(
+                "cloudinit",
+                cloudinit.get_volume_name(),
+                create=cloudinit.create,
+                destroy=_destroy_if_exists(cloudinit) if delete_storage else None,
+                vm=vm,
+                obj=cloudinit,
+                host=host,
+            )
+        )
+
+        # golden layer the root disk is based on, if any
+        layer = None
+        layer_deps = []
+        if service.layer:
+            layer_name = service.layer
+            if (host, layer_name) not in layers:
+                layer_config = config.layers[layer_name]
+                if not layer_config.image:
+                    layer_config = layer_config.replace(image=service.image)
+                layers[(host, layer_name)] = GoldenLayer.from_config(
+                    layer_config,
+                    iso_storagepool,
+                    volume_backend=volume_backend,
+                    debug=debug,
+                    uri=uri,
+                )
+            layer = layers[(host, layer_name)]
+            layer_image = layer_config_image(config, service)
+            base = plan.add(
+                "backing",
+                at(f"{iso_storagepool}/{layer_image}"),
+                create=_check_backing(layer.get_base_volume, layer_image),
+                host=host,
+            )
+            layer_deps.append(
+                plan.add(
+                    "layer",
+                    at(layer.get_volume_name()),
+                    create=layer.create,
+                    destroy=_destroy_layer(layer) if delete_storage else None,
+                    deps=[base],
+                    obj=layer,
+                    host=host,
+                )
+            )
+
+        # vm disks
+        disk_counter = 0
+        alphabet_letter = string.ascii_lowercase
+        for vol in service.volumes:
+            if vol.type == "root":
+                new_vol = RootStorage(
+                    vm,
+                    storage_pool_name=vm_storagepool,
+                    disk_mount=f"vd{alphabet_letter[disk_counter]}",
+                    size=vol.size,
+                    image=service.image,
+                    image_pool=iso_storagepool,
+                    volume_backend=volume_backend,
+                    layer=layer,
+                    debug=debug,
+                    uri=uri,
+                )
+                if layer:
+                    vol_deps = layer_deps
+                else:
+                    vol_deps = [
+                        plan.add(
+                            "backing",
+                            at(f"{iso_storagepool}/{service.image}"),
+                            create=_check_backing(
+                                new_vol.get_backing_volume, service.image
+                            ),
+                            host=host,
+                        )
+                    ]
+            else:
+                new_vol = BasicStorage(
+                    vm,
+                    storage_pool_name=vm_storagepool,
+                    disk_mount=f"vd{alphabet_letter[disk_counter]}",
+                    size=vol.size,
+                    volume_backend=volume_backend,
+                    debug=debug,
+                    uri=uri,
+                )
+                vol_deps = []
+            storages.append(new_vol)
+            domain_deps.append(
+                plan.add(
+                    "volume",
+                    new_vol.get_volume_name(),
+                    create=new_vol.create,
+                    destroy=_destroy_if_exists(new_vol) if delete_storage else None,
+                    deps=vol_deps,
+                    vm=vm,
+                    obj=new_vol,
+                    host=host,
+                )
+            )
+            disk_counter += 1
+
+        # networks and dhcp reservations
+        instance_networks = []
+        for nic in service.networks:
+            netname = nic.network
+            if (host, netname) not in networks:
+                networks[(host, netname)] = _build_network(
+                    netname, config, debug=debug, uri=uri
+                )
+            this_net = networks[(host, netname)]
+            external = config.networks[netname].external
+            net_resource = plan.add(
+                "network",
+                at(netname),
+                create=this_net.get_network,
+                destroy=(
+                    _destroy_network(this_net)
+                    if delete_network and not external
+                    else None
+                ),
+                obj=this_net,
+                host=host,
+            )
+            # dhcp reservations of all vms on a network are applied in one
+            # go: every lease is queued first, a new network is defined with
+            # the whole host list, an existing one gets a single apply.
+            # teardown releases them in one pass, unless the network itself
+            # goes away
+            ports = released_ports.setdefault(at(netname), [])
+            dhcp_resource = plan.add(
+                "dhcp",
+                at(netname),
+                create=this_net.apply_leases,
+                destroy=(
+                    None
+                    if delete_network and not external
+                    else _destroy_leases(this_net, ports)
+                ),
+                deps=[net_resource],
+                host=host,
+            )
+            if nic.ip:
+                ports.append(
+                    {
+                        "name": vm,
+                        "ip": nic.ip,
+                        "mac": macs.lookup(vm, netname, nic.index) if macs else None,
+                    }
+                )
+
+            this_instancenet = InstanceNetwork(
+                vm,
+                nic.ip,
+                this_net,
+                index=nic.index,
+                macs=macs,
+                debug=debug,
+            )
+            instance_networks.append(this_instancenet)
+            lease_resource = plan.add(
+                "lease",
+                nic_key(vm, netname, nic.index),
+                create=this_instancenet.queue,
+                vm=vm,
+                obj=this_instancenet,
+                host=host,
+            )
+            plan.add("network", at(netname), deps=[lease_resource])
+            domain_deps += [lease_resource, dhcp_resource]
+
+        instance = Instance(
+            vm,
+            vcpu=service.cpu,
+            ram=service.ram,
+            shared_ram=service.shared_ram,
+            networks=instance_networks,
+            storages=storages,
+            profile=service.profile,
+            tuning=service.tuning,
+            debug=debug,
+            uri=uri,
+        )
+        plan.add(
+            "domain",
+            vm,
+            create=instance.create,
+            destroy=_destroy_instance(instance),
+            deps=domain_deps,
+            vm=vm,
+            obj=instance,
+            host=host,
+        )
+
+    return plan
@@ -0,0 +1,97 @@
+import threading
+from libvirt import virStoragePool, virStorageVol
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect
+from vmcreator.tracing import parse_xml
+
+
+class StoragePoolManager(LibvirtConnect):
+    # one per (uri, pool): keeps a name -> volume index so lookups don't
+    # round-trip to libvirtd, and coalesces pool refreshes. a refresh is only
+    # needed for files created behind libvirt's back (qemu-img, copies),
+    # volumes created/deleted through the API are tracked directly
+    def __init__(self, name: str, uri: str = DEFAULT_URI):
+        super(StoragePoolManager, self).__init__(uri)
+        self._name = name
+        self._lock = threading.RLock()
+        self._pool: virStoragePool = None
+        self._path = None
+        self._type = None
+        self._index = None
+        self._dirty = False
+        self._refreshes = 0
+
+    def get_pool(self) -> virStoragePool:
+        if self._pool is None:
+            print(f"storage pool: {self._name}")
+            self._pool = self.get_connection().storagePoolLookupByName(self._name)
+        return self._pool
+
+    def _load_xml(self):
+        xml_tree = parse_xml(self.get_pool().XMLDesc())
+        self._type = xml_tree.get("type")
+        self._path = xml_tree.find(".//target/path").text
+
+    def get_path(self) -> str:
+        if self._path is None:
+            self._load_xml()
+        return self._path
+
+    def get_type(self) -> str:
+        if self._type is None:
+            self._load_xml()
+        return self._type
+
+    def _load_index(self):
+        self._index = {vol.name(): vol for vol in self.get_pool().listAllVolumes()}
+
+    def refresh(self):
+        with self._lock:
+            self.get_pool().refresh()
+            self._refreshes += 1
+            self._dirty = False
+            self._load_index()
+
+    def mark_dirty(self):
+        # something was written into the pool directory without libvirt,
+        # the next lookup miss triggers a (single) refresh
+        with self._lock:
+            self._dirty = True
+
+    def lookup(self, name: str) -> virStorageVol:
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            vol = self._index.get(name)
+            if vol is None and self._dirty:
+                self.refresh()
+                vol = self._index.get(name)
+            return vol
+
+    def register(self, vol: virStorageVol):
+        with self._lock:
+            if self._index is not None:
+                self._index[vol.name()] = vol
+
+    def forget(self, name: str):
+        with self._lock:
+            if self._index is not None:
+                self._index.pop(name, None)
+
+    def create_volume(self, xml: str) -> virStorageVol:
+        vol = self.get_pool().createXML(xml, 0)
+        self.register(vol)
+        return vol
+
+    def get_refresh_count(self) -> int:
+        return self._refreshes
+
+
+_managers = {}
+_managers_guard = threading.Lock()
+
+
+def get_pool_manager(name: str, uri: str = DEFAULT_URI) -> StoragePoolManager:
+    with _managers_guard:
+        if (uri, name) not in _managers:
+            _managers[(uri, name)] = StoragePoolManager(name, uri=uri)
+        return _managers[(uri, name)]
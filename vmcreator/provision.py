@@ -0,0 +1,91 @@
+import time
+import threading
+import traceback
+from typing import Callable, List
+
+
+_named_locks = {}
+_named_locks_guard = threading.Lock()
+
+
+def named_lock(*key) -> threading.RLock:
+    # serializes work on a shared resource (network, storage pool) between
+    # parallel vm pipelines
+    with _named_locks_guard:
+        if key not in _named_locks:
+            _named_locks[key] = threading.RLock()
+        return _named_locks[key]
+
+
+class ProvisionResult:
+    def __init__(self, name: str, ok: bool, elapsed: float, error: str = None):
+        self.name = name
+        self.ok = ok
+        self.elapsed = elapsed
+        self.error = error
+
+
+class PrefixedOutput:
+    # per-thread line buffering so output of parallel workers does not
+    # interleave mid-line, every line is tagged with the worker's vm name
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self._local.prefix = prefix
+        self._local.buffer = ""
+
+    def write(self, data):
+        prefix = getattr(self._local, "prefix", None)
+        if prefix is None:
+            return self._stream.write(data)
+        self._local.buffer += data
+        while "\n" in self._local.buffer:
+            line, self._local.buffer = self._local.buffer.split("\n", 1)
+            with self._lock:
+                self._stream.write(f"[{prefix}] {line}\n")
+        return len(data)
+
+    def flush(self):
+        prefix = getattr(self._local, "prefix", None)
+        if prefix is not None and self._local.buffer:
+            with self._lock:
+                self._stream.write(f"[{prefix}] {self._local.buffer}\n")
+            self._local.buffer = ""
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def run_one(name: str, func: Callable, output: PrefixedOutput, debug: bool):
+    if output:
+        output.set_prefix(name)
+    start = time.monotonic()
+    try:
+        func()
+        result = ProvisionResult(name, True, time.monotonic() - start)
+    except (Exception, SystemExit) as e:
+        # exit() of a failing step fails that resource, ctrl-c stops the run
+        error = str(e) or e.__class__.__name__
+        print(f"failed: {error}")
+        if debug:
+            print(traceback.format_exc())
+        result = ProvisionResult(name, False, time.monotonic() - start, error)
+    finally:
+        if output:
+            output.flush()
+            output.set_prefix(None)
+    return result
+
+
+def print_summary(results: List[ProvisionResult]):
+    print("summary:")
+    for result in results:
+        status = "ok" if result.ok else f"FAILED ({result.error})"
+        print(f"  {result.name}: {status} in {result.elapsed:.1f}s")
+    failed = [r for r in results if not r.ok]
+    print(f"{len(results) - len(failed)}/{len(results)} succeeded.")
+    return not failed
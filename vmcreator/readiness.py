@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+from typing import List
+import libvirt
+from libvirt import (
+    VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+    VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
+    VIR_DOMAIN_EVENT_STARTED,
+    VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED,
+    libvirtError,
+    virNetwork,
+)
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect
+from vmcreator.instance import Instance
+from vmcreator.provision import ProvisionResult
+from vmcreator.tracing import traced
+
+# first and max delay between two DHCPLeases() calls of a network
+LEASE_RECHECK = 0.5
+LEASE_RECHECK_MAX = 8.0
+
+_event_thread = None
+_event_guard = threading.Lock()
+
+
+def start_event_loop():
+    # libvirt only delivers events with an event loop implementation
+    # registered *before* connections are opened, it runs in its own thread
+    global _event_thread
+    with _event_guard:
+        if _event_thread is not None:
+            return
+
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_thread = threading.Thread(target=run, name="libvirt-events", daemon=True)
+        _event_thread.start()
+
+
+class LeaseWatcher:
+    # libvirt has no dhcp lease event: the leases of a network are read in
+    # one DHCPLeases() call for every vm waiting on it, again only after a
+    # growing delay or when a domain/agent event says a guest got further
+    def __init__(self, network: virNetwork):
+        self._network = network
+        self._waiting = {}
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def expect(self, mac: str, ip: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[mac.lower()] = (ip, future)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.__run())
+        return future
+
+    def poke(self):
+        self._wake.set()
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        delay = LEASE_RECHECK
+        while self._waiting:
+            leases = await loop.run_in_executor(None, self._network.DHCPLeases)
+            found = False
+            for lease in leases:
+                waiter = self._waiting.get((lease.get("mac") or "").lower())
+                if waiter and waiter[0] in (None, lease.get("ipaddr")):
+                    del self._waiting[lease.get("mac").lower()]
+                    if not waiter[1].done():
+                        waiter[1].set_result(lease.get("ipaddr"))
+                    found = True
+            delay = LEASE_RECHECK if found else min(delay * 2, LEASE_RECHECK_MAX)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        self._task = None
+
+
+class _Waiting:
+    def __init__(self, instance: Instance):
+        self.instance = instance
+        self.started = asyncio.Event()
+        self.agent = asyncio.Event()
+        self.times = {}
+
+
+class ReadinessWaiter(LibvirtConnect):
+    # blocks until the given vms run and every nic with a reserved address
+    # holds its lease. domain start and guest agent connect come from
+    # libvirt events (start_event_loop() has to be called first)
+    def __init__(self, timeout: float = 300, uri: str = DEFAULT_URI):
+        super(ReadinessWaiter, self).__init__(uri)
+        self._timeout = timeout
+
+    def wait(self, instances: List[Instance]) -> List[ProvisionResult]:
+        return asyncio.run(self.await_ready(instances))
+
+    async def await_ready(self, instances: List[Instance]) -> List[ProvisionResult]:
+        loop = asyncio.get_running_loop()
+        conn = self.get_connection()
+        waiting = {i.get_name(): _Waiting(i) for i in instances}
+        watchers = {}
+
+        def poke_all():
+            for watcher in watchers.values():
+                watcher.poke()
+
+        def on_lifecycle(conn, dom, event, detail, opaque):
+            entry = waiting.get(dom.name())
+            if entry and event == VIR_DOMAIN_EVENT_STARTED:
+                loop.call_soon_threadsafe(entry.started.set)
+
+        def on_agent(conn, dom, state, reason, opaque):
+            entry = waiting.get(dom.name())
+            if entry and state == VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
+                loop.call_soon_threadsafe(entry.agent.set)
+                loop.call_soon_threadsafe(poke_all)
+
+        callbacks = [
+            conn.domainEventRegisterAny(
+                None, VIR_DOMAIN_EVENT_ID_LIFECYCLE, on_lifecycle, None
+            ),
+            conn.domainEventRegisterAny(
+                None, VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, on_agent, None
+            ),
+        ]
+        try:
+            # domains that were already running when we subscribed
+            for entry in waiting.values():
+                if entry.instance.get_instance().isActive():
+                    entry.started.set()
+            return await asyncio.gather(
+                *(self.__wait_one(entry, watchers) for entry in waiting.values())
+            )
+        finally:
+            for callback in callbacks:
+                try:
+                    conn.domainEventDeregisterAny(callback)
+                except libvirtError:
+                    pass
+
+    async def __wait_one(self, entry: _Waiting, watchers: dict) -> ProvisionResult:
+        name = entry.instance.get_name()
+        start = entry.instance.get_started_at() or time.monotonic()
+        stage = "domain start"
+
+        async def agent():
+            await entry.agent.wait()
+            entry.times["agent"] = time.monotonic() - start
+
+        async def ready():
+            nonlocal stage
+            await entry.started.wait()
+            entry.times["running"] = time.monotonic() - start
+
+            stage = "dhcp lease"
+            leases = []
+            for nic in entry.instance.get_networks():
+                if not nic.get_ip():
+                    continue
+                network = nic.get_network()
+                if network.get_name() not in watchers:
+                    watchers[network.get_name()] = LeaseWatcher(network.get_network())
+                leases.append(
+                    watchers[network.get_name()].expect(nic.get_mac(), nic.get_ip())
+                )
+            ips = await asyncio.gather(*leases)
+            entry.times["ip"] = time.monotonic() - start
+            return ips
+
+        agent_task = asyncio.ensure_future(agent())
+        try:
+            ips = await asyncio.wait_for(ready(), self._timeout)
+        except asyncio.TimeoutError:
+            error = f"timed out after {self._timeout}s waiting for {stage}"
+            print(f"{name}: {error}")
+            return ProvisionResult(name, False, time.monotonic() - start, error)
+        finally:
+            agent_task.cancel()
+
+        timings = ", ".join(f"{k} +{v:.1f}s" for k, v in entry.times.items())
+        print(f"{name}: ready ({', '.join(ips) or 'no reserved ip'}) {timings}")
+        return ProvisionResult(name, True, time.monotonic() - start)
+
+
+@traced("wait")
+def wait_ready(instances: List[Instance], timeout: float = 300) -> List[ProvisionResult]:
+    # one waiter (event subscription) per host, all hosts at once
+    by_uri = {}
+    for instance in instances:
+        by_uri.setdefault(instance.get_uri(), []).append(instance)
+
+    async def wait_all():
+        results = await asyncio.gather(
+            *(
+                ReadinessWaiter(timeout, uri).await_ready(group)
+                for uri, group in by_uri.items()
+            )
+        )
+        return [result for group in results for result in group]
+
+    return asyncio.run(wait_all())
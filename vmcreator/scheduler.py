@@ -0,0 +1,231 @@
+from typing import Dict, List
+from libvirt import (
+    VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+    VIR_NODE_MEMORY_STATS_ALL_CELLS,
+    libvirtError,
+)
+from vmcreator.config import Config, ServiceConfig
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect, pool
+from vmcreator.units import parse_size
+
+MiB = 1024 * 1024
+
+
+class SchedulingError(Exception):
+    def __init__(self, errors: list):
+        super(SchedulingError, self).__init__("; ".join(errors))
+        self.errors = errors
+
+
+def get_hosts(config: Config) -> Dict[str, str]:
+    # hosts: {name: {uri: ...}}, without that section everything goes to
+    # libvirt.uri (or the local system instance)
+    if not config.hosts:
+        return {"local": config.libvirt.uri or DEFAULT_URI}
+    return {name: host.uri or DEFAULT_URI for name, host in config.hosts.items()}
+
+
+def is_multi_host(config: Config) -> bool:
+    return bool(config.hosts)
+
+
+def available_memory(conn) -> int:
+    # MemAvailable: free memory plus page cache and buffers, which the kernel
+    # gives back on demand. getFreeMemory() alone is MemFree and refuses
+    # hosts that just have a big cache
+    try:
+        stats = conn.getMemoryStats(VIR_NODE_MEMORY_STATS_ALL_CELLS, 0)
+    except libvirtError:
+        stats = {}
+    if "free" not in stats:
+        return conn.getFreeMemory()
+    return (stats["free"] + stats.get("cached", 0) + stats.get("buffers", 0)) * 1024
+
+
+def locate(
+    config: Config, hosts: Dict[str, str], sticky: Dict[str, str] = None
+) -> Dict[str, str]:
+    # where the vms of config already are: the state, else whichever host
+    # has a domain of that name. vms found nowhere are left out
+    sticky = sticky or {}
+    placement = {}
+    for vm in config.services:
+        if sticky.get(vm) in hosts:
+            placement[vm] = sticky[vm]
+            continue
+        for name, uri in hosts.items():
+            try:
+                pool.acquire(uri).lookupByName(vm)
+            except libvirtError:
+                continue
+            placement[vm] = name
+            break
+    return placement
+
+
+class Demand:
+    def __init__(self, ram: int = 0, vcpu: int = 0, disk: int = 0):
+        self.ram = ram
+        self.vcpu = vcpu
+        self.disk = disk
+
+    @classmethod
+    def of(cls, service: ServiceConfig) -> "Demand":
+        disk = 0
+        for vol in service.volumes:
+            disk += parse_size(vol.size)
+        return cls(ram=service.ram * MiB, vcpu=service.cpu, disk=disk)
+
+    def __add__(self, other: "Demand") -> "Demand":
+        return Demand(
+            self.ram + other.ram, self.vcpu + other.vcpu, self.disk + other.disk
+        )
+
+    def sort_key(self):
+        return (self.ram, self.vcpu, self.disk)
+
+
+class HostState(LibvirtConnect):
+    # what is left on a host for new vms: available ram (never overcommitted),
+    # vcpus up to cpu_overcommit x host cpus minus the running ones and the
+    # free space of the vm pool. the scheduler takes from it as it places
+    def __init__(
+        self,
+        name: str,
+        uri: str = DEFAULT_URI,
+        vm_pool: str = None,
+        cpu_overcommit: float = 4.0,
+        disk_overcommit: float = 1.0,
+    ):
+        super(HostState, self).__init__(uri)
+        self.name = name
+        conn = self.get_connection()
+        self.ram = available_memory(conn)
+        running = sum(
+            dom.info()[3]
+            for dom in conn.listAllDomains(VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        )
+        self.vcpu = conn.getInfo()[2] * cpu_overcommit - running
+        self.disk = None
+        if vm_pool:
+            try:
+                self.disk = (
+                    conn.storagePoolLookupByName(vm_pool).info()[3] * disk_overcommit
+                )
+            except libvirtError:
+                pass
+        self.domains = {dom.name() for dom in conn.listAllDomains(0)}
+        self.groups = set()
+        self.vms = []
+
+    def fits(self, demand: Demand) -> bool:
+        return (
+            demand.ram <= self.ram
+            and demand.vcpu <= self.vcpu
+            and (self.disk is None or demand.disk <= self.disk)
+        )
+
+    def take(self, demand: Demand):
+        self.ram -= demand.ram
+        self.vcpu -= demand.vcpu
+        if self.disk is not None:
+            self.disk -= demand.disk
+
+    def describe(self) -> str:
+        disk = "?" if self.disk is None else f"{self.disk / MiB / 1024:.1f}G"
+        return f"{self.ram / MiB / 1024:.1f}G ram, {self.vcpu:g} vcpu, {disk} disk left"
+
+
+class _Unit:
+    # services placed together: an affinity group or a single service
+    def __init__(self, name: str):
+        self.name = name
+        self.vms: List[str] = []
+        self.pins = set()
+        self.groups = set()
+        self.demand = Demand()
+
+
+def schedule(
+    config: Config,
+    hosts: Dict[str, HostState],
+    sticky: Dict[str, str] = None,
+) -> Dict[str, str]:
+    # {vm: host name}. best fit decreasing: the biggest units first, each
+    # onto the host it fills the most without overflowing. vms that already
+    # run somewhere stay there (state or an existing domain of that name),
+    # host: pins a service, affinity: <group> keeps services together and
+    # anti_affinity: <group(s)> keeps services of a group on different hosts
+    sticky = dict(sticky or {})
+    errors = []
+    services = config.services
+
+    for vm in services:
+        if vm in sticky:
+            continue
+        found = [h.name for h in hosts.values() if vm in h.domains]
+        if found:
+            sticky[vm] = found[0]
+
+    units: Dict[str, _Unit] = {}
+    for vm, service in services.items():
+        name = f"affinity {service.affinity}" if service.affinity else vm
+        unit = units.setdefault(name, _Unit(name))
+        unit.vms.append(vm)
+        for pin in (service.host, sticky.get(vm)):
+            if pin is not None:
+                unit.pins.add(pin)
+        groups = set(service.anti_affinity)
+        if groups & unit.groups:
+            errors.append(
+                f"{name}: shares anti-affinity {', '.join(sorted(groups & unit.groups))} within the group"
+            )
+        unit.groups |= groups
+        host = hosts.get(sticky.get(vm))
+        if host is None or vm not in host.domains:
+            unit.demand = unit.demand + Demand.of(service)
+
+    for unit in units.values():
+        unknown = unit.pins - set(hosts)
+        if unknown:
+            errors.append(f"{unit.name}: unknown host {', '.join(sorted(unknown))}")
+        elif len(unit.pins) > 1:
+            errors.append(
+                f"{unit.name}: pinned to several hosts {', '.join(sorted(unit.pins))}"
+            )
+    if errors:
+        raise SchedulingError(errors)
+
+    placement = {}
+    # pinned units first, then the rest biggest first
+    order = sorted(
+        units.values(), key=lambda u: (bool(u.pins), u.demand.sort_key()), reverse=True
+    )
+    for unit in order:
+        candidates = (
+            [hosts[p] for p in unit.pins] if unit.pins else list(hosts.values())
+        )
+        candidates = [h for h in candidates if not h.groups & unit.groups]
+        if not candidates:
+            errors.append(
+                f"{unit.name}: anti-affinity {', '.join(sorted(unit.groups))} leaves no host"
+            )
+            continue
+        fitting = [h for h in candidates if h.fits(unit.demand)]
+        if not fitting:
+            errors.append(
+                f"{unit.name}: needs {unit.demand.ram // MiB} MiB ram, {unit.demand.vcpu} vcpu,"
+                f" {unit.demand.disk // MiB // 1024}G disk; "
+                + "; ".join(f"{h.name}: {h.describe()}" for h in candidates)
+            )
+            continue
+        host = min(fitting, key=lambda h: h.ram - unit.demand.ram)
+        host.take(unit.demand)
+        host.groups |= unit.groups
+        host.vms += unit.vms
+        for vm in unit.vms:
+            placement[vm] = host.name
+
+    if errors:
+        raise SchedulingError(errors)
+    return placement
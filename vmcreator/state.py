@@ -0,0 +1,56 @@
+import os
+import yaml
+from vmcreator.config import SafeDumper, SafeLoader
+
+STATE_VERSION = 1
+
+
+def state_filename(config_filename):
+    cfg_basename = os.path.basename(
+                    os.path.splitext(config_filename)[0]
+                ).replace(" ","_")
+    return f"{cfg_basename}_output.state"
+
+
+def read_state(config_filename) -> dict:
+    # {"version": 1, "config": <last applied config>, "macs": {key: mac},
+    #  "ips": {key: auto-assigned ip}, "hosts": {vm: host it was placed on}},
+    # older state files are just the frozen config
+    filename = state_filename(config_filename)
+    state = {
+        "version": STATE_VERSION,
+        "config": None,
+        "macs": {},
+        "ips": {},
+        "hosts": {},
+    }
+    if not os.path.exists(filename):
+        return state
+    try:
+        with open(filename, "r") as f:
+            data = yaml.load(f, Loader=SafeLoader) or {}
+    except (OSError, yaml.YAMLError) as e:
+        print(e)
+        return state
+    if "services" in data:
+        state["config"] = data
+    else:
+        state.update(data)
+    return state
+
+
+def write_state(
+    config_filename, config, macs: dict = None, ips: dict = None, hosts: dict = None
+):
+    state = {
+        "version": STATE_VERSION,
+        "config": config,
+        "macs": macs or {},
+        "ips": ips or {},
+        "hosts": hosts or {},
+    }
+    try:
+        with open(state_filename(config_filename), "w") as f:
+            yaml.dump(state, f, Dumper=SafeDumper)
+    except Exception as e:
+        print(e)
@@ -1,27 +1,35 @@
-from vmcreator.connection import LibvirtConnect
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect, host_key
+from vmcreator.cache import iso_cache, digest_files
+from vmcreator.iso9660 import build_iso
+from vmcreator.passwords import password_hasher
+from vmcreator.pool import StoragePoolManager, get_pool_manager
+from vmcreator.aio import AsyncMixin, runner
+from vmcreator.tracing import check_call, parse_xml
+from vmcreator.units import parse_size
 from libvirt import virStoragePool, virStorageVol
-from abc import abstractmethod
-import subprocess
-import os
+from abc import abstractmethod, ABC
 import tempfile
-import crypt
 import yaml
-from shutil import copyfile, rmtree
-import xml.etree.ElementTree as ET
+from shutil import rmtree, which
 
 
+ISO_BACKENDS = ("python", "genisoimage")
+VOLUME_BACKENDS = ("libvirt", "qemu-img")
+FILE_POOL_TYPES = ("dir", "fs", "netfs")
+UPLOAD_CHUNK = 256 * 1024
+
 class StorageNotFoundException(Exception):
     def __init__(self, message):
-        super(self, message)
+        super(StorageNotFoundException, self).__init__(message)
 
 
-class Storage(LibvirtConnect):
+class Storage(LibvirtConnect, AsyncMixin, ABC):
     def __init__(
         self,
         vm_name,
         storage_pool_name,
         debug: bool = False,
-        uri: str = "qemu:///system",
+        uri: str = DEFAULT_URI,
     ):
         self._storage_pool_name = storage_pool_name
         self._vm_name = vm_name
@@ -33,10 +41,6 @@ class Storage(LibvirtConnect):
     def create(self) -> None:
         pass
 
-    @abstractmethod
-    def delete(self) -> None:
-        pass
-
     @staticmethod
     def from_virsh(data: virStorageVol):
         if data is None:
@@ -68,22 +72,90 @@ class Storage(LibvirtConnect):
 
         return storage
 
+    def get_pool_manager(self, name=None) -> StoragePoolManager:
+        return get_pool_manager(name or self._storage_pool_name, uri=self.get_uri())
+
     def get_pool_path(self, name) -> str:
         # retrieve abs path of pool
-        xml_tree = ET.fromstring(
-            self.get_connection().storagePoolLookupByName(name).XMLDesc()
-        )
-        return xml_tree.find(".//target/path").text
+        return self.get_pool_manager(name).get_path()
 
     def get_storage_pool(self) -> virStoragePool:
-        print(f"storage pool: {self._storage_pool_name}")
-        return self.get_connection().storagePoolLookupByName(self._storage_pool_name)
+        return self.get_pool_manager().get_pool()
 
-    def get_disk(self) -> virStorageVol:
+    def get_pool_type(self) -> str:
+        return self.get_pool_manager().get_type()
+
+    def refresh_storage_pool(self):
+        self.get_pool_manager().refresh()
+
+    @abstractmethod
+    def get_volume_name(self) -> str:
+        pass
+
+    def exists(self) -> bool:
         if not self._disk:
+            self._disk = self.get_pool_manager().lookup(self.get_volume_name())
+        return self._disk is not None
+
+    def get_disk(self) -> virStorageVol:
+        if not self.exists():
             self.create()
+            self._disk = self.get_pool_manager().lookup(self.get_volume_name())
+        if not self._disk:
+            raise StorageNotFoundException(
+                f"volume {self.get_volume_name()} not found in {self._storage_pool_name}"
+            )
         return self._disk
 
+    def delete(self):
+        self.get_disk().delete(0)
+        self.get_pool_manager().forget(self.get_volume_name())
+        self._disk = None
+
+    def qemu_img_command(self, backing_path: str = None) -> list:
+        vm_path = self.get_pool_path(self._storage_pool_name)
+        command = ["qemu-img", "create", "-f", "qcow2"]
+        if backing_path:
+            command += ["-F", "qcow2", "-b", backing_path]
+        return command + [f"{vm_path}/{self.get_volume_name()}", str(self._size)]
+
+    def volume_xml(self, backing_path: str = None) -> str:
+        backing = ""
+        if backing_path:
+            backing = f"""
+            <backingStore>
+                <path>{backing_path}</path>
+                <format type="qcow2"/>
+            </backingStore>
+            """
+        return f"""
+        <volume>
+            <name>{self.get_volume_name()}</name>
+            <capacity unit="B">{parse_size(self._size)}</capacity>
+            <target><format type="qcow2"/></target>
+            {backing}
+        </volume>
+        """
+
+    def create_qcow2(self, backing_path: str = None):
+        if self._volume_backend == "qemu-img":
+            r = check_call(self.qemu_img_command(backing_path))
+            # picked up by the next lookup, one pool refresh covers the whole batch
+            self.get_pool_manager().mark_dirty()
+        else:
+            # no process spawn and no pool rescan, works on any pool type
+            self._disk = self.get_pool_manager().create_volume(
+                self.volume_xml(backing_path)
+            )
+
+    async def acreate_qcow2(self, backing_path: str = None):
+        if self._volume_backend == "qemu-img":
+            command = await runner.call(self.qemu_img_command, backing_path)
+            await runner.run_process(command)
+            self.get_pool_manager().mark_dirty()
+        else:
+            await runner.call(self.create_qcow2, backing_path)
+
 
 class RootStorage(Storage):
     def __init__(
@@ -94,53 +166,94 @@ class RootStorage(Storage):
         size="1G",
         image=None,
         image_pool="default",
+        volume_backend="libvirt",
+        layer=None,
         debug=False,
-        uri: str = "qemu:///system",
+        uri: str = DEFAULT_URI,
     ):
         super(RootStorage, self).__init__(
             vm_name, storage_pool_name, debug=debug, uri=uri
         )
+        self._volume_backend = volume_backend
+        self._layer = layer
         self._size = size
         self._image = image
         self._image_pool = image_pool
         self._disk_mount = disk_mount
 
-    def create(self):
-        try:
-            disk = self.get_storage_pool().storageVolLookupByName(
-                f"{self._vm_name}-root-{self._disk_mount}.qcow2"
+    def get_volume_name(self) -> str:
+        return f"{self._vm_name}-root-{self._disk_mount}.qcow2"
+
+    def get_size(self) -> str:
+        return self._size
+
+    def get_backing_image(self) -> str:
+        return self._image
+
+    def get_image_pool_name(self) -> str:
+        return self._image_pool
+
+    def get_layer(self):
+        return self._layer
+
+    def get_overlay_key(self) -> str:
+        return host_key(
+            self.get_uri(), f"{self._storage_pool_name}/{self.get_volume_name()}"
+        )
+
+    def get_backing_volume(self) -> virStorageVol:
+        vol = self.get_pool_manager(self._image_pool).lookup(self._image)
+        if vol is None:
+            raise StorageNotFoundException(
+                f"base image {self._image} not found in {self._image_pool}"
+            )
+        return vol
+
+    def get_create_backing_path(self) -> str:
+        if self._layer:
+            return self._layer.get_disk().path()
+        return self.get_backing_volume().path()
+
+    def _register_overlay(self):
+        if self._layer:
+            from vmcreator.backing import backing_registry
+
+            backing_registry.acquire(
+                self._layer.get_registry_key(), self.get_overlay_key()
             )
-            self._disk = disk
+
+    def create(self):
+        if self.exists():
             print(
                 f"Disk {self._vm_name}-root-{self._disk_mount}.qcow2 already created."
             )
             return
-        except:
+        print(
+            f"Disk {self._vm_name}-root-{self._disk_mount}.qcow2 not found, creating..."
+        )
+        self.create_qcow2(self.get_create_backing_path())
+        self._register_overlay()
+        print(
+            f"Disk {self._vm_name}-root-{self._disk_mount}.qcow2 successfully created"
+        )
+
+    async def acreate(self):
+        if await self.aexists():
             print(
-                f"Disk {self._vm_name}-root-{self._disk_mount}.qcow2 not found, creating..."
+                f"Disk {self._vm_name}-root-{self._disk_mount}.qcow2 already created."
             )
-            disk = None
-            if self._debug:
-                import traceback
-
-                print(traceback.format_exc())
-
-        vm_path = self.get_pool_path(self._storage_pool_name)
-        isos_path = self.get_pool_path(self._image_pool)
-
-        command = f"qemu-img create -f qcow2 -F qcow2 -b {isos_path}/{self._image} {vm_path}/{self._vm_name}-root-{self._disk_mount}.qcow2 {self._size}"
-        r = subprocess.check_call(command.split(" "))
-        self.get_storage_pool().refresh()
-        self._disk = self.get_storage_pool().storageVolLookupByName(
-            f"{self._vm_name}-root-{self._disk_mount}.qcow2"
-        )
+            return
+        await self.acreate_qcow2(await runner.call(self.get_create_backing_path))
+        await runner.call(self._register_overlay)
         print(
             f"Disk {self._vm_name}-root-{self._disk_mount}.qcow2 successfully created"
         )
 
     def delete(self):
-        self.get_disk().delete(0)
-        self.get_storage_pool().refresh()
+        from vmcreator.backing import backing_registry
+
+        super(RootStorage, self).delete()
+        backing_registry.release(self.get_overlay_key())
 
 
 class BasicStorage(Storage):
@@ -150,37 +263,34 @@ class BasicStorage(Storage):
         storage_pool_name="default",
         disk_mount="vdb",
         size="1G",
+        volume_backend="libvirt",
         debug=False,
-        uri: str = "qemu:///system",
+        uri: str = DEFAULT_URI,
     ):
         super(BasicStorage, self).__init__(
             vm_name, storage_pool_name, debug=debug, uri=uri
         )
+        self._volume_backend = volume_backend
         self._size = size
         self._disk_mount = disk_mount
 
+    def get_volume_name(self) -> str:
+        return f"{self._vm_name}-{self._disk_mount}.qcow2"
+
+    def get_size(self) -> str:
+        return self._size
+
     def create(self):
-        try:
-            disk = self.get_storage_pool().storageVolLookupByName(
-                f"{self._vm_name}-{self._disk_mount}.qcow2"
-            )
-            self._disk = disk
+        if self.exists():
             return
-        except:
-            disk = None
-        
-        vm_path = self.get_pool_path(self._storage_pool_name)
 
-        command = f"qemu-img create -f qcow2 {vm_path}/{self._vm_name}-{self._disk_mount}.qcow2 {self._size}"
-        r = subprocess.check_call(command.split(" "))
-        self.get_storage_pool().refresh()
-        self._disk = self.get_storage_pool().storageVolLookupByName(
-            f"{self._vm_name}-{self._disk_mount}.qcow2"
-        )
+        self.create_qcow2()
 
-    def delete(self):
-        self.get_disk().delete(0)
-        self.get_storage_pool().refresh()
+    async def acreate(self):
+        if await self.aexists():
+            return
+
+        await self.acreate_qcow2()
 
 
 class Cloudinit(Storage):
@@ -190,89 +300,175 @@ class Cloudinit(Storage):
         storage_pool_name="default",
         config=None,
         force=False,
+        iso_backend="python",
         debug=False,
-        uri: str = "qemu:///system",
+        uri: str = DEFAULT_URI,
     ):
         super(Cloudinit, self).__init__(
             vm_name, storage_pool_name, debug=debug, uri=uri
         )
         self._config = config
         self._force_create = force
+        self._iso_backend = iso_backend
+
+    def get_volume_name(self) -> str:
+        return f"{self._vm_name}.cloudinit.iso"
+
+    def set_force(self, force: bool):
+        self._force_create = force
 
     def create(self):
-        vm_path = self.get_pool_path(self._storage_pool_name)
-        cloudinit_path = f"{vm_path}/{self._vm_name}.cloudinit.iso"
+        seed = self.render_seed()
+        key = digest_files(seed)
 
-        if os.path.exists(cloudinit_path):
-            if self._force_create:
-                self.__do_generate()
-            self._disk = self.get_storage_pool().storageVolLookupByName(
-                f"{self._vm_name}.cloudinit.iso"
+        if self.__is_current(key):
+            print(
+                f"Disk {self._storage_pool_name}/{self.get_volume_name()} already created."
             )
-            print(f"Disk {vm_path}/{self._vm_name}.cloudinit.iso already created.")
             return
 
-        self.__do_generate()
-
-    def delete(self):
-        self.get_disk().delete(0)
-        self.get_storage_pool().refresh()
-
-    def __do_generate(self):
-        tmpdir = tempfile.mkdtemp()
+        self.__do_generate(seed, key)
+
+    async def acreate(self):
+        # genisoimage runs as an asyncio child process and only fills the
+        # cache, create() then uploads the cached iso
+        if self._iso_backend == "genisoimage" and which("genisoimage"):
+            seed = await runner.call(self.render_seed)
+            key = digest_files(seed)
+            current = await runner.call(self.__is_current, key, True)
+            if not current and not iso_cache.get(key):
+                await self.__agenisoimage(seed, key)
+        await runner.call(self.create)
+
+    def __placement(self) -> str:
+        # the volume on its host, the pool may live on another machine
+        return host_key(
+            self.get_uri(), f"{self._storage_pool_name}/{self.get_volume_name()}"
+        )
 
-        user = self.__userinit(tmpdir)
-        metadata = self.__metadatainit(tmpdir)
-        network = self.__networkinit(tmpdir)
+    def __stamp(self) -> str:
+        # changes whenever the volume is rewritten, read through libvirt
+        mtime = parse_xml(self._disk.XMLDesc(0)).find(".//timestamps/mtime")
+        return mtime.text if mtime is not None else None
+
+    def __is_current(self, key: str, quiet: bool = False) -> bool:
+        if not self.exists():
+            return False
+        placed = iso_cache.placed(self.__placement(), self.__stamp())
+        if placed == key or (placed is None and not self._force_create):
+            return True
+        if not quiet:
+            print(f"cloud-init seed of {self._vm_name} changed, regenerating...")
+        return False
 
-        # generate .iso file
-        cmd = f"genisoimage -output {tmpdir}/{self._vm_name}.cloudinit.iso -V cidata -r -J {user} {metadata} {network}"
-        a = subprocess.check_call(cmd.split(" "))
+    def delete(self):
+        super(Cloudinit, self).delete()
+        iso_cache.forget_placement(self.__placement())
+
+    def render_seed(self) -> dict:
+        return {
+            "user-data": self.__userinit().encode(),
+            "meta-data": self.__metadatainit().encode(),
+            "network-config": self.__networkinit().encode(),
+        }
+
+    def __do_generate(self, seed: dict, key: str):
+        iso_path = iso_cache.get(key)
+        data = None
+        if iso_path:
+            print(f"cloud-init iso {key[:12]} found in cache")
+        elif self._iso_backend == "genisoimage" and which("genisoimage"):
+            iso_path = self.__genisoimage(seed, key)
+        else:
+            # small enough to build in memory, cached like genisoimage output
+            data = build_iso(seed, volume_id="cidata")
+            iso_cache.put_data(key, data)
 
-        # copy to vms pool libvirt folder
-        vm_path = self.get_pool_path(self._storage_pool_name)
         try:
-            copyfile(
-                f"{tmpdir}/{self._vm_name}.cloudinit.iso",
-                f"{vm_path}/{self._vm_name}.cloudinit.iso",
-            )
-            # refresh after copy
-            self.get_storage_pool().refresh()
+            if data is None:
+                with open(iso_path, "rb") as f:
+                    data = f.read()
+
+            # create the volume through libvirt so the pool never needs a refresh
+            if not self.exists():
+                self._disk = self.get_pool_manager().create_volume(
+                    f"""
+                    <volume>
+                        <name>{self.get_volume_name()}</name>
+                        <capacity unit="B">{len(data)}</capacity>
+                        <target><format type="raw"/></target>
+                    </volume>
+                    """
+                )
+
+            # streamed through libvirtd for every pool type: the pool may be
+            # on another host and its files are usually only writable by root
+            if self._disk.info()[1] < len(data):
+                self._disk.resize(len(data))
+            stream = self.get_connection().newStream(0)
+            self._disk.upload(stream, 0, len(data), 0)
+            for offset in range(0, len(data), UPLOAD_CHUNK):
+                stream.send(data[offset : offset + UPLOAD_CHUNK])
+            stream.finish()
+            iso_cache.record_placement(self.__placement(), key, self.__stamp())
 
-            print(f"Disk {vm_path}/{self._vm_name}.cloudinit.iso successfully created.")
-            self._disk = self.get_storage_pool().storageVolLookupByName(
-                f"{self._vm_name}.cloudinit.iso"
+            print(
+                f"Disk {self._storage_pool_name}/{self.get_volume_name()} successfully created."
             )
-        except:
+        except Exception as e:
+            print(f"cloud-init iso of {self._vm_name} failed: {e}")
             if self._debug:
                 import traceback
 
                 print(traceback.format_exc())
             exit(-10)
 
+    def __genisoimage_command(self, seed: dict, tmpdir: str) -> list:
+        for name, content in seed.items():
+            with open(f"{tmpdir}/{name}", "wb") as f:
+                f.write(content)
+
+        cmd = f"genisoimage -output {tmpdir}/{self._vm_name}.cloudinit.iso -V cidata -r -J {tmpdir}/user-data {tmpdir}/meta-data {tmpdir}/network-config"
+        return cmd.split(" ")
+
+    def __genisoimage(self, seed: dict, key: str) -> str:
+        tmpdir = tempfile.mkdtemp()
+
+        # generate .iso file
+        a = check_call(self.__genisoimage_command(seed, tmpdir))
+        iso_path = iso_cache.put(key, f"{tmpdir}/{self._vm_name}.cloudinit.iso")
+
         # cleanup tmpdirs
         try:
             rmtree(tmpdir)
-        except:
+        except Exception as e:
+            print(f"could not remove {tmpdir}: {e}")
             if self._debug:
                 import traceback
 
                 print(traceback.format_exc())
             exit(-10)
 
-    def __metadatainit(self, outdir):
+        return iso_path
+
+    async def __agenisoimage(self, seed: dict, key: str) -> str:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            await runner.run_process(self.__genisoimage_command(seed, tmpdir))
+            return iso_cache.put(key, f"{tmpdir}/{self._vm_name}.cloudinit.iso")
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def __metadatainit(self) -> str:
         metadataconfig = {}
         metadataconfig["instance-id"] = f"iid-{self._vm_name}"
         metadataconfig["local-hostname"] = self._vm_name
 
-        with open(f"{outdir}/meta-data", "w+") as f:
-            yaml.safe_dump(
-                metadataconfig, f, allow_unicode=True, sort_keys=True, width=2048
-            )
-
-        return f"{outdir}/meta-data"
+        return yaml.safe_dump(
+            metadataconfig, allow_unicode=True, sort_keys=True, width=2048
+        )
 
-    def __userinit(self, outdir):
+    def __userinit(self) -> str:
         userconfig = {}
         userconfig["fqdn"] = self._config.get("fqdn", "local")
         userconfig["timezone"] = self._config.get("timezone", "UTC")
@@ -287,19 +483,17 @@ class Cloudinit(Storage):
                     "sudo": "ALL=(ALL) NOPASSWD:ALL",
                     "groups": "sudo",
                     "ssh_authorized_keys": [key for key in user.get("ssh_key")],
-                    "passwd": crypt.crypt(user.get("password", "student")),
+                    "passwd": password_hasher.hash(
+                        user.get("name"), user.get("password", "student")
+                    ),
                 }
             )
 
-        with open(f"{outdir}/user-data", "w+") as f:
-            f.write("#cloud-config\n")
-            yaml.safe_dump(
-                userconfig, f, allow_unicode=True, sort_keys=True, width=2048
-            )
-
-        return f"{outdir}/user-data"
+        return "#cloud-config\n" + yaml.safe_dump(
+            userconfig, allow_unicode=True, sort_keys=True, width=2048
+        )
 
-    def __networkinit(self, outdir):
+    def __networkinit(self) -> str:
         networkconfig = {}
         
         if self._config.get("network-init"):
@@ -316,7 +510,4 @@ class Cloudinit(Storage):
                 }
                 iface_start += 1
 
-        with open(f"{outdir}/network-config", "w+") as f:
-            yaml.safe_dump(networkconfig, f, allow_unicode=True, sort_keys=True)
-
-        return f"{outdir}/network-config"
+        return yaml.safe_dump(networkconfig, allow_unicode=True, sort_keys=True)
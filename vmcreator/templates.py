@@ -0,0 +1,176 @@
+from string import Template
+
+# domain xml is rendered from fragments compiled once at import: the
+# skeleton is split around <devices> so a whole domain is a single join of
+# head + disks + nics + the (pre-joined) static devices of its profile + tail
+
+DOMAIN_HEAD = Template(
+    '<domain type="kvm">'
+    "<name>${name}</name>"
+    "<features><acpi/><apic/><vmport state=\"off\"/></features>"
+    '<memory unit="MiB">${ram}</memory>'
+    "${memory_backing}"
+    "<on_poweroff>destroy</on_poweroff>"
+    "<on_reboot>restart</on_reboot>"
+    "<on_crash>destroy</on_crash>"
+    '<cpu mode="host-passthrough"></cpu>'
+    '<vcpu placement="static"${cpuset}>${vcpu}</vcpu>'
+    "${iothreads}${cputune}${numatune}"
+    "<os>"
+    '<type arch="x86_64" machine="q35">hvm</type>'
+    '<boot dev="hd"/>'
+    "</os>"
+    "<devices>"
+)
+DOMAIN_TAIL = "</devices></domain>"
+
+MEMORY_BACKING = Template("<memoryBacking>${hugepages}${shared}</memoryBacking>")
+HUGEPAGES = Template('<hugepages><page size="${size}" unit="KiB"/></hugepages>')
+SHARED_MEMORY = '<source type="memfd"/><access mode="shared"/>'
+
+IOTHREADS = Template("<iothreads>${count}</iothreads>")
+VCPUPIN = Template('<vcpupin vcpu="${vcpu}" cpuset="${cpuset}"/>')
+EMULATORPIN = Template('<emulatorpin cpuset="${cpuset}"/>')
+NUMATUNE = Template(
+    '<numatune><memory mode="${mode}" nodeset="${nodeset}"/></numatune>'
+)
+
+DISK = Template(
+    '<disk type="file" device="disk">'
+    '<driver name="qemu" type="qcow2"${driver}/>'
+    '<source file="${path}"/>'
+    '<target dev="${dev}" bus="virtio"/>'
+    "</disk>"
+)
+
+CDROM = Template(
+    '<disk type="file" device="cdrom">'
+    '<driver name="qemu" type="raw"/>'
+    '<source file="${path}"/>'
+    '<target dev="${dev}" bus="sata"/>'
+    "<readonly/>"
+    "</disk>"
+)
+
+INTERFACE = Template(
+    '<interface type="network">'
+    '<mac address="${mac}"/>'
+    '<source network="${network}"/>'
+    '<model type="virtio"/>'
+    "${driver}"
+    "</interface>"
+)
+NET_QUEUES = Template('<driver name="vhost" queues="${queues}"/>')
+
+# static devices, shared by the profiles below
+SERIAL_CONSOLE = (
+    '<serial type="pty">'
+    '<target type="isa-serial" port="0"><model name="isa-serial"/></target>'
+    "</serial>"
+    '<console type="pty"><target type="serial" port="0"/></console>'
+)
+GUEST_AGENT = (
+    '<channel type="unix">'
+    '<target type="virtio" name="org.qemu.guest_agent.0"/>'
+    "</channel>"
+)
+MEMBALLOON = '<memballoon model="virtio"/>'
+SPICE = (
+    '<channel type="spicevmc">'
+    '<target type="virtio" name="com.redhat.spice.0"/>'
+    "</channel>"
+    '<input type="tablet" bus="usb"/>'
+    '<input type="mouse" bus="ps2"/>'
+    '<input type="keyboard" bus="ps2"/>'
+    '<graphics type="spice" autoport="yes">'
+    '<listen type="address"/>'
+    '<image compression="off"/>'
+    "</graphics>"
+    '<sound model="ich6"/>'
+    '<audio id="1" type="spice"/>'
+    "<video>"
+    '<model type="qxl" ram="65536" vram="65536" vgamem="16384" heads="1" primary="yes"/>'
+    "</video>"
+    '<redirdev bus="usb" type="spicevmc"/>'
+    '<redirdev bus="usb" type="spicevmc"/>'
+)
+
+PROFILES = {
+    # what vmcreator always used: spice desktop with qxl, sound, usb redirection
+    "default": "".join([SERIAL_CONSOLE, GUEST_AGENT, MEMBALLOON, SPICE]),
+    # serial console only, no video/sound/spice emulation to feed
+    "headless": "".join([SERIAL_CONSOLE, GUEST_AGENT, MEMBALLOON]),
+}
+
+
+def get_profile(name: str) -> str:
+    if name not in PROFILES:
+        raise ValueError(
+            f"unknown hardware profile {name}, one of: {', '.join(PROFILES)}"
+        )
+    return PROFILES[name]
+
+
+def _attrs(**attrs) -> str:
+    return "".join(f' {k}="{v}"' for k, v in attrs.items() if v is not None)
+
+
+def render_disk(
+    path: str, dev: str, cache: str = None, io: str = None, iothread: int = None
+) -> str:
+    return DISK.substitute(
+        path=path, dev=dev, driver=_attrs(cache=cache, io=io, iothread=iothread)
+    )
+
+
+def render_cdrom(path: str, dev: str) -> str:
+    return CDROM.substitute(path=path, dev=dev)
+
+
+def render_interface(mac: str, network: str, queues: int = None) -> str:
+    driver = NET_QUEUES.substitute(queues=queues) if queues else ""
+    return INTERFACE.substitute(mac=mac, network=network, driver=driver)
+
+
+def render_memory_backing(shared_ram: bool, hugepage_kib: int = None) -> str:
+    if not shared_ram and not hugepage_kib:
+        return ""
+    return MEMORY_BACKING.substitute(
+        hugepages=HUGEPAGES.substitute(size=hugepage_kib) if hugepage_kib else "",
+        shared=SHARED_MEMORY if shared_ram else "",
+    )
+
+
+def render_cputune(vcpupin: list = None, emulatorpin: str = None) -> str:
+    pins = [VCPUPIN.substitute(vcpu=i, cpuset=c) for i, c in enumerate(vcpupin or [])]
+    if emulatorpin:
+        pins.append(EMULATORPIN.substitute(cpuset=emulatorpin))
+    if not pins:
+        return ""
+    return "".join(["<cputune>", *pins, "</cputune>"])
+
+
+def render_domain(
+    profile: str,
+    name: str,
+    vcpu: int,
+    ram: int,
+    shared_ram: bool,
+    disks: list,
+    interfaces: list,
+    tuning: dict = None,
+) -> str:
+    # tuning: pre-rendered head fragments, see Tuning.render_head()
+    tuning = tuning or {}
+    head = DOMAIN_HEAD.substitute(
+        name=name,
+        ram=ram,
+        vcpu=vcpu,
+        memory_backing=tuning.get("memory_backing")
+        or render_memory_backing(shared_ram),
+        cpuset=_attrs(cpuset=tuning.get("cpuset")),
+        iothreads=tuning.get("iothreads", ""),
+        cputune=tuning.get("cputune", ""),
+        numatune=tuning.get("numatune", ""),
+    )
+    return "".join([head, *disks, *interfaces, get_profile(profile), DOMAIN_TAIL])
@@ -0,0 +1,62 @@
+import threading
+from vmcreator.connection import DEFAULT_URI, LibvirtConnect
+from vmcreator.tracing import parse_xml
+from vmcreator.tuning import cpuset
+
+
+class HostTopology(LibvirtConnect):
+    # numa cells of the host from the capabilities xml. placement spreads
+    # vms over the cells: each vm goes to the cell with the most free memory
+    # left, counting what this run already put there
+    def __init__(self, uri: str = DEFAULT_URI):
+        super(HostTopology, self).__init__(uri)
+        self._lock = threading.Lock()
+        self._cells = None
+        self._free = None
+
+    def get_cells(self) -> dict:
+        if self._cells is None:
+            caps = parse_xml(self.get_connection().getCapabilities())
+            cells = {}
+            for cell in caps.findall("./host/topology/cells/cell"):
+                memory = cell.find("memory")
+                cells[int(cell.get("id"))] = {
+                    "cpus": cpuset(
+                        int(c.get("id")) for c in cell.findall("./cpus/cpu")
+                    ),
+                    "memory": int(memory.text) if memory is not None else 0,
+                }
+            self._cells = cells
+        return self._cells
+
+    def get_cell(self, cell_id: int) -> dict:
+        cells = self.get_cells()
+        if cell_id not in cells:
+            raise ValueError(
+                f"host has no numa node {cell_id}, available: {sorted(cells)}"
+            )
+        return cells[cell_id]
+
+    def place(self, ram_mib: int) -> int:
+        with self._lock:
+            cells = self.get_cells()
+            if not cells:
+                return None
+            if self._free is None:
+                ids = sorted(cells)
+                free = self.get_connection().getCellsFreeMemory(ids[0], len(ids))
+                self._free = dict(zip(ids, free))
+            cell_id = max(self._free, key=lambda c: self._free[c])
+            self._free[cell_id] -= ram_mib * 1024 * 1024
+            return cell_id
+
+
+_topologies = {}
+_topologies_guard = threading.Lock()
+
+
+def get_topology(uri: str = DEFAULT_URI) -> HostTopology:
+    with _topologies_guard:
+        if uri not in _topologies:
+            _topologies[uri] = HostTopology(uri)
+        return _topologies[uri]
@@ -0,0 +1,327 @@
+import atexit
+import functools
+import itertools
+import json
+import os
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager, nullcontext
+
+TRACE_FORMATS = ("chrome", "otlp")
+# attributes a span hands down to the spans opened inside it
+INHERITED = ("resource", "vm", "host")
+# local checks, called around every libvirt call, not worth a span
+UNTRACED = ("isAlive",)
+
+_NOOP = nullcontext()
+
+
+class Span:
+    __slots__ = ("id", "parent", "name", "cat", "start", "end", "tid", "args")
+
+    def __init__(self, id, parent, name, cat, start, tid, args):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.cat = cat
+        self.start = start
+        self.end = None
+        self.tid = tid
+        self.args = args
+
+    def duration(self) -> float:
+        return (self.end - self.start) / 1e9
+
+
+class Tracer:
+    # collects spans (libvirt calls, processes, xml parsing, plan resources)
+    # while enabled, nested per thread: a libvirt call made while a resource
+    # is created is a child of that resource's span and carries its vm. off
+    # by default, span() is then a shared no-op
+    def __init__(self):
+        self.enabled = False
+        self._spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._threads = {}
+        self._epoch = 0
+        self._origin = 0
+
+    def enable(self):
+        self._epoch = time.time_ns()
+        self._origin = time.perf_counter_ns()
+        self.enabled = True
+
+    def now(self) -> int:
+        return time.perf_counter_ns()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _open(self, name: str, cat: str, attrs: dict, parent: Span = None) -> Span:
+        args = {}
+        if parent is not None:
+            args = {k: parent.args[k] for k in INHERITED if k in parent.args}
+        args.update((k, v) for k, v in attrs.items() if v is not None)
+        self._threads.setdefault(threading.get_ident(), threading.current_thread().name)
+        return Span(
+            next(self._ids),
+            parent.id if parent else None,
+            name,
+            cat,
+            self.now(),
+            threading.get_ident(),
+            args,
+        )
+
+    def _close(self, span: Span):
+        span.end = self.now()
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def _span(self, name: str, cat: str, attrs: dict):
+        stack = self._stack()
+        span = self._open(name, cat, attrs, stack[-1] if stack else None)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.args["error"] = str(e) or e.__class__.__name__
+            raise
+        finally:
+            stack.pop()
+            self._close(span)
+
+    def span(self, name: str, cat: str = "vmcreator", **attrs):
+        if not self.enabled:
+            return _NOOP
+        return self._span(name, cat, attrs)
+
+    def record(self, name: str, cat: str, start: int, **attrs):
+        # a span that ended just now, for coroutines: they share one thread,
+        # so they can't nest on its stack
+        if not self.enabled:
+            return
+        span = self._open(name, cat, attrs)
+        span.start = start
+        self._close(span)
+
+    def annotate(self, **attrs):
+        stack = self._stack() if self.enabled else None
+        if stack:
+            stack[-1].args.update(attrs)
+
+    def wrap(self, obj):
+        if not self.enabled:
+            return obj
+        return _wrap(obj)
+
+    def spans(self) -> list:
+        with self._lock:
+            return list(self._spans)
+
+    def to_chrome(self) -> dict:
+        threads = {}
+        events = []
+        for span in self.spans():
+            tid = threads.setdefault(span.tid, len(threads) + 1)
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.cat,
+                    "ph": "X",
+                    "ts": (span.start - self._origin) / 1000,
+                    "dur": (span.end - span.start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": span.args,
+                }
+            )
+        for ident, tid in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": self._threads.get(ident, str(ident))},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_otlp(self) -> dict:
+        trace_id = os.urandom(16).hex()
+
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        spans = []
+        for span in self.spans():
+            otlp = {
+                "traceId": trace_id,
+                "spanId": f"{span.id:016x}",
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(self._epoch + span.start - self._origin),
+                "endTimeUnixNano": str(self._epoch + span.end - self._origin),
+                "attributes": [
+                    {"key": k, "value": value(v)}
+                    for k, v in dict(span.args, category=span.cat).items()
+                ],
+            }
+            if span.parent:
+                otlp["parentSpanId"] = f"{span.parent:016x}"
+            if "error" in span.args:
+                otlp["status"] = {"code": 2, "message": span.args["error"]}
+            spans.append(otlp)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "vmcreator"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "vmcreator"}, "spans": spans}],
+                }
+            ]
+        }
+
+    def write(self, path: str, fmt: str = "chrome"):
+        trace = self.to_otlp() if fmt == "otlp" else self.to_chrome()
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+    def summary(self, limit: int = 15):
+        # the slowest plan resources and what they spent their time on
+        resources = {}
+        for span in self.spans():
+            key = span.args.get("resource")
+            if key is None:
+                continue
+            row = resources.setdefault(
+                key,
+                {
+                    "total": 0.0,
+                    "libvirt": [0, 0.0],
+                    "subprocess": [0, 0.0],
+                    "xml": [0, 0.0],
+                },
+            )
+            if span.cat == "resource":
+                row["total"] += span.duration()
+            elif span.cat in row:
+                row[span.cat][0] += 1
+                row[span.cat][1] += span.duration()
+        if not resources:
+            return
+        print(f"slowest resources (of {len(resources)}):")
+        print(
+            f"  {'resource':40} {'total':>8} {'libvirt':>14} {'processes':>14} {'xml':>12}"
+        )
+        slowest = sorted(resources.items(), key=lambda r: r[1]["total"], reverse=True)
+        for key, row in slowest[:limit]:
+            cells = [
+                f"{n} / {t:.2f}s"
+                for n, t in (row["libvirt"], row["subprocess"], row["xml"])
+            ]
+            print(
+                f"  {key[:40]:40} {row['total']:7.2f}s {cells[0]:>14} {cells[1]:>14} {cells[2]:>12}"
+            )
+
+
+tracer = Tracer()
+span = tracer.span
+
+
+class TracedObject:
+    # stands in for a libvirt object: every method call is a span and the
+    # libvirt objects it returns are wrapped as well. attributes like _o
+    # pass through, so it can still be handed to libvirt methods
+    __slots__ = ("_obj",)
+
+    def __init__(self, obj):
+        object.__setattr__(self, "_obj", obj)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith("_") or name in UNTRACED or not callable(attr):
+            return attr
+        label = f"{type(self._obj).__name__}.{name}"
+
+        def call(*args, **kwargs):
+            with tracer.span(label, "libvirt"):
+                return _wrap(attr(*args, **kwargs))
+
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)
+
+    def __repr__(self):
+        return f"<traced {self._obj!r}>"
+
+
+def _is_libvirt(obj) -> bool:
+    # virConnect, virDomain, virStorageVol... all live in the libvirt module,
+    # checked by name so tracing doesn't need libvirt to be importable
+    return type(obj).__module__ == "libvirt"
+
+
+def _wrap(result):
+    if _is_libvirt(result):
+        return TracedObject(result)
+    if isinstance(result, list) and result and _is_libvirt(result[0]):
+        return [TracedObject(obj) for obj in result]
+    return result
+
+
+def traced(name: str, cat: str = "phase"):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def parse_xml(text) -> ET.Element:
+    with tracer.span("xml.parse", "xml", size=len(text)):
+        return ET.fromstring(text)
+
+
+def check_call(command: list) -> int:
+    name = os.path.basename(command[0])
+    with tracer.span(f"exec {name}", "subprocess", argv=" ".join(command)):
+        return subprocess.check_call(command)
+
+
+def start_tracing(path: str, fmt: str = "chrome"):
+    # before the first connection is opened, only connections opened while
+    # tracing get wrapped. the trace and summary are written on the way out
+    tracer.enable()
+
+    def finish():
+        tracer.summary()
+        tracer.write(path, fmt)
+        print(f"trace written to {path} ({len(tracer.spans())} spans, {fmt})")
+
+    atexit.register(finish)
@@ -0,0 +1,113 @@
+from vmcreator.templates import (
+    IOTHREADS,
+    NUMATUNE,
+    render_cputune,
+    render_memory_backing,
+)
+
+HUGEPAGE_SIZES = {"2M": 2048, "1G": 1048576}
+DISK_CACHE_MODES = ("default", "none", "writethrough", "writeback", "directsync", "unsafe")
+DISK_IO_MODES = ("native", "threads", "io_uring")
+
+
+def cpuset(cpus) -> str:
+    # [0, 1, 2, 3, 8] -> "0-3,8"
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+class Tuning:
+    # the tuning: section of a service
+    #   hugepages: 2M | 1G | true (2M)
+    #   vcpupin: [cpuset per vcpu]     emulatorpin: cpuset
+    #   numa: auto | <node id>         iothreads: <count>
+    #   disk: {cache: none, io: native}
+    #   net_queues: <count> | auto (one per vcpu)
+    def __init__(self, config: dict = None, vcpu: int = 1):
+        config = config or {}
+        errors = []
+
+        hugepages = config.get("hugepages")
+        if hugepages is True:
+            hugepages = "2M"
+        self.hugepage_kib = None
+        if hugepages:
+            if hugepages not in HUGEPAGE_SIZES:
+                errors.append(f"hugepages: one of {', '.join(HUGEPAGE_SIZES)}")
+            else:
+                self.hugepage_kib = HUGEPAGE_SIZES[hugepages]
+
+        self.vcpupin = [str(c) for c in config.get("vcpupin") or []]
+        if self.vcpupin and len(self.vcpupin) != vcpu:
+            errors.append(f"vcpupin: needs one cpuset per vcpu ({vcpu})")
+        self.emulatorpin = config.get("emulatorpin")
+        if self.emulatorpin is not None:
+            self.emulatorpin = str(self.emulatorpin)
+
+        self.numa = config.get("numa")
+        if self.numa is not None and self.numa != "auto" and not isinstance(self.numa, int):
+            errors.append("numa: auto or a host numa node id")
+
+        self.iothreads = config.get("iothreads") or 0
+        if not isinstance(self.iothreads, int) or self.iothreads < 0:
+            errors.append("iothreads: a positive number")
+            self.iothreads = 0
+
+        disk = config.get("disk") or {}
+        self.disk_cache = disk.get("cache")
+        self.disk_io = disk.get("io")
+        if self.disk_cache and self.disk_cache not in DISK_CACHE_MODES:
+            errors.append(f"disk.cache: one of {', '.join(DISK_CACHE_MODES)}")
+        if self.disk_io and self.disk_io not in DISK_IO_MODES:
+            errors.append(f"disk.io: one of {', '.join(DISK_IO_MODES)}")
+        if self.disk_io == "native" and self.disk_cache not in ("none", "directsync"):
+            errors.append("disk.io native needs disk.cache none or directsync")
+
+        self.net_queues = config.get("net_queues")
+        if self.net_queues == "auto":
+            self.net_queues = vcpu
+        if self.net_queues is not None and (
+            not isinstance(self.net_queues, int) or self.net_queues < 1
+        ):
+            errors.append("net_queues: auto or a positive number")
+            self.net_queues = None
+        if self.net_queues == 1:
+            # one queue is what virtio-net does anyway
+            self.net_queues = None
+
+        if errors:
+            raise ValueError("invalid tuning: " + "; ".join(errors))
+
+    def disk_driver(self, index: int) -> dict:
+        # kwargs for render_disk(), disks are spread over the iothreads
+        return {
+            "cache": self.disk_cache,
+            "io": self.disk_io,
+            "iothread": (index % self.iothreads) + 1 if self.iothreads else None,
+        }
+
+    def render_head(self, ram: int, shared_ram: bool, topology=None) -> dict:
+        # fragments for render_domain(), numa placement happens here, at
+        # define time, so every vm of a run sees the earlier ones. topology:
+        # the HostTopology of the host, needed with numa
+        head = {
+            "memory_backing": render_memory_backing(shared_ram, self.hugepage_kib),
+            "cputune": render_cputune(self.vcpupin, self.emulatorpin),
+        }
+        if self.iothreads:
+            head["iothreads"] = IOTHREADS.substitute(count=self.iothreads)
+
+        node = self.numa
+        if node is not None:
+            if node == "auto":
+                node = topology.place(ram)
+            if node is not None:
+                head["numatune"] = NUMATUNE.substitute(mode="strict", nodeset=node)
+                if not self.vcpupin:
+                    head["cpuset"] = topology.get_cell(node)["cpus"]
+        return head
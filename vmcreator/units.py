@@ -0,0 +1,11 @@
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size) -> int:
+    # qemu-img style sizes: 512, 20G, 1.5T (binary units)
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip("IB") or "0"
+    unit = size[-1] if size[-1] in SIZE_UNITS else ""
+    number = size[:-1] if unit else size
+    return int(float(number) * SIZE_UNITS[unit])
@@ -0,0 +1,123 @@
+from typing import Dict
+from vmcreator.config import Config, nic_key
+from vmcreator.diff import ConfigDiff, ServiceChange
+from vmcreator.plan import Plan
+from vmcreator.planner import plan_from_config
+from vmcreator.network import InstanceNetwork
+from vmcreator.mac import MacAllocator
+from vmcreator.storage import Cloudinit
+
+
+def _apply_change(plan: Plan, change: ServiceChange):
+    def create():
+        instance = plan.get("domain", change.name).obj
+        volumes = [
+            r.obj
+            for r in plan.resources()
+            if r.kind == "volume" and r.vm == change.name
+        ]
+        for idx in change.added_volumes:
+            instance.attach_disk(volumes[idx])
+        for idx in change.grown_volumes:
+            instance.grow_disk(volumes[idx], volumes[idx].get_size())
+        for nic in change.added_networks:
+            lease = plan.get("lease", nic_key(change.name, nic.network, nic.index))
+            instance.attach_interface(lease.obj)
+        if change.vcpu or change.ram:
+            instance.redefine(vcpu=change.vcpu, ram=change.ram)
+        for line in change.ignored:
+            print(f"warning: {line}")
+
+    return create
+
+
+def _release(instancenet: InstanceNetwork):
+    def destroy():
+        if instancenet.get_network().exists():
+            instancenet.delete()
+
+    return destroy
+
+
+def _detach_nics(old_plan: Plan, change: ServiceChange):
+    def destroy():
+        instance = old_plan.get("domain", change.name).obj
+        if not instance.exists():
+            return
+        for nic in change.removed_networks:
+            lease = old_plan.get("lease", nic_key(change.name, nic.network, nic.index))
+            instance.detach_interface(lease.obj)
+
+    return destroy
+
+
+def plan_update(
+    old: Config,
+    new: Config,
+    diff: ConfigDiff,
+    debug: bool = False,
+    delete_storage: bool = False,
+    iso_backend: str = "python",
+    volume_backend: str = "libvirt",
+    macs: MacAllocator = None,
+    placement: Dict[str, str] = None,
+):
+    # returns (teardown plan on the old config, apply plan on the new config)
+    teardown = plan_from_config(
+        old.subset(diff.removed),
+        debug=debug,
+        delete_storage=delete_storage,
+        macs=macs,
+        placement=placement,
+    )
+    shrinking = [vm for vm, c in diff.changed.items() if c.removed_networks]
+    if shrinking:
+        old_plan = plan_from_config(
+            old.subset(shrinking), debug=debug, macs=macs, placement=placement
+        )
+        for vm in shrinking:
+            change = diff.changed[vm]
+            leases = []
+            for nic in change.removed_networks:
+                lease = old_plan.get("lease", nic_key(vm, nic.network, nic.index))
+                leases.append(
+                    teardown.add(
+                        lease.kind,
+                        lease.name,
+                        destroy=_release(lease.obj),
+                        vm=vm,
+                        host=lease.host,
+                    )
+                )
+            # teardown runs in reverse, so the nic is detached before its
+            # lease is released
+            teardown.add(
+                "update",
+                vm,
+                destroy=_detach_nics(old_plan, change),
+                deps=leases,
+                vm=vm,
+                host=old_plan.get("domain", vm).host,
+            )
+
+    apply = plan_from_config(
+        new.subset(diff.added + list(diff.changed)),
+        debug=debug,
+        iso_backend=iso_backend,
+        volume_backend=volume_backend,
+        macs=macs,
+        placement=placement,
+    )
+    for vm, change in diff.changed.items():
+        if change.cloudinit:
+            cloudinit: Cloudinit = apply.get("cloudinit", f"{vm}.cloudinit.iso").obj
+            cloudinit.set_force(True)
+        apply.add(
+            "update",
+            vm,
+            create=_apply_change(apply, change),
+            deps=[apply.get("domain", vm)],
+            vm=vm,
+            host=apply.get("domain", vm).host,
+        )
+    return teardown, apply